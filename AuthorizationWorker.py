@@ -0,0 +1,174 @@
+import itertools
+import threading
+import time
+from collections import deque
+from PyQt5.QtCore import QThread, QCoreApplication, pyqtSignal
+from Metrics import Metrics
+from StreamingRecognizer import StreamingRecognizer
+from UserIdentification import UserIdentification
+from UserSearch import UserSearch
+
+class AuthorizationWorker(QThread):
+    '''Runs face authorization requests off the GUI thread and reports results through signals.
+
+    With coalesce enabled only the newest waiting request is kept, so repeated clicks while a
+    request is running lead to a single follow-up authorization instead of a backlog.
+    '''
+    authorization_complete = pyqtSignal(int, object, dict)
+    authorization_failed = pyqtSignal(int, str, dict)
+    authorization_cancelled = pyqtSignal(int)
+
+    def __init__(self, coalesce=True, recognizer_options=None):
+        super().__init__()
+        self.coalesce = coalesce
+        self.recognizer_options = recognizer_options or {}
+        self.request_ids = itertools.count(1)
+        self.last_request_id = 0
+        self.cancelled_up_to = 0
+        self.pending = deque()
+        self.cancelled = set()
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.user_identification = None
+
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def submit(self, image):
+        '''
+            Queue an image for authorization, starting the worker on first use.
+            :param image: BGR frame that the worker may keep until it is processed
+            :return: id of the request, passed back with every signal
+        '''
+        return self.enqueue(image, streaming=False)
+
+    def submit_stream(self, camera_view):
+        '''
+            Queue a multi-frame authorization reading consecutive frames from the camera.
+            :param camera_view: CameraView to read frames from while the request runs
+            :return: id of the request, passed back with every signal
+        '''
+        return self.enqueue(camera_view, streaming=True)
+
+    def enqueue(self, source, streaming):
+        with self.condition:
+            request_id = next(self.request_ids)
+            self.last_request_id = request_id
+            if self.coalesce:
+                while self.pending:
+                    self.authorization_cancelled.emit(self.pending.popleft()[0])
+            self.pending.append((request_id, source, streaming, time.perf_counter()))
+            Metrics.set_gauge("authorization_queue_depth", len(self.pending))
+            self.condition.notify()
+
+        if not self.isRunning():
+            self.stopping = False
+            self.start()
+        return request_id
+
+    def cancel(self, request_id=None):
+        '''Cancel one request, or every waiting and running request when no id is given'''
+        with self.condition:
+            if request_id is None:
+                dropped = [request[0] for request in self.pending]
+                self.pending.clear()
+                self.cancelled.clear()
+                self.cancelled_up_to = self.last_request_id
+            else:
+                dropped = [request[0] for request in self.pending if request[0] == request_id]
+                self.pending = deque(request for request in self.pending if request[0] != request_id)
+                self.cancelled.add(request_id)
+
+        for dropped_id in dropped:
+            self.authorization_cancelled.emit(dropped_id)
+
+    def stop(self):
+        '''Cancel everything and wait for the worker thread to finish'''
+        self.cancel()
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.wait()
+
+    def is_cancelled(self, request_id):
+        with self.condition:
+            return request_id <= self.cancelled_up_to or request_id in self.cancelled
+
+    def run(self):
+        '''Process queued requests until the worker is stopped'''
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.stopping)
+                if self.stopping:
+                    return
+                request_id, source, streaming, submitted = self.pending.popleft()
+                Metrics.set_gauge("authorization_queue_depth", len(self.pending))
+
+            with Metrics.span("authorization"):
+                if streaming:
+                    self.process_stream(request_id, source, submitted)
+                else:
+                    self.process(request_id, source, submitted)
+
+    def get_user_identification(self):
+        if self.user_identification is None:
+            self.user_identification = UserIdentification()
+        return self.user_identification
+
+    def process(self, request_id, image, submitted):
+        '''Run extraction and search for one request, checking for cancellation between stages'''
+        started = time.perf_counter()
+        timings = {"queued": started - submitted}
+        try:
+            self.get_user_identification()
+
+            feature_vector = self.user_identification.extract_feature_vector(image)
+            extracted = time.perf_counter()
+            timings["extraction"] = extracted - started
+            if self.is_cancelled(request_id):
+                self.authorization_cancelled.emit(request_id)
+                return
+
+            user_search = UserSearch(user_identification=self.user_identification)
+            result = user_search.find_nearest_user(feature_vector)
+            finished = time.perf_counter()
+            timings["search"] = finished - extracted
+            timings["total"] = finished - submitted
+
+            if self.is_cancelled(request_id):
+                self.authorization_cancelled.emit(request_id)
+            else:
+                self.authorization_complete.emit(request_id, result, timings)
+
+        except Exception as e:
+            timings["total"] = time.perf_counter() - submitted
+            if self.is_cancelled(request_id):
+                self.authorization_cancelled.emit(request_id)
+            else:
+                self.authorization_failed.emit(request_id, str(e), timings)
+
+    def process_stream(self, request_id, camera_view, submitted):
+        '''Run multi-frame recognition for one request, stopping early when it is cancelled'''
+        started = time.perf_counter()
+        timings = {"queued": started - submitted}
+        try:
+            user_search = UserSearch(user_identification=self.get_user_identification())
+            recognizer = StreamingRecognizer(user_search, **self.recognizer_options)
+            result, statistics = recognizer.recognize(camera_view, lambda: self.is_cancelled(request_id))
+            finished = time.perf_counter()
+            timings["recognition"] = finished - started
+            timings["total"] = finished - submitted
+            timings.update(statistics)
+
+            if self.is_cancelled(request_id):
+                self.authorization_cancelled.emit(request_id)
+            else:
+                self.authorization_complete.emit(request_id, result, timings)
+
+        except Exception as e:
+            timings["total"] = time.perf_counter() - submitted
+            if self.is_cancelled(request_id):
+                self.authorization_cancelled.emit(request_id)
+            else:
+                self.authorization_failed.emit(request_id, str(e), timings)
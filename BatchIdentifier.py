@@ -0,0 +1,223 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+from DatabaseManager import DatabaseManager
+from FaceExceptions import NoFaceDetectedException, MultipleFacesDetectedException, LowQualityFrameException
+from FrameQualityGate import FrameQualityGate
+from Metrics import Metrics
+from UserIdentification import UserIdentification
+from UserSearch import UserSearch
+
+VIDEO_EXTENSIONS = {".mp4", ".avi", ".mov", ".mkv", ".webm"}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+
+worker_identification = None
+worker_quality_gate = None
+
+
+def init_worker(quality_gate=False, metrics=False):
+    '''
+        Loads the face models once per worker process, optionally with a FrameQualityGate.
+        :param metrics: record pipeline metrics in the worker, they are returned with every result
+    '''
+    global worker_identification, worker_quality_gate
+    # A forked worker starts with a copy of the parent's metrics, which must not be sent back
+    Metrics.reset()
+    Metrics.enable(metrics)
+    worker_identification = UserIdentification()
+    worker_quality_gate = FrameQualityGate() if quality_gate else None
+
+
+def extract_item(item):
+    '''
+        Extracts the feature vector of one image or video frame inside a worker process.
+        :param item: (source, frame index, image path, encoded image bytes or decoded frame)
+        :return: (source, frame index, feature vector or None, status, error message, extraction seconds),
+                 metrics recorded by the worker for this item or None, see Metrics.drain()
+    '''
+    result = extract(*item)
+    return result, Metrics.drain()
+
+
+def extract(source, frame_index, image):
+    '''Decodes the image if needed and extracts its feature vector, reporting failures as a status'''
+    start = time.perf_counter()
+    try:
+        if isinstance(image, str):
+            image = cv2.imread(image)
+            if image is None:
+                return source, frame_index, None, "error", "Could not read image.", time.perf_counter() - start
+        elif isinstance(image, (bytes, bytearray)):
+            image = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if image is None:
+                return source, frame_index, None, "error", "Could not decode image.", time.perf_counter() - start
+        feature_vector = worker_identification.extract_feature_vector(image, quality_gate=worker_quality_gate)
+        return source, frame_index, feature_vector, "ok", None, time.perf_counter() - start
+    except NoFaceDetectedException as e:
+        return source, frame_index, None, "no_face", str(e), time.perf_counter() - start
+    except MultipleFacesDetectedException as e:
+        return source, frame_index, None, "multiple_faces", str(e), time.perf_counter() - start
+    except LowQualityFrameException as e:
+        return source, frame_index, None, e.reason, str(e), time.perf_counter() - start
+    except Exception as e:
+        return source, frame_index, None, "error", str(e), time.perf_counter() - start
+
+
+def iterate_sources(paths, frame_step=1):
+    '''
+        Yields work items for image files, video files and directories containing them.
+        Images are passed as paths so the workers decode them; video frames are decoded here.
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            children = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+            yield from iterate_sources([child for child in children if os.path.isfile(child)], frame_step)
+            continue
+
+        extension = os.path.splitext(path)[1].lower()
+        if extension in VIDEO_EXTENSIONS:
+            capture = cv2.VideoCapture(path)
+            frame_index = 0
+            try:
+                while True:
+                    ret, frame = capture.read()
+                    if not ret:
+                        break
+                    if frame_index % frame_step == 0:
+                        yield path, frame_index, frame
+                    frame_index += 1
+            finally:
+                capture.release()
+        elif extension in IMAGE_EXTENSIONS:
+            yield path, None, path
+
+
+class BatchIdentifier:
+    '''Identifies faces in image sets and video files using all CPU cores.
+
+    A reader thread feeds a bounded queue, a process pool extracts features with a bounded
+    number of items in flight, and extracted vectors are matched against the gallery in
+    micro-batches. The bounds keep memory flat however large the archive is. With quality_gate
+    enabled, blurred, badly exposed and turned-away frames are rejected before detection.
+    '''
+
+    def __init__(self, gallery=None, db_name="user_identification.db", workers=None,
+                 queue_size=64, max_in_flight=None, search_batch_size=64, threshold=None, quality_gate=False):
+        self.gallery = gallery if gallery is not None else UserSearch.load_gallery(DatabaseManager(db_name))
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = queue_size
+        self.max_in_flight = max_in_flight or self.workers * 4
+        self.search_batch_size = search_batch_size
+        self.threshold = self.gallery.match_threshold(UserSearch.distance_threshold) if threshold is None \
+            else threshold
+        self.quality_gate = quality_gate
+        self.metrics = Metrics.enabled
+
+    def read_items(self, items, work_queue, stop_event):
+        '''
+            Reader thread: decode sources into the bounded work queue, blocking while it is full.
+            The queue ends with None, or with the exception that stopped reading so identify() can raise it.
+        '''
+        end = None
+        try:
+            for item in items:
+                if not self.put(work_queue, (item, time.perf_counter()), stop_event):
+                    return
+        except Exception as e:
+            end = e
+        finally:
+            self.put(work_queue, end, stop_event)
+
+    @staticmethod
+    def put(work_queue, entry, stop_event):
+        '''Put an entry into the queue, giving up when the consumer has stopped'''
+        while not stop_event.is_set():
+            try:
+                work_queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def identify(self, items):
+        '''
+            Runs identification over work items and yields one result dict per item.
+            An exception raised while iterating items is raised here after the items read before it.
+            :param items: iterable of (source, frame index, image path or frame), see iterate_sources()
+        '''
+        work_queue = queue.Queue(maxsize=self.queue_size)
+        stop_event = threading.Event()
+        reader = threading.Thread(target=self.read_items, args=(items, work_queue, stop_event), daemon=True)
+        reader.start()
+
+        in_flight = deque()
+        extracted = []
+        read_error = None
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                     initargs=(self.quality_gate, self.metrics)) as executor:
+                finished_reading = False
+                while not finished_reading or in_flight:
+                    while not finished_reading and len(in_flight) < self.max_in_flight:
+                        entry = work_queue.get()
+                        if entry is None or isinstance(entry, Exception):
+                            finished_reading = True
+                            read_error = entry
+                            break
+                        item, queued = entry
+                        in_flight.append((executor.submit(extract_item, item), queued))
+
+                    Metrics.set_gauge("batch_queue_depth", work_queue.qsize())
+                    Metrics.set_gauge("batch_in_flight", len(in_flight))
+                    if in_flight:
+                        future, queued = in_flight.popleft()
+                        result, worker_metrics = future.result()
+                        Metrics.merge(worker_metrics)
+                        extracted.append((result, queued))
+
+                    if len(extracted) >= self.search_batch_size or (finished_reading and not in_flight):
+                        yield from self.search(extracted)
+                        extracted = []
+            if read_error is not None:
+                # The items read before the failure were reported, the run must not look complete
+                raise read_error
+        finally:
+            stop_event.set()
+            reader.join()
+
+    def search(self, extracted):
+        '''Matches a micro-batch of extraction results against the gallery with one query'''
+        vectors = [result[2] for result, _ in extracted if result[2] is not None]
+        start = time.perf_counter()
+        with Metrics.span("batch_search"):
+            matches = iter(self.gallery.batch_nearest(vectors, self.threshold) if vectors else [])
+        search_seconds = (time.perf_counter() - start) / max(len(vectors), 1)
+        finished = time.perf_counter()
+
+        for (source, frame_index, feature_vector, status, error, extraction_seconds), queued in extracted:
+            record = {
+                "source": source,
+                "frame": frame_index,
+                "status": status,
+                "user_id": None,
+                "name": None,
+                "distance": None,
+                "error": error,
+                "extraction_ms": extraction_seconds * 1000,
+                "search_ms": None,
+                "latency_ms": (finished - queued) * 1000,
+            }
+            if feature_vector is not None:
+                match = next(matches)
+                record["search_ms"] = search_seconds * 1000
+                if match:
+                    (record["user_id"], record["name"]), record["distance"] = match
+                    record["status"] = "match"
+                else:
+                    record["status"] = "no_match"
+            yield record
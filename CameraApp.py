@@ -1,9 +1,9 @@
-import cv2
 from PyQt5.QtWidgets import QApplication, QLabel, QWidget, QVBoxLayout, QPushButton, QMessageBox, QHBoxLayout
-from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtCore import QTimer, Qt
 from CameraView import CameraView
-from UserSearch import UserSearch
+from FrameRenderer import FrameRenderer
+from ModelRegistry import ModelRegistry
+from AuthorizationWorker import AuthorizationWorker
 from AfterAuthorizationScreen import AfterAuthorizationScreen
 
 class CameraApp(QWidget):
@@ -13,6 +13,11 @@ class CameraApp(QWidget):
         super().__init__()
         self.stacked_widget = stacked_widget
         self.camera_view = None
+        self.last_timings = None
+
+        self.authorization_worker = AuthorizationWorker()
+        self.authorization_worker.authorization_complete.connect(self.on_authorization_complete)
+        self.authorization_worker.authorization_failed.connect(self.on_authorization_failed)
 
         self.init_ui()
         self.timer = QTimer()
@@ -27,6 +32,7 @@ class CameraApp(QWidget):
         self.label = QLabel(self)
         self.label.setFixedSize(640, 400)
         self.layout.addWidget(self.label, alignment=Qt.AlignCenter)
+        self.renderer = FrameRenderer(self.label)
 
         button_layout = QHBoxLayout()
 
@@ -64,10 +70,30 @@ class CameraApp(QWidget):
         self.setLayout(self.layout)
         self.setWindowTitle("Camera View")
 
+        model_warmup = getattr(self.stacked_widget, 'model_warmup', None)
+        if model_warmup is not None and not ModelRegistry.is_ready():
+            self.authorize_button.setEnabled(False)
+            self.authorize_button.setText("Loading models...")
+            model_warmup.warmup_complete.connect(self.on_models_ready)
+            # The warm-up may have ended before this screen existed or before the connection was made
+            if ModelRegistry.warm_up_finished():
+                self.on_models_ready(ModelRegistry.is_ready(), ModelRegistry.warm_up_error() or "")
+
+    def on_models_ready(self, success, message):
+        '''Enable authorization once the background model warm-up has succeeded, otherwise show why it failed'''
+        if success:
+            self.authorize_button.setText("Authorize")
+            self.authorize_button.setEnabled(True)
+            return
+        self.authorize_button.setText("Face models failed to load")
+        self.authorize_button.setEnabled(False)
+        self.authorize_button.setToolTip(message)
+
     def start_camera(self):
         '''Initialize the camera after switching to this screen'''
         if self.camera_view is None:
-            self.camera_view = CameraView()
+            self.camera_view = CameraView.acquire()
+            self.renderer.reset()
             self.timer.start(30)
 
     def stop_camera(self):
@@ -82,44 +108,57 @@ class CameraApp(QWidget):
         if self.camera_view is None:
             return
 
-        frame = self.camera_view.get_frame()
-        if frame is not None:
-            rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            h, w, ch = rgb_image.shape
-            bytes_per_line = ch * w
-            q_image = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-
-            pixmap = QPixmap.fromImage(q_image).scaled(self.label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        frame, sequence, _ = self.latest()
+        self.renderer.render(frame, sequence)
 
-            self.label.setPixmap(pixmap)
+    def latest(self):
+        '''Return the newest frame with its sequence number and timestamp, only valid for immediate display'''
+        if self.camera_view:
+            return self.camera_view.get_latest()
+        return None, 0, 0.0
 
-    def capture_frame(self):
-        '''Capture and return the current frame'''
+    def latest_frame(self):
+        '''Return the newest frame without copying it, only valid for immediate display'''
         if self.camera_view:
             return self.camera_view.get_frame()
         return None
 
+    def capture_frame(self):
+        '''Capture and return a copy of the current frame that is safe to keep'''
+        frame = self.latest_frame()
+        if frame is not None:
+            return frame.copy()
+        return None
+
     def go_back(self):
         '''Stop the camera and switch back to the main screen'''
         self.stop_camera()
         self.stacked_widget.setCurrentIndex(0)
 
     def authorize(self):
-        try:
-            image = self.capture_frame()
-            if image is not None:
-                user_search = UserSearch(image)
-                user = user_search.get_nearest_user()
-                if user:
-                    username = user[0][1]
-                    self.stacked_widget.authorization_screen = AfterAuthorizationScreen(self.stacked_widget, username)
-                    self.stacked_widget.addWidget(self.stacked_widget.authorization_screen)
-                    self.stacked_widget.setCurrentWidget(self.stacked_widget.authorization_screen)
-                else:
-                    QMessageBox.warning(self, "Authorization Failed", "Authorization denied. Please try again.")
-        except Exception as e:
-            print("Exception: ", e)
-            QMessageBox.critical(self, "Error", f"An error has occured: {e}")
+        '''Start multi-frame authorization on the worker, the preview keeps running meanwhile'''
+        if self.camera_view is not None:
+            self.authorization_worker.submit_stream(self.camera_view)
+            self.authorize_button.setText("Authorizing...")
+
+    def on_authorization_complete(self, request_id, user, timings):
+        '''Show the result of a finished authorization request'''
+        self.authorize_button.setText("Authorize")
+        self.last_timings = timings
+        if user:
+            username = user[0][1]
+            self.stacked_widget.authorization_screen = AfterAuthorizationScreen(self.stacked_widget, username)
+            self.stacked_widget.addWidget(self.stacked_widget.authorization_screen)
+            self.stacked_widget.setCurrentWidget(self.stacked_widget.authorization_screen)
+        else:
+            QMessageBox.warning(self, "Authorization Failed", "Authorization denied. Please try again.")
+
+    def on_authorization_failed(self, request_id, error, timings):
+        '''Report an authorization request that raised an error'''
+        self.authorize_button.setText("Authorize")
+        self.last_timings = timings
+        print("Exception: ", error)
+        QMessageBox.critical(self, "Error", f"An error has occured: {error}")
 
     def showEvent(self, event):
         '''Called when the widget with camera is being shown, starts the camera'''
@@ -127,7 +166,9 @@ class CameraApp(QWidget):
         super().showEvent(event)
 
     def hideEvent(self, event):
-        '''Called when the widget is hidden, stops the camera'''
+        '''Called when the widget is hidden, stops the camera and drops pending authorizations'''
+        self.authorization_worker.cancel()
+        self.authorize_button.setText("Authorize")
         self.stop_camera()
         super().hideEvent(event)
 
@@ -1,21 +1,111 @@
+import threading
+import time
 import cv2
+from FrameRingBuffer import FrameRingBuffer
+from Metrics import Metrics
 
 class CameraView:
-    '''This class is responsible for camera stream'''
+    '''This class is responsible for camera stream
 
-    def __init__(self, camera_index=0):
+    In threaded mode a background thread keeps grabbing frames into a FrameRingBuffer,
+    so get_frame() returns the newest frame immediately instead of waiting on the driver.
+    '''
+
+    shared_views = {}
+    shared_lock = threading.Lock()
+
+    def __init__(self, camera_index=0, threaded=False, buffer_size=4):
         self.camera_index = camera_index
         self.camera = cv2.VideoCapture(self.camera_index)
         if not self.camera.isOpened():
             raise Exception(f"Error: Could not open camera with index {camera_index}.")
 
+        self.threaded = threaded
+        self.users = 1
+        self.buffer = None
+        self.capture_thread = None
+        self.stop_event = threading.Event()
+
+        if threaded:
+            # Only the newest frame is wanted, so keep the driver queue as short as possible
+            self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            self.buffer = FrameRingBuffer(buffer_size)
+            self.capture_thread = threading.Thread(target=self.capture_loop, daemon=True)
+            self.capture_thread.start()
+
+    @classmethod
+    def acquire(cls, camera_index=0):
+        '''Returns a threaded view of the camera shared by all consumers of the same device'''
+        with cls.shared_lock:
+            view = cls.shared_views.get(camera_index)
+            if view is None:
+                view = cls(camera_index, threaded=True)
+                cls.shared_views[camera_index] = view
+            else:
+                view.users += 1
+            return view
+
+    def capture_loop(self):
+        '''Continuously grab frames into the ring buffer until the view is released'''
+        while not self.stop_event.is_set():
+            if not self.camera.grab():
+                Metrics.increment("camera_grab_failures")
+                time.sleep(0.01)
+                continue
+            timestamp = time.monotonic()
+
+            slot = self.buffer.next_slot() if self.buffer.slots is not None else None
+            ret, frame = self.camera.retrieve(slot)
+            if not ret:
+                continue
+            if slot is None or frame.shape != slot.shape:
+                self.buffer.allocate(frame.shape, frame.dtype)
+                slot = self.buffer.next_slot()
+            if frame is not slot:
+                slot[...] = frame
+
+            self.buffer.publish(timestamp)
+
     def get_frame(self):
         '''Get the camera frame and return it'''
-        ret, frame = self.camera.read()
+        if self.threaded:
+            return self.buffer.latest()[0]
+
+        with Metrics.span("camera_read"):
+            ret, frame = self.camera.read()
         if ret:
             return frame
+        Metrics.increment("camera_grab_failures")
         return None
 
+    def get_latest(self):
+        '''
+            Get the newest frame together with its sequence number and capture timestamp.
+            The frame is a view into the ring buffer, copy it before keeping it around.
+        '''
+        if self.threaded:
+            return self.buffer.latest()
+
+        frame = self.get_frame()
+        return frame, 0, time.monotonic()
+
+    def wait_for_frame(self, sequence, timeout=None):
+        '''Block until a frame newer than the given sequence number has been captured'''
+        if self.threaded:
+            return self.buffer.wait_for_newer(sequence, timeout)
+        return self.get_latest()
+
     def release(self):
         '''Release the camera'''
+        if self.threaded:
+            with self.shared_lock:
+                self.users -= 1
+                if self.users > 0:
+                    return
+                if self.shared_views.get(self.camera_index) is self:
+                    del self.shared_views[self.camera_index]
+
+            self.stop_event.set()
+            self.capture_thread.join()
+
         self.camera.release()
@@ -1,7 +1,24 @@
+import atexit
 import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 import bcrypt
+import numpy as np
 from cryptography.fernet import Fernet, InvalidToken
+from DatabaseSession import DatabaseSession
+from EncryptedContainer import EncryptedContainer
+from Metrics import Metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SCHEMA_VERSION = 4
+FEATURE_VECTOR_VERSION = 1
+FEATURE_VECTOR_DTYPE = np.dtype('<f4')
+MAX_TEMPLATES = 10
 
 def load_or_create_key():
     """Loads an existing encryption key or creates a new one if it doesn't exist."""
@@ -16,39 +33,205 @@ def load_or_create_key():
         return key
 
 
+def hash_password(password):
+    """Hashes a password using bcrypt. Module-level so it can run in worker processes."""
+    salt = bcrypt.gensalt()
+    hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
+    return hashed_password.decode('utf-8')
+
+
+def pack_feature_vector(feature_vector):
+    """Converts a feature vector (list, array or comma-separated string) into a little-endian float32 BLOB."""
+    if isinstance(feature_vector, str):
+        feature_vector = np.array(feature_vector.split(","), dtype=np.float64)
+    vector = np.asarray(feature_vector, dtype=FEATURE_VECTOR_DTYPE).ravel()
+    return vector.tobytes(), vector.shape[0]
+
+
+def as_template_matrix(feature_vectors):
+    """Converts one feature vector or a sequence of them into a (templates, dimension) float32 matrix."""
+    if isinstance(feature_vectors, str):
+        feature_vectors = np.array(feature_vectors.split(","), dtype=np.float64)
+    matrix = np.asarray(feature_vectors, dtype=FEATURE_VECTOR_DTYPE)
+    return matrix.reshape(1, -1) if matrix.ndim < 2 else matrix
+
+
+def unpack_feature_vector(blob):
+    """Returns a read-only float32 view over a feature vector BLOB without copying it."""
+    return np.frombuffer(blob, dtype=FEATURE_VECTOR_DTYPE)
+
+
 class DatabaseManager:
-    """Handles database operations with file-level encryption."""
+    """Handles database operations with file-level encryption.
+
+    By default every operation decrypts the file, queries it and encrypts it again. After
+    open_session() all managers for the same file share one decrypted in-memory database instead.
+    """
+
+    sessions = {}
+    sessions_lock = threading.Lock()
+    closed_at_exit = set()
+    # Lock files held by the current thread, so file_lock() can be nested
+    held_locks = threading.local()
 
     def __init__(self, db_name="user_identification.db"):
         self.db_name = db_name
         self.key = load_or_create_key()
         self.cipher_suite = Fernet(self.key)
+        self.container = EncryptedContainer(self.key)
+        self.schema_checked = False
 
-        if not os.path.exists(self.db_name):
+        if self.session() is None and not os.path.exists(self.db_name):
             self.init_db()
 
+    @classmethod
+    def open_session(cls, db_name="user_identification.db", pool_size=4, flush_every=1):
+        """Decrypts the database once into memory and routes all managers of this file through it.
+
+        Args:
+            db_name (str): The database file to open.
+            pool_size (int): Number of pooled connections serving queries.
+            flush_every (int): Number of commits after which the file is re-encrypted. With more
+                than 1, commits not yet written fail to merge with writes of other processes and
+                the session raises ValueError instead of overwriting them.
+
+        Returns:
+            DatabaseSession: The shared session, also closed automatically at exit.
+        """
+        path = os.path.abspath(db_name)
+        with cls.sessions_lock:
+            session = cls.sessions.get(path)
+            if session is None:
+                session = DatabaseSession(cls(db_name), pool_size=pool_size, flush_every=flush_every)
+                cls.sessions[path] = session
+                # Once per file, processes that reopen sessions would otherwise pile up exit handlers
+                if path not in cls.closed_at_exit:
+                    cls.closed_at_exit.add(path)
+                    atexit.register(cls.close_session, path)
+        return session
+
+    @classmethod
+    def close_session(cls, db_name="user_identification.db"):
+        """Writes the session back to the encrypted file and returns to per-call decryption."""
+        with cls.sessions_lock:
+            session = cls.sessions.pop(os.path.abspath(db_name), None)
+        if session is not None:
+            session.close()
+            EncryptedContainer.forget(db_name)
+
+    def session(self):
+        """Returns the open session for this database file, if any."""
+        return self.sessions.get(os.path.abspath(self.db_name))
+
+    def file_state(self):
+        """Returns what identifies the current version of the database file, None when it does not exist.
+
+        Every write replaces the file, so a different inode, size or modification time means
+        another manager or process wrote it.
+        """
+        try:
+            stat = os.stat(self.db_name)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @contextmanager
+    def file_lock(self):
+        """Holds an exclusive lock on the database file across processes while the block runs.
+
+        Taken around every read and write of the file, so no process reads a file that another
+        one is rewriting, or writes back a copy loaded before another process changed it. The
+        lock is reentrant within a thread. Without fcntl (Windows) it does nothing.
+        """
+        if fcntl is None:
+            yield
+            return
+
+        path = os.path.abspath(self.db_name)
+        held = self.held_locks.__dict__.setdefault("files", {})
+        if path in held:
+            held[path][1] += 1
+            try:
+                yield
+            finally:
+                held[path][1] -= 1
+            return
+
+        with open(f"{path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            held[path] = [lock_file, 1]
+            try:
+                yield
+            finally:
+                del held[path]
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def read_database_bytes(self):
+        """Returns the decrypted database contents without writing anything to disk.
+
+        Files still encrypted as a single Fernet token are read as well, the next
+        write_database_bytes() stores them in the chunked container format.
+        """
+        if not os.path.exists(self.db_name):
+            return b""
+
+        with open(self.db_name, "rb") as file:
+            prefix = file.read(16)
+            if not prefix or prefix.startswith(b'SQLite format 3'):
+                return prefix + file.read()
+
+        with Metrics.span("db_decrypt"):
+            if EncryptedContainer.is_container(prefix):
+                return self.container.read(self.db_name)
+            with open(self.db_name, "rb") as file:
+                return self.cipher_suite.decrypt(file.read())
+
+    def write_database_bytes(self, data):
+        """Encrypts the database contents and atomically replaces the file on disk.
+
+        Only the chunks that changed since the last read or write of this file are encrypted again.
+        """
+        with Metrics.span("db_encrypt"):
+            encrypted = self.container.write(self.db_name, data)
+        chunks = -(-len(data) // self.container.chunk_size)
+        Metrics.increment("db_chunks_encrypted", encrypted)
+        Metrics.increment("db_chunks_reused", chunks - encrypted)
+
     def encrypt_file(self):
         """Encrypts the database file if it is not already encrypted."""
+        with Metrics.span("db_encrypt_file"):
+            self._encrypt_file()
+
+    def _encrypt_file(self):
         if os.path.exists(self.db_name):
             with open(self.db_name, "rb") as file:
-                file_data = file.read()
+                prefix = file.read(16)
 
-            if file_data.startswith(b'SQLite format 3'):
-                encrypted_data = self.cipher_suite.encrypt(file_data)
-                with open(self.db_name, "wb") as file:
-                    file.write(encrypted_data)
+            if prefix.startswith(b'SQLite format 3'):
+                self.container.encrypt_file(self.db_name)
 
     def decrypt_file(self):
         """Decrypts the database file if it is encrypted."""
+        with Metrics.span("db_decrypt_file"):
+            self._decrypt_file()
+
+    def _decrypt_file(self):
         if not os.path.exists(self.db_name):
             return
 
         with open(self.db_name, "rb") as file:
-            encrypted_data = file.read()
+            prefix = file.read(16)
 
-        if encrypted_data.startswith(b'SQLite format 3'):
+        if prefix.startswith(b'SQLite format 3'):
             return
 
+        if EncryptedContainer.is_container(prefix):
+            self.container.decrypt_file(self.db_name)
+            return
+
+        # Legacy single-token Fernet file, encrypt_file() writes it back as a container
+        with open(self.db_name, "rb") as file:
+            encrypted_data = file.read()
         try:
             decrypted_data = self.cipher_suite.decrypt(encrypted_data)
             with open(self.db_name, "wb") as file:
@@ -60,29 +243,207 @@ class DatabaseManager:
         """Establishes a connection to the database after decryption."""
         self.decrypt_file()
         conn = sqlite3.connect(self.db_name)
+        if not self.schema_checked:
+            self.migrate_db(conn)
         return conn
 
+    @contextmanager
+    def reading(self):
+        """Yields a connection for queries, from the session pool when a session is open."""
+        Metrics.increment("db_reads")
+        session = self.session()
+        if session is not None:
+            with session.reading() as conn:
+                yield conn
+            return
+
+        with self.file_lock():
+            conn = self.connect()
+            try:
+                yield conn
+            finally:
+                conn.close()
+                self.encrypt_file()
+
+    @contextmanager
+    def writing(self):
+        """Yields a connection for changes and commits them when the block succeeds."""
+        Metrics.increment("db_writes")
+        session = self.session()
+        if session is not None:
+            with session.writing() as conn:
+                yield conn
+            return
+
+        with self.file_lock():
+            conn = self.connect()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                conn.close()
+                self.encrypt_file()
+
     def init_db(self):
         """Initializes the database by creating the users table if it doesn't exist."""
-        conn = self.connect()
+        with self.file_lock():
+            conn = self.connect()
+            self.create_schema(conn)
+            conn.close()
+            self.encrypt_file()
+
+    def create_schema(self, conn):
+        """Creates the tables of the current schema version if they don't exist."""
         cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'")
+        if cursor.fetchone():
+            return
+
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT NOT NULL,
                 password TEXT NOT NULL,
-                feature_vector TEXT NOT NULL
+                feature_vector BLOB NOT NULL,
+                feature_dim INTEGER NOT NULL DEFAULT 0,
+                feature_version INTEGER NOT NULL DEFAULT 0,
+                spread REAL NOT NULL DEFAULT 0
             )
         """)
+        self.create_change_log(cursor)
+        self.create_templates(cursor)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
-        conn.close()
-        self.encrypt_file()
+
+    def create_change_log(self, cursor):
+        """Creates the user_changes table and the triggers that fill it.
+
+        Every insert, update of a name or feature vector and delete in users appends the
+        user id under a new, monotonically increasing revision. Caches remember the last
+        revision they saw and load only the users changed since then with get_changes().
+        Only the latest change of each user is kept, so the log never grows beyond one
+        row per user id ever used, however often users are updated.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_changes (
+                revision INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_changes_user_id ON user_changes (user_id)")
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS users_inserted AFTER INSERT ON users
+            BEGIN
+                DELETE FROM user_changes WHERE user_id = NEW.id;
+                INSERT INTO user_changes (user_id) VALUES (NEW.id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS users_updated AFTER UPDATE OF name, feature_vector ON users
+            BEGIN
+                DELETE FROM user_changes WHERE user_id = NEW.id;
+                INSERT INTO user_changes (user_id) VALUES (NEW.id);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS users_deleted AFTER DELETE ON users
+            BEGIN
+                DELETE FROM user_changes WHERE user_id = OLD.id;
+                INSERT INTO user_changes (user_id) VALUES (OLD.id);
+            END
+        """)
+
+    def create_templates(self, cursor):
+        """Creates the user_templates table holding every enrolled feature vector of a user.
+
+        users.feature_vector keeps the centroid of a user's templates and users.spread the
+        largest distance of a template from it, so search can rank users by centroid first.
+        """
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_templates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                feature_vector BLOB NOT NULL,
+                feature_dim INTEGER NOT NULL,
+                feature_version INTEGER NOT NULL
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS user_templates_user_id ON user_templates (user_id)")
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS users_deleted_templates AFTER DELETE ON users
+            BEGIN DELETE FROM user_templates WHERE user_id = OLD.id; END
+        """)
+
+    def migrate_db(self, conn):
+        """Upgrades an older database in place.
+
+        Version 1 converts text feature vectors into float32 BLOBs, version 2 adds the
+        user_changes log, version 3 turns every stored vector into the user's first template
+        and version 4 keeps only the latest change of each user in the log.
+
+        The migration runs once: the schema version is stored in SQLite's user_version pragma.
+        Returns True when the database was changed.
+        """
+        cursor = conn.cursor()
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        tables = cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchall()
+        migrated = False
+        vacuum = False
+
+        if version < 1 and tables:
+            columns = [row[1] for row in cursor.execute("PRAGMA table_info(users)")]
+            if "feature_dim" not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN feature_dim INTEGER NOT NULL DEFAULT 0")
+            if "feature_version" not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN feature_version INTEGER NOT NULL DEFAULT 0")
+
+            rows = cursor.execute("SELECT id, feature_vector FROM users WHERE typeof(feature_vector) = 'text'").fetchall()
+            for user_id, feature_vector in rows:
+                blob, dimension = pack_feature_vector(feature_vector)
+                cursor.execute("""
+                    UPDATE users SET feature_vector = ?, feature_dim = ?, feature_version = ?
+                    WHERE id = ?
+                """, (blob, dimension, FEATURE_VECTOR_VERSION, user_id))
+            vacuum = True
+
+        if version < 2 and tables:
+            self.create_change_log(cursor)
+
+        if version < 3 and tables:
+            cursor.execute("ALTER TABLE users ADD COLUMN spread REAL NOT NULL DEFAULT 0")
+            self.create_templates(cursor)
+            cursor.execute("""
+                INSERT INTO user_templates (user_id, feature_vector, feature_dim, feature_version)
+                SELECT id, feature_vector, feature_dim, feature_version FROM users ORDER BY id
+            """)
+
+        if version < 4 and tables:
+            # Revisions stay as they are, AUTOINCREMENT never hands out a removed one again
+            for trigger in ("users_inserted", "users_updated", "users_deleted"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+            cursor.execute("""
+                DELETE FROM user_changes
+                WHERE revision NOT IN (SELECT MAX(revision) FROM user_changes GROUP BY user_id)
+            """)
+            self.create_change_log(cursor)
+            vacuum = True
+
+        if version < SCHEMA_VERSION and tables:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.commit()
+            if vacuum:
+                conn.execute("VACUUM")
+            migrated = True
+
+        self.schema_checked = True
+        return migrated
 
     def hash_password(self, password):
         """Hashes a password using bcrypt."""
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
-        return hashed_password.decode('utf-8')
+        return hash_password(password)
 
     def verify_password(self, stored_password, provided_password):
         """Verifies the provided password against the stored hash."""
@@ -90,53 +451,47 @@ class DatabaseManager:
 
     def user_exists(self, name):
         """Checks if a user with the specified name exists in the database."""
-        self.decrypt_file()
-        conn = self.connect()
-        cursor = conn.cursor()
-        cursor.execute("SELECT password, feature_vector FROM users WHERE name = ?", (name,))
-        result = cursor.fetchone()
-        conn.close()
-        self.encrypt_file()
+        with self.reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT password, feature_vector FROM users WHERE name = ?", (name,))
+            result = cursor.fetchone()
+        if result:
+            result = (result[0], unpack_feature_vector(result[1]))
         return result
 
-    def register_user(self, name, password, feature_vector, overwrite=False):
+    def register_user(self, name, password, feature_vector, overwrite=False, add_template=False):
         """Registers a new user or updates an existing one.
 
         Args:
             name (str): The user's name.
             password (str): The user's password.
-            feature_vector (list/str): The user's facial feature vector.
-            overwrite (bool): If True, updates the existing user's record.
+            feature_vector (list/array/str): The user's facial feature vector, or a
+                (templates, dimension) matrix of several captures.
+            overwrite (bool): If True, replaces the existing user's password and templates.
+            add_template (bool): If True, adds the captures to the existing user's templates.
 
         Returns:
-            bool: True if registration was successful, False otherwise.
+            bool: True if registration was successful, False otherwise, also when overwrite or
+                add_template name a user that does not exist.
         """
-        if isinstance(feature_vector, list):
-            feature_vector = ','.join(map(str, feature_vector))
-
+        templates = as_template_matrix(feature_vector)
         hashed_password = self.hash_password(password)
 
         try:
-            self.decrypt_file()
-
-            conn = self.connect()
-            cursor = conn.cursor()
+            with self.writing() as conn:
+                cursor = conn.cursor()
 
-            if overwrite:
-                cursor.execute("""
-                    UPDATE users SET password = ?, feature_vector = ?
-                    WHERE name = ?
-                """, (hashed_password, feature_vector, name))
-            else:
-                cursor.execute("""
-                    INSERT INTO users (name, password, feature_vector)
-                    VALUES (?, ?, ?)
-                """, (name, hashed_password, feature_vector))
-
-            conn.commit()
-            conn.close()
+                if overwrite or add_template:
+                    row = cursor.execute("SELECT id FROM users WHERE name = ?", (name,)).fetchone()
+                    if row is None:
+                        print(f"Error: No user named {name} to update.")
+                        return False
+                    if overwrite:
+                        cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, row[0]))
+                    self.store_templates(cursor, row[0], templates, replace=overwrite)
+                else:
+                    self.insert_user(cursor, name, hashed_password, templates)
 
-            self.encrypt_file()
             return True
 
         except sqlite3.Error as e:
@@ -147,13 +502,202 @@ class DatabaseManager:
             print(f"Error: {e}")
             return False
 
+    def register_users(self, users, overwrite=False):
+        """Registers many users in a single transaction.
+
+        A name appearing several times in one call enrolls each feature vector as another
+        template of that user.
+
+        Args:
+            users (iterable): (name, hashed_password, feature_vector) tuples, passwords
+                already hashed with hash_password().
+            overwrite (bool): If True, existing users with the same name are updated,
+                otherwise they are skipped.
+
+        Returns:
+            dict: Number of "inserted", "updated" and "skipped" users.
+        """
+        counts = {"inserted": 0, "updated": 0, "skipped": 0}
+        with self.writing() as conn:
+            cursor = conn.cursor()
+            existing = {row[1]: row[0] for row in cursor.execute("SELECT id, name FROM users")}
+            written = {}
+
+            for name, hashed_password, feature_vector in users:
+                templates = as_template_matrix(feature_vector)
+                if name in written:
+                    self.store_templates(cursor, written[name], templates)
+                elif name in existing:
+                    if not overwrite:
+                        counts["skipped"] += 1
+                        continue
+                    cursor.execute("UPDATE users SET password = ? WHERE id = ?", (hashed_password, existing[name]))
+                    self.store_templates(cursor, existing[name], templates, replace=True)
+                    written[name] = existing[name]
+                    counts["updated"] += 1
+                else:
+                    written[name] = self.insert_user(cursor, name, hashed_password, templates)
+                    counts["inserted"] += 1
+
+        return counts
+
+    def insert_user(self, cursor, name, hashed_password, templates):
+        """Inserts a user with their templates and returns the new user id."""
+        centroid, spread = self.summarize_templates(templates)
+        feature_blob, feature_dim = pack_feature_vector(centroid)
+        cursor.execute("""
+            INSERT INTO users (name, password, feature_vector, feature_dim, feature_version, spread)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (name, hashed_password, feature_blob, feature_dim, FEATURE_VECTOR_VERSION, spread))
+        user_id = cursor.lastrowid
+        self.insert_templates(cursor, user_id, templates)
+        return user_id
+
+    def insert_templates(self, cursor, user_id, templates):
+        cursor.executemany("""
+            INSERT INTO user_templates (user_id, feature_vector, feature_dim, feature_version)
+            VALUES (?, ?, ?, ?)
+        """, [(user_id, *pack_feature_vector(template), FEATURE_VECTOR_VERSION) for template in templates])
+
+    def store_templates(self, cursor, user_id, templates, replace=False):
+        """Adds templates to a user, keeping the newest MAX_TEMPLATES, and updates the centroid and spread.
+
+        Args:
+            cursor (sqlite3.Cursor): Cursor of the open write transaction.
+            user_id (int): The user to update.
+            templates (array): (templates, dimension) matrix of new feature vectors.
+            replace (bool): If True, the user's previous templates are deleted first.
+        """
+        if replace:
+            cursor.execute("DELETE FROM user_templates WHERE user_id = ?", (user_id,))
+        self.insert_templates(cursor, user_id, templates)
+        cursor.execute("""
+            DELETE FROM user_templates WHERE user_id = ? AND id NOT IN (
+                SELECT id FROM user_templates WHERE user_id = ? ORDER BY id DESC LIMIT ?
+            )
+        """, (user_id, user_id, MAX_TEMPLATES))
+
+        blobs = [row[0] for row in cursor.execute(
+            "SELECT feature_vector FROM user_templates WHERE user_id = ? ORDER BY id", (user_id,))]
+        stored = np.frombuffer(b"".join(blobs), dtype=FEATURE_VECTOR_DTYPE).reshape(len(blobs), -1)
+        centroid, spread = self.summarize_templates(stored)
+        feature_blob, feature_dim = pack_feature_vector(centroid)
+        cursor.execute("""
+            UPDATE users SET feature_vector = ?, feature_dim = ?, feature_version = ?, spread = ?
+            WHERE id = ?
+        """, (feature_blob, feature_dim, FEATURE_VECTOR_VERSION, spread, user_id))
+
+    @staticmethod
+    def summarize_templates(templates):
+        """Returns the centroid of a (templates, dimension) matrix and the largest template distance from it."""
+        centroid = templates.astype(np.float64).mean(axis=0).astype(FEATURE_VECTOR_DTYPE)
+        spread = float(np.sqrt(((templates - centroid) ** 2).sum(axis=1)).max())
+        return centroid, spread
+
     def get_all_users(self):
-        """Retrieves all users from the database."""
-        self.decrypt_file()
-        conn = self.connect()
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, feature_vector FROM users")
-        users = cursor.fetchall()
-        conn.close()
-        self.encrypt_file()
-        return users
+        """Retrieves all users from the database, with feature vectors as float32 arrays."""
+        with self.reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, feature_vector FROM users")
+            rows = cursor.fetchall()
+        return [(user_id, name, unpack_feature_vector(blob)) for user_id, name, blob in rows]
+
+    def get_templates(self, user_ids=None):
+        """Retrieves the templates of all users, or of the given users, ordered by user id.
+
+        Returns:
+            tuple: (user ids, one per template) and a (templates, dimension) float32 matrix.
+        """
+        query = "SELECT user_id, feature_vector FROM user_templates"
+        parameters = ()
+        if user_ids is not None:
+            query += f" WHERE user_id IN ({','.join('?' * len(user_ids))})"
+            parameters = tuple(user_ids)
+        with self.reading() as conn:
+            rows = conn.execute(query + " ORDER BY user_id, id", parameters).fetchall()
+        return self._template_matrix(rows)
+
+    @staticmethod
+    def _template_matrix(rows):
+        owners = np.array([row[0] for row in rows], dtype=np.int64)
+        matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=FEATURE_VECTOR_DTYPE)
+        return owners, matrix.reshape(len(rows), -1) if rows else matrix.reshape(0, 0)
+
+    def get_spreads(self):
+        """Retrieves the template spread of every user, ordered by user id like get_feature_matrix()."""
+        with self.reading() as conn:
+            return np.array([row[0] for row in conn.execute("SELECT spread FROM users ORDER BY id")], dtype=np.float32)
+
+    def get_feature_matrix(self):
+        """Retrieves all users as id and name lists plus one (users, dimension) float32 matrix.
+
+        The BLOBs are concatenated and viewed with a single np.frombuffer call, so no
+        per-element parsing or copying takes place.
+        """
+        with self.reading() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, name, feature_vector, feature_dim FROM users ORDER BY id")
+            rows = cursor.fetchall()
+
+        ids = [row[0] for row in rows]
+        names = [row[1] for row in rows]
+        dimensions = {row[3] for row in rows}
+        if len(dimensions) > 1:
+            raise ValueError("Stored feature vectors do not have the same size.")
+
+        dimension = dimensions.pop() if dimensions else 0
+        matrix = np.frombuffer(b"".join(row[2] for row in rows), dtype=FEATURE_VECTOR_DTYPE)
+        return ids, names, matrix.reshape(len(rows), dimension)
+
+    def get_revision(self):
+        """Returns the revision of the latest change to the users table, 0 if nothing was logged."""
+        with self.reading() as conn:
+            return conn.execute("SELECT COALESCE(MAX(revision), 0) FROM user_changes").fetchone()[0]
+
+    def get_changes(self, since_revision):
+        """Retrieves the users added, modified or deleted after a revision.
+
+        Args:
+            since_revision (int): The last revision the caller has seen.
+
+        Returns:
+            dict: The new "revision", the current "ids", "names", (users, dimension)
+                "vectors" and "spreads" of added or modified users, their "templates" as
+                (template owners, matrix), and the "deleted" user ids.
+        """
+        with self.reading() as conn:
+            cursor = conn.cursor()
+            revision = cursor.execute("SELECT COALESCE(MAX(revision), 0) FROM user_changes").fetchone()[0]
+            rows = []
+            template_rows = []
+            if revision > since_revision:
+                cursor.execute("""
+                    SELECT changed.user_id, users.name, users.feature_vector, users.feature_dim, users.spread
+                    FROM (SELECT DISTINCT user_id FROM user_changes WHERE revision > ? AND revision <= ?) AS changed
+                    LEFT JOIN users ON users.id = changed.user_id
+                    ORDER BY changed.user_id
+                """, (since_revision, revision))
+                rows = cursor.fetchall()
+                cursor.execute("""
+                    SELECT user_id, feature_vector FROM user_templates
+                    WHERE user_id IN (SELECT user_id FROM user_changes WHERE revision > ? AND revision <= ?)
+                    ORDER BY user_id, id
+                """, (since_revision, revision))
+                template_rows = cursor.fetchall()
+
+        current = [row for row in rows if row[1] is not None]
+        dimensions = {row[3] for row in current}
+        if len(dimensions) > 1:
+            raise ValueError("Stored feature vectors do not have the same size.")
+
+        dimension = dimensions.pop() if dimensions else 0
+        vectors = np.frombuffer(b"".join(row[2] for row in current), dtype=FEATURE_VECTOR_DTYPE)
+        return {
+            "revision": revision,
+            "ids": [row[0] for row in current],
+            "names": [row[1] for row in current],
+            "vectors": vectors.reshape(len(current), dimension),
+            "spreads": np.array([row[4] for row in current], dtype=np.float32),
+            "templates": self._template_matrix(template_rows),
+            "deleted": [row[0] for row in rows if row[1] is None],
+        }
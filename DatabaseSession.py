@@ -0,0 +1,188 @@
+import itertools
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from Metrics import Metrics
+
+
+class DatabaseSession:
+    """Keeps a decrypted copy of the database in memory and serves queries from pooled connections.
+
+    The encrypted file is decrypted once when the session opens. Every query then runs against a
+    shared in-memory SQLite database, and the file is re-encrypted only after a batch of commits,
+    on flush() or when the session is closed.
+
+    Other processes may write the same file, with their own session or per-call. Before a query
+    the session compares the file with the version it loaded or wrote last and loads it again when
+    it changed. Writes hold the file lock from that check until the file is written back, so a
+    commit never overwrites changes made by another process. Commits that are not written yet
+    (flush_every > 1) cannot be merged with such changes: the session raises instead of losing either.
+    """
+
+    _counter = itertools.count()
+
+    def __init__(self, manager, pool_size=4, flush_every=1):
+        self.manager = manager
+        self.db_name = manager.db_name
+        self.pool_size = pool_size
+        self.flush_every = flush_every
+        self.pending_commits = 0
+        self.closed = False
+        self.file_state = None
+
+        self.uri = f"file:face_recognition_session_{os.getpid()}_{next(self._counter)}?mode=memory&cache=shared"
+        self.condition = threading.Condition()
+        self.active_readers = 0
+        self.writer_active = False
+
+        self.anchor = self._connect()
+        self._load()
+        self.pool = queue.LifoQueue()
+        for _ in range(pool_size):
+            self.pool.put(self._connect())
+
+    def _connect(self):
+        return sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+
+    def _load(self):
+        """Decrypts the database file straight into the shared in-memory database."""
+        with self.manager.file_lock():
+            data = self._read_file()
+            self.manager.create_schema(self.anchor)
+            migrated = self.manager.migrate_db(self.anchor)
+            if not data or migrated:
+                self.flush()
+
+    def _read_file(self):
+        """Replaces the in-memory database by the file contents, the file lock must be held."""
+        data = self.manager.read_database_bytes()
+        if data:
+            seed = self._deserialize(data)
+            try:
+                seed.backup(self.anchor)
+            finally:
+                seed.close()
+        self.file_state = self.manager.file_state()
+        return data
+
+    def _reload_if_changed(self):
+        """Loads the file again when another process wrote it, the file lock and exclusive access must be held."""
+        if self.manager.file_state() == self.file_state:
+            return
+        if self.pending_commits:
+            raise ValueError(f"{self.db_name} was changed by another process, {self.pending_commits} commits "
+                             "of this session were not written to it.")
+        with Metrics.span("db_session_reload"):
+            self._read_file()
+        Metrics.increment("db_session_reloads")
+
+    def refresh(self):
+        """Loads the file again if another process wrote it since this session loaded or wrote it."""
+        if self.manager.file_state() == self.file_state:
+            return
+        with self.manager.file_lock(), self._exclusive():
+            self._reload_if_changed()
+
+    @staticmethod
+    def _deserialize(data):
+        conn = sqlite3.connect(":memory:")
+        if hasattr(conn, "deserialize"):
+            conn.deserialize(data)
+            return conn
+
+        conn.close()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session.db")
+            with open(path, "wb") as file:
+                file.write(data)
+            source = sqlite3.connect(path)
+            conn = sqlite3.connect(":memory:")
+            source.backup(conn)
+            source.close()
+        return conn
+
+    def _serialize(self):
+        if hasattr(self.anchor, "serialize"):
+            return self.anchor.serialize()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "session.db")
+            target = sqlite3.connect(path)
+            self.anchor.backup(target)
+            target.close()
+            with open(path, "rb") as file:
+                return file.read()
+
+    @contextmanager
+    def reading(self):
+        """Yields a pooled connection for queries; several readers may run at once."""
+        self.refresh()
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writer_active)
+            self.active_readers += 1
+        conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+            with self.condition:
+                self.active_readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def writing(self):
+        """Yields a pooled connection with exclusive access, committing when the block succeeds."""
+        with self.manager.file_lock(), self._exclusive():
+            self._reload_if_changed()
+            conn = self.pool.get()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.put(conn)
+
+            self.pending_commits += 1
+            if self.pending_commits >= self.flush_every:
+                self._flush()
+
+    @contextmanager
+    def _exclusive(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.writer_active and self.active_readers == 0)
+            self.writer_active = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer_active = False
+                self.condition.notify_all()
+
+    def flush(self):
+        """Encrypts the current in-memory database and writes it back to disk."""
+        with self.manager.file_lock(), self._exclusive():
+            self._reload_if_changed()
+            self._flush()
+
+    def _flush(self):
+        with Metrics.span("db_session_flush"):
+            self.manager.write_database_bytes(self._serialize())
+        self.file_state = self.manager.file_state()
+        self.pending_commits = 0
+
+    def close(self):
+        """Writes outstanding commits to disk and closes all connections."""
+        if self.closed:
+            return
+
+        if self.pending_commits:
+            self.flush()
+        self.closed = True
+        while not self.pool.empty():
+            self.pool.get().close()
+        self.anchor.close()
@@ -0,0 +1,242 @@
+import base64
+import contextlib
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"FRCRYPT\x00"
+CONTAINER_VERSION = 2
+HEADER = struct.Struct("<8sHHIQ16s32s")
+FILE_ID = slice(HEADER.size - 48, HEADER.size - 32)
+NONCE_SIZE = 12
+TAG_SIZE = 16
+HEADER_SIZE = HEADER.size + NONCE_SIZE + TAG_SIZE
+CHUNK_OVERHEAD = NONCE_SIZE + TAG_SIZE
+
+
+class EncryptedContainer:
+    """Encrypts a file in fixed-size AES-GCM chunks that can be decrypted and rewritten one by one.
+
+    The header holds the plaintext length, the chunk size, a random file id and a SHA-256 digest
+    over the tags of all chunks, and is authenticated on its own. Every chunk is stored as nonce,
+    ciphertext and tag with the file id and the chunk number as associated data. Because the
+    header commits to every tag, a chunk taken from another file or from an earlier version of
+    this one fails verification, even though unchanged chunks keep their ciphertext across writes.
+    Records have a fixed size, so chunk i can be found without reading the chunks before it, and
+    the file is read through mmap without an intermediate copy of the ciphertext.
+
+    For every file it read or wrote last, the class keeps one SHA-256 digest per plaintext chunk.
+    write() copies the ciphertext of chunks whose digest did not change instead of encrypting
+    them again. The new file is always written next to the old one and renamed over it.
+    """
+
+    previous = {}
+    previous_lock = threading.Lock()
+
+    def __init__(self, key, chunk_size=64 * 1024):
+        """
+        Args:
+            key (bytes): The base64 Fernet key of the database, the AES key is derived from it.
+            chunk_size (int): Plaintext bytes per chunk.
+        """
+        aes_key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                       info=b"face_recognition database container").derive(base64.urlsafe_b64decode(key))
+        self.aead = AESGCM(aes_key)
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def is_container(prefix):
+        """Checks whether data starting with these bytes is an encrypted container."""
+        return prefix.startswith(MAGIC)
+
+    @classmethod
+    def forget(cls, path):
+        """Drops the chunk digests kept for unchanged-chunk detection, e.g. when a session closes."""
+        with cls.previous_lock:
+            cls.previous.pop(os.path.abspath(path), None)
+
+    def read(self, path, remember=True):
+        """Decrypts a whole container into memory.
+
+        Args:
+            path (str): The container file.
+            remember (bool): Keep the chunk digests so the next write() can skip unchanged chunks.
+
+        Returns:
+            bytes: The plaintext.
+        """
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                chunk_size, length, file_id, tags_digest = self._read_header(mapped)
+                chunks = list(self._decrypt_chunks(mapped, chunk_size, length, file_id, tags_digest))
+        plaintext = b"".join(chunks)
+
+        if remember:
+            digests = [hashlib.sha256(chunk).digest() for chunk in chunks]
+            self._remember(path, stat, file_id, chunk_size, digests)
+        return plaintext
+
+    def write(self, path, data):
+        """Encrypts data into a container at path, replacing the file atomically.
+
+        Chunks whose digest equals the one of the same chunk when path was last read or written
+        are copied from the existing file as ciphertext, the others are encrypted with fresh nonces.
+
+        Returns:
+            int: Number of chunks that had to be encrypted.
+        """
+        data = memoryview(data).cast("B")
+        with self.previous_lock:
+            previous = self.previous.get(os.path.abspath(path))
+
+        old_file = None
+        if previous is not None and previous["chunk_size"] == self.chunk_size:
+            try:
+                old_file = open(path, "rb")
+            except FileNotFoundError:
+                pass
+        try:
+            stat = os.fstat(old_file.fileno()) if old_file is not None else None
+            mapped = None
+            if stat is not None and (stat.st_ino, stat.st_size, stat.st_mtime_ns) == previous["stat"]:
+                mapped = mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ)
+                if mapped[FILE_ID] != previous["file_id"]:
+                    mapped.close()
+                    mapped = None
+            if mapped is not None:
+                file_id = previous["file_id"]
+                with mapped:
+                    encrypted, digests = self._write_chunks(path, file_id, len(data), self._slices(data),
+                                                            previous["digests"], mapped)
+            else:
+                # Unknown or modified since we last saw it: encrypt everything under a new file id
+                file_id = os.urandom(16)
+                encrypted, digests = self._write_chunks(path, file_id, len(data), self._slices(data))
+        finally:
+            if old_file is not None:
+                old_file.close()
+
+        self._remember(path, os.stat(path), file_id, self.chunk_size, digests)
+        return encrypted
+
+    def encrypt_file(self, path):
+        """Replaces a plaintext file by its container, reading it one chunk at a time."""
+        length = os.path.getsize(path)
+        with open(path, "rb") as source:
+            chunks = iter(lambda: source.read(self.chunk_size), b"")
+            self._write_chunks(path, os.urandom(16), length, chunks)
+        self.forget(path)
+
+    def decrypt_file(self, path):
+        """Replaces a container by its plaintext file, decrypting one chunk at a time.
+
+        The plaintext only replaces the container once every chunk and the tag digest were verified.
+        """
+        temp_path = f"{path}.tmp"
+        try:
+            with open(path, "rb") as file, open(temp_path, "wb") as target:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    chunk_size, length, file_id, tags_digest = self._read_header(mapped)
+                    for chunk in self._decrypt_chunks(mapped, chunk_size, length, file_id, tags_digest):
+                        target.write(chunk)
+                target.flush()
+                os.fsync(target.fileno())
+        except BaseException:
+            # The temp file may not exist, e.g. when the container could not be opened
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, path)
+        self.forget(path)
+
+    def _slices(self, data):
+        for start in range(0, len(data), self.chunk_size):
+            yield data[start:start + self.chunk_size]
+
+    def _write_chunks(self, path, file_id, length, chunks, old_digests=None, old_mapped=None):
+        """Writes chunks and header to a temp file and renames it over path.
+
+        Returns:
+            tuple: Number of chunks encrypted and the digest of every plaintext chunk.
+        """
+        encrypted = 0
+        digests = []
+        tags = hashlib.sha256()
+
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as target:
+            # The header commits to all chunk tags, so it is written once they are known
+            target.seek(HEADER_SIZE)
+            for index, chunk in enumerate(chunks):
+                digest = hashlib.sha256(chunk).digest()
+                digests.append(digest)
+                if old_digests is not None and index < len(old_digests) and old_digests[index] == digest:
+                    offset = HEADER_SIZE + index * (self.chunk_size + CHUNK_OVERHEAD)
+                    record = old_mapped[offset:offset + len(chunk) + CHUNK_OVERHEAD]
+                else:
+                    nonce = os.urandom(NONCE_SIZE)
+                    record = nonce + self.aead.encrypt(nonce, bytes(chunk), file_id + struct.pack("<Q", index))
+                    encrypted += 1
+                tags.update(record[-TAG_SIZE:])
+                target.write(record)
+
+            fields = HEADER.pack(MAGIC, CONTAINER_VERSION, 0, self.chunk_size, length, file_id, tags.digest())
+            nonce = os.urandom(NONCE_SIZE)
+            target.seek(0)
+            target.write(fields + nonce + self.aead.encrypt(nonce, b"", fields))
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_path, path)
+        return encrypted, digests
+
+    def _read_header(self, mapped):
+        if len(mapped) < HEADER_SIZE:
+            raise ValueError("Encrypted database header is truncated.")
+        fields = mapped[:HEADER.size]
+        magic, version, _, chunk_size, length, file_id, tags_digest = HEADER.unpack(fields)
+        if magic != MAGIC or version != CONTAINER_VERSION:
+            raise ValueError("Unsupported encrypted database format.")
+        nonce = mapped[HEADER.size:HEADER.size + NONCE_SIZE]
+        try:
+            self.aead.decrypt(nonce, mapped[HEADER.size + NONCE_SIZE:HEADER_SIZE], fields)
+        except InvalidTag:
+            raise ValueError("Encrypted database header failed authentication, wrong key or corrupted file.")
+
+        chunks = (length + chunk_size - 1) // chunk_size
+        if len(mapped) < HEADER_SIZE + length + chunks * CHUNK_OVERHEAD:
+            raise ValueError("Encrypted database is truncated.")
+        return chunk_size, length, file_id, tags_digest
+
+    def _decrypt_chunks(self, mapped, chunk_size, length, file_id, tags_digest):
+        """Yields the plaintext chunks and checks the tag digest of the header after the last one."""
+        tags = hashlib.sha256()
+        for index, start in enumerate(range(0, length, chunk_size)):
+            size = min(chunk_size, length - start)
+            offset = HEADER_SIZE + index * (chunk_size + CHUNK_OVERHEAD)
+            nonce = mapped[offset:offset + NONCE_SIZE]
+            record = mapped[offset + NONCE_SIZE:offset + CHUNK_OVERHEAD + size]
+            try:
+                chunk = self.aead.decrypt(nonce, record, file_id + struct.pack("<Q", index))
+            except InvalidTag:
+                raise ValueError(f"Encrypted database chunk {index} failed authentication, the file is corrupted.")
+            tags.update(record[-TAG_SIZE:])
+            yield chunk
+
+        if tags.digest() != tags_digest:
+            raise ValueError("Encrypted database chunks do not belong to this version of the file.")
+
+    def _remember(self, path, stat, file_id, chunk_size, digests):
+        with self.previous_lock:
+            self.previous[os.path.abspath(path)] = {
+                "stat": (stat.st_ino, stat.st_size, stat.st_mtime_ns),
+                "file_id": file_id,
+                "chunk_size": chunk_size,
+                "digests": digests,
+            }
@@ -3,4 +3,12 @@ class NoFaceDetectedException(Exception):
 
 
 class MultipleFacesDetectedException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class LowQualityFrameException(Exception):
+    '''Raised for frames not worth matching, reason is e.g. "blurred", "too_dark" or "turned_head"'''
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
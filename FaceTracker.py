@@ -0,0 +1,95 @@
+import dlib
+import numpy as np
+from Metrics import Metrics
+
+
+class FaceTracker:
+    '''Follows one face across consecutive frames so the HOG detector does not run on every frame.
+
+    After a detection the face box is followed with a dlib.correlation_tracker. Every
+    detect_every frames, or when the tracking quality drops below min_quality, the detector
+    runs again but only within the last box grown by roi_margin on each side. The whole frame
+    is searched when there is no box yet, when the region holds no single face, and every
+    full_detect_every frames so that a second person stepping into view is noticed.
+    One tracker belongs to one stream of frames; create one per camera consumer.
+    '''
+
+    def __init__(self, detector, detect_every=5, full_detect_every=30, min_quality=7.0, roi_margin=0.5):
+        self.detector = detector
+        self.detect_every = detect_every
+        self.full_detect_every = full_detect_every
+        self.min_quality = min_quality
+        self.roi_margin = roi_margin
+        self.reset()
+
+    def reset(self):
+        '''Drop the current track, the next frame is searched completely'''
+        self.tracker = None
+        self.box = None
+        self.frames_since_detection = 0
+        self.frames_since_full_detection = 0
+
+    def update(self, gray):
+        '''
+            Finds the faces in the next frame of the stream.
+            :param gray: preprocessed grayscale frame
+            :return: list of dlib rectangles, a single tracked box while the track holds
+        '''
+        self.frames_since_detection += 1
+        self.frames_since_full_detection += 1
+
+        if self.tracker is not None and self.frames_since_detection < self.detect_every:
+            with Metrics.span("track"):
+                quality = self.tracker.update(gray)
+            if quality >= self.min_quality:
+                Metrics.increment("tracked_frames")
+                self.box = self.clip(self.tracker.get_position(), gray.shape)
+                return [self.box]
+            Metrics.increment("track_losses")
+
+        faces = None
+        if self.box is not None and self.frames_since_full_detection < self.full_detect_every:
+            faces = self.detect_region(gray)
+        if faces is None:
+            faces = self.detect_full(gray)
+
+        self.frames_since_detection = 0
+        if len(faces) == 1:
+            self.box = faces[0]
+            self.tracker = dlib.correlation_tracker()
+            self.tracker.start_track(gray, self.box)
+        else:
+            self.tracker = None
+            self.box = None
+        return list(faces)
+
+    def detect_full(self, gray):
+        Metrics.increment("full_detections")
+        self.frames_since_full_detection = 0
+        with Metrics.span("detect"):
+            return list(self.detector(gray))
+
+    def detect_region(self, gray):
+        '''Runs the detector around the last box, returns None unless exactly one face is found there'''
+        Metrics.increment("roi_detections")
+        height, width = gray.shape[:2]
+        margin_x = int(self.box.width() * self.roi_margin)
+        margin_y = int(self.box.height() * self.roi_margin)
+        left, top = max(self.box.left() - margin_x, 0), max(self.box.top() - margin_y, 0)
+        right, bottom = min(self.box.right() + margin_x, width), min(self.box.bottom() + margin_y, height)
+
+        with Metrics.span("detect"):
+            faces = self.detector(np.ascontiguousarray(gray[top:bottom, left:right]))
+        if len(faces) != 1:
+            return None
+        face = faces[0]
+        return [dlib.rectangle(face.left() + left, face.top() + top, face.right() + left, face.bottom() + top)]
+
+    @staticmethod
+    def clip(position, shape):
+        '''Converts a tracker position into an integer rectangle inside the frame'''
+        height, width = shape[:2]
+        return dlib.rectangle(
+            int(max(position.left(), 0)), int(max(position.top(), 0)),
+            int(min(position.right(), width - 1)), int(min(position.bottom(), height - 1)),
+        )
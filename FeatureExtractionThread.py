@@ -4,7 +4,7 @@ from DatabaseManager import DatabaseManager
 class FeatureExtractionThread(QThread):
     extraction_complete = pyqtSignal(str)
 
-    def __init__(self, name, password, captured_frame, user_identification, overwrite):
+    def __init__(self, name, password, captured_frame, user_identification, overwrite, add_template=False):
         super().__init__()
         self.name = name
         self.password = password
@@ -12,6 +12,7 @@ class FeatureExtractionThread(QThread):
         self.user_identification = user_identification
         self.db_manager = DatabaseManager()
         self.overwrite = overwrite
+        self.add_template = add_template
 
     def run(self):
         '''Extract feature vector and save to database'''
@@ -21,8 +22,8 @@ class FeatureExtractionThread(QThread):
                 self.extraction_complete.emit("Error: Unable to detect face or extract features.")
                 return
 
-            feature_vector_str = ",".join(map(str, feature_vector))
-            result = self.db_manager.register_user(self.name, self.password, feature_vector_str, self.overwrite)
+            result = self.db_manager.register_user(self.name, self.password, feature_vector, self.overwrite,
+                                                   self.add_template)
 
             if result:
                 self.extraction_complete.emit(f"User {self.name} registered successfully!")
@@ -0,0 +1,231 @@
+import io
+import os
+import threading
+import numpy as np
+from Metrics import Metrics
+
+PROJECTION_VERSION = 2
+
+
+def projection_path(db_name):
+    '''Returns the path of the feature projection stored next to the database file.'''
+    return f"{os.path.splitext(db_name)[0]}.projection"
+
+
+class FeatureProjection:
+    '''Standardizes landmark feature vectors per dimension and projects them onto their main PCA axes.
+
+    The raw features mix normalized distances with angles in degrees, so a few dimensions dominate
+    the Euclidean distance, and many of them are strongly correlated. After the standardization
+    every feature counts on the same scale, and the search runs on the `dimension` axes of largest
+    variance instead of on all features. fit() also calibrates a match threshold in the projected
+    space so that only false_accept_rate of probes from people who are not enrolled match anyone.
+
+    The database keeps the raw vectors, so a projection can be refitted at any time; galleries
+    and indexes apply it when they load users, and search probes are projected at query time.
+    Every fit gets a new version, which is persisted with the projection next to the database.
+    '''
+
+    opened = {}
+    opened_lock = threading.Lock()
+
+    def __init__(self, mean, scale, components, version=1, threshold=None, explained_variance=None):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.scale = np.asarray(scale, dtype=np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        self.version = version
+        self.threshold = threshold
+        self.explained_variance = explained_variance
+
+        # Standardization and projection folded into one matrix product and one offset
+        self.weights = np.ascontiguousarray(self.components / self.scale[:, None])
+        self.offset = self.mean @ self.weights
+
+    @property
+    def dimension(self):
+        return self.components.shape[1]
+
+    @property
+    def source_dimension(self):
+        return self.components.shape[0]
+
+    @classmethod
+    def fit(cls, vectors, dimension=32, false_accept_rate=0.01, version=1, seed=0, groups=None):
+        '''
+            Learns the standardization and the principal axes from enrolled feature vectors.
+            :param vectors: (samples, features) matrix, e.g. all templates of the gallery
+            :param dimension: number of principal axes kept, must be below the number of features
+            :param false_accept_rate: share of unenrolled probes allowed to match someone, see calibrate()
+            :param version: version number stored with the projection
+            :param groups: user id of every sample, defaults to one user per sample
+            :return: fitted FeatureProjection
+        '''
+        vectors = np.asarray(vectors, dtype=np.float64)
+        if vectors.ndim != 2 or len(vectors) < 2:
+            raise ValueError("At least two enrolled feature vectors are needed to fit a projection.")
+        if not 0 < dimension < vectors.shape[1]:
+            raise ValueError(f"The projected dimension must be between 1 and {vectors.shape[1] - 1}.")
+        groups = np.arange(len(vectors)) if groups is None else np.asarray(groups)
+        if len(np.unique(groups)) < 2:
+            raise ValueError("At least two enrolled users are needed to calibrate the match threshold.")
+
+        mean, scale, components, explained_variance = cls.principal_axes(vectors, dimension)
+        projection = cls(mean, scale, components, version, explained_variance=explained_variance)
+        projection.threshold = cls.calibrate(vectors, groups, dimension, false_accept_rate, seed)
+        return projection
+
+    @staticmethod
+    def principal_axes(vectors, dimension):
+        '''Returns mean, scale, the `dimension` main axes of the standardized vectors and their share of the variance'''
+        mean = vectors.mean(axis=0)
+        scale = vectors.std(axis=0)
+        scale[scale < 1e-6] = 1.0
+        standardized = (vectors - mean) / scale
+
+        covariance = standardized.T @ standardized / (len(vectors) - 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:dimension]
+        explained_variance = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+        return mean, scale, eigenvectors[:, order], explained_variance
+
+    @classmethod
+    def calibrate(cls, vectors, groups, dimension, false_accept_rate=0.01, seed=0, folds=5, probes=5000):
+        '''
+            Returns the projected distance below which false_accept_rate of unenrolled probes match someone.
+            Identification compares a probe with every enrolled vector, so the rate applies to the distance
+            from a stranger to the nearest enrolled vector, not to a single pair. Strangers are simulated by
+            cross-validation: the users are split into folds, the axes are fitted without one fold, and the
+            samples of that fold are compared with all samples of the other users. Fitting without them keeps
+            the held-out users as far from the axes as real strangers are.
+            The threshold tightens as the gallery grows, so refit the projection along with it.
+            :param vectors: (samples, features) matrix
+            :param groups: user id of every sample
+            :param probes: number of held-out samples compared in total
+            :return: threshold in the space of a projection with `dimension` axes
+        '''
+        users, owners = np.unique(groups, return_inverse=True)
+        folds = min(folds, len(users))
+        rng = np.random.default_rng(seed)
+        fold_of_user = rng.permutation(len(users)) % folds
+
+        nearest = []
+        for fold in range(folds):
+            held = fold_of_user[owners] == fold
+            if (~held).sum() < 2:
+                continue
+            projection = cls(*cls.principal_axes(vectors[~held], dimension)[:3])
+            held_rows = np.flatnonzero(held)
+            held_rows = rng.choice(held_rows, min(len(held_rows), max(probes // folds, 1)), replace=False)
+            nearest.append(cls.nearest_distances(projection.transform(vectors[held_rows]),
+                                                 projection.transform(vectors[~held])))
+
+        # Every stranger was compared with (folds - 1) / folds of the gallery only
+        return float(np.quantile(np.concatenate(nearest), false_accept_rate * (folds - 1) / folds))
+
+    @staticmethod
+    def nearest_distances(probes, enrolled, block=256):
+        '''Returns the distance from every probe to its closest enrolled vector'''
+        norms = np.einsum('ij,ij->i', enrolled, enrolled)
+        nearest = np.empty(len(probes), dtype=np.float32)
+        for start in range(0, len(probes), block):
+            rows = probes[start:start + block]
+            squared = np.einsum('ij,ij->i', rows, rows)[:, None] + norms[None, :] - 2.0 * (rows @ enrolled.T)
+            nearest[start:start + block] = np.sqrt(np.maximum(squared.min(axis=1), 0.0))
+        return nearest
+
+    def transform(self, vectors):
+        '''
+            Projects raw feature vectors.
+            :param vectors: one vector or a (vectors, source_dimension) matrix
+            :return: float32 array with `dimension` values per vector
+        '''
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[-1] != self.source_dimension:
+            raise ValueError("Vectors are not the same size.")
+        return vectors @ self.weights - self.offset
+
+    def project_rows(self, ids, vectors, owners, templates):
+        '''
+            Projects gallery rows and recomputes the template spreads in the projected space.
+            :param ids: user ids of the centroid rows
+            :param vectors: (users, source_dimension) centroids
+            :param owners: user id of every template
+            :param templates: (templates, source_dimension) matrix or None
+            :return: (projected centroids, spreads, (owners, projected templates))
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        owners = np.asarray(owners, dtype=np.int64)
+        projected = self.transform(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        spreads = np.zeros(len(ids), dtype=np.float32)
+        if templates is None or len(owners) == 0:
+            return projected, spreads, (owners[:0], np.empty((0, self.dimension), dtype=np.float32))
+
+        projected_templates = self.transform(np.asarray(templates).reshape(len(owners), -1))
+        order = np.argsort(ids, kind='stable')
+        rows = order[np.minimum(np.searchsorted(ids[order], owners), max(len(ids) - 1, 0))]
+        known = ids[rows] == owners
+        difference = projected_templates[known] - projected[rows[known]]
+        np.maximum.at(spreads, rows[known], np.sqrt(np.einsum('ij,ij->i', difference, difference)))
+        return projected, spreads, (owners, projected_templates)
+
+    @classmethod
+    def open(cls, db_manager):
+        '''
+            Returns the projection persisted next to a database, or None when there is none.
+            The file is read again only when it changed on disk.
+        '''
+        path = projection_path(db_manager.db_name)
+        key = os.path.abspath(path)
+        try:
+            modified = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+        with cls.opened_lock:
+            cached = cls.opened.get(key)
+            if cached is not None and cached[0] == modified:
+                return cached[1]
+            projection = None
+            with Metrics.span("projection_load"):
+                try:
+                    projection = cls.load(path, db_manager.cipher_suite)
+                except Exception as e:
+                    print(f"Error: {e}")
+            cls.opened[key] = (modified, projection)
+            return projection
+
+    @classmethod
+    def load(cls, path, cipher_suite):
+        '''
+            Reads a saved projection.
+            Returns None when it was written by an incompatible version or has no calibrated threshold,
+            searches then stay on the raw feature vectors.
+        '''
+        data = cls.read_arrays(path, cipher_suite)
+        threshold = float(data["threshold"])
+        if int(data["format"]) != PROJECTION_VERSION or np.isnan(threshold):
+            return None
+        return cls(data["mean"], data["scale"], data["components"], int(data["version"]),
+                   threshold, float(data["explained_variance"]))
+
+    @classmethod
+    def stored_version(cls, path, cipher_suite):
+        '''Returns the version of a saved projection, also for ones load() ignores'''
+        return int(cls.read_arrays(path, cipher_suite)["version"])
+
+    @staticmethod
+    def read_arrays(path, cipher_suite):
+        with open(path, "rb") as file:
+            return np.load(io.BytesIO(cipher_suite.decrypt(file.read())))
+
+    def save(self, path, cipher_suite):
+        '''Writes the projection encrypted like the database'''
+        buffer = io.BytesIO()
+        np.savez(buffer, format=PROJECTION_VERSION, version=self.version, mean=self.mean, scale=self.scale,
+                 components=self.components,
+                 threshold=np.nan if self.threshold is None else self.threshold,
+                 explained_variance=np.nan if self.explained_variance is None else self.explained_variance)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(cipher_suite.encrypt(buffer.getvalue()))
+        os.replace(temp_path, path)
@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+from FaceExceptions import LowQualityFrameException
+from Metrics import Metrics
+
+NOSE_TIP = 30
+JAW_LEFT, JAW_RIGHT = 0, 16
+EYE_LEFT, EYE_RIGHT = 36, 45
+
+
+class FrameQualityGate:
+    '''Rejects frames that would give useless feature vectors before the expensive models run.
+
+    check_frame() measures sharpness as the variance of the Laplacian and exposure as the mean
+    brightness and the share of clipped pixels, on a copy downscaled to sample_width so a frame
+    costs a fraction of a millisecond. check_pose() estimates head yaw from the asymmetry of the
+    nose tip between the jaw ends and roll from the eye line, once landmarks are known.
+    score() turns the measurements into a single number for ranking frames.
+    '''
+
+    def __init__(self, min_sharpness=60.0, min_brightness=50.0, max_brightness=210.0, max_clipped=0.3,
+                 max_yaw=0.35, max_roll=20.0, sample_width=320):
+        self.min_sharpness = min_sharpness
+        self.min_brightness = min_brightness
+        self.max_brightness = max_brightness
+        self.max_clipped = max_clipped
+        self.max_yaw = max_yaw
+        self.max_roll = max_roll
+        self.sample_width = sample_width
+
+    def measure_frame(self, gray):
+        '''
+            Measures sharpness and exposure of a grayscale frame.
+            :return: dict with sharpness (Laplacian variance), brightness (0-255) and clipped (0-1)
+        '''
+        height, width = gray.shape[:2]
+        if width > self.sample_width:
+            sample_height = max(int(height * self.sample_width / width), 1)
+            gray = cv2.resize(gray, (self.sample_width, sample_height), interpolation=cv2.INTER_AREA)
+
+        clipped = np.count_nonzero((gray < 8) | (gray > 247)) / gray.size
+        return {
+            "sharpness": float(cv2.Laplacian(gray, cv2.CV_32F).var()),
+            "brightness": float(gray.mean()),
+            "clipped": clipped,
+        }
+
+    def check_frame(self, gray):
+        '''Measures a grayscale frame and raises LowQualityFrameException when it is not worth detecting in'''
+        with Metrics.span("quality"):
+            measures = self.measure_frame(gray)
+
+        if measures["brightness"] < self.min_brightness:
+            self.reject("Frame is too dark.", "too_dark")
+        if measures["brightness"] > self.max_brightness:
+            self.reject("Frame is too bright.", "too_bright")
+        if measures["clipped"] > self.max_clipped:
+            self.reject("Frame is over- or underexposed.", "clipped")
+        if measures["sharpness"] < self.min_sharpness:
+            self.reject("Frame is blurred.", "blurred")
+        return measures
+
+    @staticmethod
+    def measure_pose(points):
+        '''
+            Estimates the head pose from 68-point landmarks.
+            :return: dict with yaw (-1 to 1, 0 is frontal) and roll in degrees
+        '''
+        points = np.asarray(points, dtype=np.float64)
+        left = np.linalg.norm(points[NOSE_TIP] - points[JAW_LEFT])
+        right = np.linalg.norm(points[JAW_RIGHT] - points[NOSE_TIP])
+        dx, dy = points[EYE_RIGHT] - points[EYE_LEFT]
+        return {
+            "yaw": float((right - left) / (right + left)) if right + left else 0.0,
+            "roll": float(np.degrees(np.arctan2(dy, dx))),
+        }
+
+    def check_pose(self, points):
+        '''Raises LowQualityFrameException when the head is turned or tilted too far'''
+        pose = self.measure_pose(points)
+        if abs(pose["yaw"]) > self.max_yaw:
+            self.reject("Head is turned too far, look into the camera.", "turned_head")
+        if abs(pose["roll"]) > self.max_roll:
+            self.reject("Head is tilted too far, hold it upright.", "tilted_head")
+        return pose
+
+    def score(self, measures, pose=None):
+        '''Ranks frames by their measurements between 0 and 1, higher is better'''
+        score = min(measures["sharpness"] / self.min_sharpness, 4.0) / 4.0
+        score *= 1.0 - measures["clipped"]
+        if pose is not None:
+            score *= 1.0 - min(abs(pose["yaw"]) / self.max_yaw, 1.0) * 0.5
+        return score
+
+    @staticmethod
+    def reject(message, reason):
+        Metrics.increment("low_quality_frames")
+        raise LowQualityFrameException(message, reason)
@@ -0,0 +1,109 @@
+import time
+from collections import deque
+import cv2
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap
+from Metrics import Metrics
+
+# Format_BGR888 exists since Qt 5.14, older versions need a BGR -> RGB conversion
+BGR_FORMAT = getattr(QImage, "Format_BGR888", None)
+
+
+class FrameRenderer:
+    '''Shows BGR camera frames in a QLabel with one resize and no per-frame allocations.
+
+    Each new frame is resized once, straight from the capture resolution to the label size,
+    into a preallocated buffer that a QImage wraps as BGR, so neither a colour-converted
+    copy nor a smooth pixmap rescale is needed. Frames whose sequence number was already
+    shown are skipped. Landmarks can be drawn into the resized buffer, so the camera frame
+    itself is never modified. statistics() reports the render rate and the CPU time per frame.
+    '''
+
+    def __init__(self, label, stats_window=60):
+        self.label = label
+        self.buffer = None
+        self.image = None
+        self.source_shape = None
+        self.label_size = None
+        self.last_sequence = None
+        self.rendered = 0
+        self.skipped = 0
+        self.render_times = deque(maxlen=stats_window)
+        self.cpu_seconds = deque(maxlen=stats_window)
+
+    def reset(self):
+        '''Forget the last shown frame so the next one is rendered even with the same sequence number'''
+        self.last_sequence = None
+
+    def render(self, frame, sequence=None, points=None):
+        '''
+            Shows a frame in the label.
+            :param frame: BGR frame, e.g. a ring buffer slot; it is only read during this call
+            :param sequence: frame sequence number, frames already shown are skipped
+            :param points: optional (N, 2) landmark coordinates in frame pixels to draw over the frame
+            :return: True when the label was updated
+        '''
+        if frame is None or (sequence is not None and sequence == self.last_sequence):
+            self.skipped += 1
+            Metrics.increment("render_skipped")
+            return False
+
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        with Metrics.span("render"):
+            image = self.to_image(frame)
+            if points is not None:
+                self.draw_points(points, frame.shape)
+            self.label.setPixmap(QPixmap.fromImage(image))
+
+        self.last_sequence = sequence
+        self.rendered += 1
+        self.render_times.append(start)
+        self.cpu_seconds.append(time.thread_time() - cpu_start)
+        Metrics.increment("frames_rendered")
+        return True
+
+    def to_image(self, frame):
+        '''Resizes the frame into the preallocated buffer and returns the QImage wrapping it'''
+        size = self.label.size()
+        label_size = (size.width(), size.height())
+        if frame.shape != self.source_shape or label_size != self.label_size:
+            self.allocate(frame.shape, label_size)
+
+        height, width = self.buffer.shape[:2]
+        if BGR_FORMAT is None:
+            resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=self.buffer)
+        elif (height, width) == frame.shape[:2]:
+            self.buffer[...] = frame
+        else:
+            cv2.resize(frame, (width, height), dst=self.buffer, interpolation=cv2.INTER_AREA)
+        return self.image
+
+    def draw_points(self, points, shape):
+        '''Draws frame coordinates into the resized buffer, green is the same in BGR and RGB'''
+        scale = self.buffer.shape[1] / shape[1]
+        for x, y in np.asarray(points) * scale:
+            cv2.circle(self.buffer, (int(x), int(y)), 2, (0, 255, 0), -1)
+
+    def allocate(self, shape, label_size):
+        '''Sizes the buffer to the largest frame that fits the label with the capture aspect ratio'''
+        frame_height, frame_width = shape[:2]
+        scale = min(label_size[0] / frame_width, label_size[1] / frame_height)
+        width = max(int(frame_width * scale), 1)
+        height = max(int(frame_height * scale), 1)
+
+        self.buffer = np.empty((height, width, 3), dtype=np.uint8)
+        image_format = BGR_FORMAT if BGR_FORMAT is not None else QImage.Format_RGB888
+        self.image = QImage(self.buffer.data, width, height, self.buffer.strides[0], image_format)
+        self.source_shape = shape
+        self.label_size = label_size
+
+    def statistics(self):
+        '''Render rate over the recent frames and the mean CPU time spent per rendered frame'''
+        fps = 0.0
+        if len(self.render_times) > 1:
+            elapsed = self.render_times[-1] - self.render_times[0]
+            fps = (len(self.render_times) - 1) / elapsed if elapsed > 0 else 0.0
+        cpu_ms = sum(self.cpu_seconds) / len(self.cpu_seconds) * 1000 if self.cpu_seconds else 0.0
+        return {"fps": fps, "cpu_ms_per_frame": cpu_ms, "rendered": self.rendered, "skipped": self.skipped}
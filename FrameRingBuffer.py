@@ -0,0 +1,72 @@
+import threading
+import time
+import numpy as np
+from Metrics import Metrics
+
+
+class FrameRingBuffer:
+    '''Small preallocated ring of frames written by one capture thread and read by many consumers.
+
+    Readers get a view of the newest slot without copying it. The writer always fills the
+    slot after the newest one, so a frame stays untouched until size - 1 newer frames have
+    been captured; consumers that keep a frame longer than that must copy it.
+    '''
+
+    def __init__(self, size=4):
+        if size < 2:
+            raise ValueError("The ring buffer needs at least two slots.")
+        self.size = size
+        self.slots = None
+        self.timestamps = np.zeros(size, dtype=np.float64)
+        self.sequences = np.zeros(size, dtype=np.int64)
+        self.sequence = 0
+        self.latest_index = -1
+        self.read_sequence = 0
+        self.condition = threading.Condition()
+
+    def allocate(self, shape, dtype=np.uint8):
+        '''Allocates all slots for frames of the given shape, dropping buffered frames.'''
+        with self.condition:
+            self.slots = np.zeros((self.size,) + tuple(shape), dtype=dtype)
+            self.latest_index = -1
+
+    def next_slot(self):
+        '''Returns the slot the writer should fill next.'''
+        return self.slots[(self.latest_index + 1) % self.size]
+
+    def publish(self, timestamp=None):
+        '''Marks the slot returned by next_slot() as the newest frame and wakes waiting readers.'''
+        with self.condition:
+            if self.read_sequence < self.sequence:
+                Metrics.increment("frames_dropped")
+            Metrics.increment("frames_captured")
+            index = (self.latest_index + 1) % self.size
+            self.sequence += 1
+            self.sequences[index] = self.sequence
+            self.timestamps[index] = time.monotonic() if timestamp is None else timestamp
+            self.latest_index = index
+            self.condition.notify_all()
+
+    def latest(self):
+        '''
+            Returns the newest frame without blocking.
+            :return: (frame, sequence number, timestamp) or (None, 0, 0.0) before the first frame
+        '''
+        with self.condition:
+            index = self.latest_index
+            if index < 0:
+                return None, 0, 0.0
+            self.read_sequence = max(self.read_sequence, int(self.sequences[index]))
+            return self.slots[index], int(self.sequences[index]), float(self.timestamps[index])
+
+    def wait_for_newer(self, sequence, timeout=None):
+        '''
+            Blocks until a frame newer than the given sequence number is available.
+            :param sequence: sequence number the caller has already seen
+            :param timeout: maximum time to wait in seconds
+            :return: (frame, sequence number, timestamp), frame is None on timeout
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence > sequence, timeout):
+                return None, sequence, 0.0
+        return self.latest()
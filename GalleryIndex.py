@@ -0,0 +1,337 @@
+import atexit
+import io
+import os
+import threading
+import numpy as np
+from Metrics import Metrics
+
+INDEX_VERSION = 3
+
+
+def index_path(db_name):
+    '''Returns the path of the search index stored next to the database file.'''
+    return f"{os.path.splitext(db_name)[0]}.index"
+
+
+class IVFIndex:
+    '''Approximate nearest-neighbour index over the gallery using coarse k-means buckets (IVF).
+
+    Vectors are assigned to the nearest of n_lists centroids. A query only scans the n_probe
+    closest buckets, ranks their vectors with a cheap expanded distance and re-ranks the best
+    `rerank` candidates exactly. Raising n_probe or rerank trades latency for recall.
+
+    open() shares one index per database file and persists it next to the database; sync()
+    applies the users changed since the index revision from the database change log. An index
+    of a projected gallery holds projected vectors and is rebuilt when the projection changes.
+    Saving rewrites the whole file, so synced changes are only saved after save_every users
+    changed and at exit. A file older than the database is still correct: load() and sync()
+    catch up from its revision.
+    '''
+
+    opened = {}
+    opened_lock = threading.Lock()
+    save_every = 1000
+    saved_at_exit = False
+
+    def __init__(self, n_lists=None, n_probe=8, rerank=32, iterations=10, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.rerank = rerank
+        self.iterations = iterations
+        self.seed = seed
+
+        self.centroids = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.names = np.empty(0, dtype=object)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.norms = np.empty(0, dtype=np.float32)
+        self.lists = []
+        self.row_of = {}
+        self.free_rows = []
+        self.assignment = np.empty(0, dtype=np.int64)
+        self.lock = threading.RLock()
+        self.revision = 0
+        self.path = None
+        self.cipher_suite = None
+        self.projection = None
+        self.unsaved = 0
+
+    def __len__(self):
+        return len(self.row_of)
+
+    @property
+    def projection_version(self):
+        return self.projection.version if self.projection is not None else 0
+
+    @classmethod
+    def open(cls, db_manager, gallery, **options):
+        '''
+            Returns the shared index of a database, loading the persisted file or building it from the gallery.
+            :param db_manager: DatabaseManager of the database file
+            :param gallery: UserGallery with the current database contents
+            :param options: IVFIndex settings used when the index has to be built
+        '''
+        path = index_path(db_manager.db_name)
+        key = os.path.abspath(path)
+        with cls.opened_lock:
+            index = cls.opened.get(key)
+            projection_version = gallery.projection.version if gallery.projection is not None else 0
+            if index is not None and index.projection_version == projection_version:
+                return index
+
+            with Metrics.span("index_load"):
+                index = None
+                if os.path.exists(path):
+                    try:
+                        index = cls.load(path, db_manager.cipher_suite, gallery, projection_version)
+                    except Exception as e:
+                        print(f"Error: {e}")
+                built = index is None
+                if built:
+                    index = cls(**options).build(gallery.ids, gallery.names, gallery.vectors)
+                    index.revision = gallery.revision
+                index.path = path
+                index.cipher_suite = db_manager.cipher_suite
+                index.projection = gallery.projection
+                index.sync(db_manager)
+                if built:
+                    index.save()
+
+            cls.opened[key] = index
+            if not cls.saved_at_exit:
+                cls.saved_at_exit = True
+                atexit.register(cls.save_opened)
+            return index
+
+    @classmethod
+    def save_opened(cls):
+        '''Saves the opened indexes that have changes not written yet, e.g. at exit'''
+        with cls.opened_lock:
+            indexes = list(cls.opened.values())
+        for index in indexes:
+            if index.unsaved:
+                index.save()
+
+    def sync(self, db_manager):
+        '''
+            Applies the users added, modified or deleted since the index revision.
+            The index is saved once save_every users changed since it was saved last.
+            :param db_manager: DatabaseManager of the indexed database
+            :return: True when the index changed
+        '''
+        with self.lock:
+            changes = db_manager.get_changes(self.revision)
+            if changes["revision"] == self.revision:
+                return False
+            for user_id in changes["deleted"]:
+                self.remove(user_id)
+            vectors = changes["vectors"]
+            if self.projection is not None and len(changes["ids"]):
+                vectors = self.projection.transform(vectors)
+            for user_id, name, vector in zip(changes["ids"], changes["names"], vectors):
+                self.add(user_id, name, vector)
+            self.revision = changes["revision"]
+            self.unsaved += len(changes["ids"]) + len(changes["deleted"])
+            if self.unsaved >= self.save_every:
+                self.save()
+            return True
+
+    def build(self, ids, names, vectors):
+        '''
+            Trains the coarse centroids and assigns every vector to its bucket.
+            :param ids: user ids
+            :param names: user names
+            :param vectors: (users, dimension) matrix of feature vectors
+        '''
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return self
+        n_lists = self.n_lists or int(np.clip(np.sqrt(len(vectors)), 1, 4096))
+        self.centroids = self.train(vectors, n_lists)
+        self.n_lists = len(self.centroids)
+        self._set_rows(ids, names, vectors, self.assign(vectors))
+        return self
+
+    def train(self, vectors, n_lists):
+        '''Runs a few Lloyd iterations of k-means on a sample of the vectors'''
+        rng = np.random.default_rng(self.seed)
+        n_lists = max(1, min(n_lists, len(vectors)))
+        sample = vectors
+        if len(vectors) > 256 * n_lists:
+            sample = vectors[rng.choice(len(vectors), 256 * n_lists, replace=False)]
+
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignment = self._nearest_centroid(sample, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            order = np.argsort(assignment, kind='stable')
+            empty = counts == 0
+            starts = (np.cumsum(counts) - counts)[~empty]
+            sums = np.add.reduceat(sample[order].astype(np.float64), starts, axis=0)
+            centroids[~empty] = (sums / counts[~empty, None]).astype(np.float32)
+            if empty.any():
+                centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        return centroids
+
+    def assign(self, vectors):
+        '''Returns the bucket of every vector'''
+        return self._nearest_centroid(np.atleast_2d(vectors).astype(np.float32), self.centroids)
+
+    @staticmethod
+    def _nearest_centroid(vectors, centroids):
+        squared = (np.einsum('ij,ij->i', centroids, centroids)[None, :] - 2.0 * (vectors @ centroids.T))
+        return np.argmin(squared, axis=1)
+
+    def _set_rows(self, ids, names, vectors, assignment):
+        self.ids = np.array(ids, dtype=np.int64)
+        self.names = np.array(names, dtype=object)
+        # The gallery matrix is shared until the first insert needs to write into it
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(self.ids), -1)
+        self.vectors_shared = True
+        self.norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+        self.row_of = {int(user_id): row for row, user_id in enumerate(self.ids)}
+        self.free_rows = []
+        order = np.argsort(assignment, kind='stable')
+        bounds = np.searchsorted(assignment[order], np.arange(self.n_lists + 1))
+        self.lists = [order[bounds[i]:bounds[i + 1]] for i in range(self.n_lists)]
+        self.assignment = np.asarray(assignment, dtype=np.int64)
+
+    def add(self, user_id, name, vector):
+        '''Inserts a user, or moves an existing user to the bucket of their new vector'''
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        with self.lock:
+            if self.centroids is None:
+                self.build([user_id], [name], vector[None, :])
+                return
+            self._insert(user_id, name, vector)
+
+    def _insert(self, user_id, name, vector):
+        self.remove(user_id)
+        if not self.free_rows:
+            self._grow(len(self.ids) + 1)
+        elif self.vectors_shared:
+            self.vectors = self.vectors.copy()
+            self.vectors_shared = False
+        row = self.free_rows.pop()
+
+        bucket = int(self.assign(vector)[0])
+        self.ids[row] = user_id
+        self.names[row] = name
+        self.vectors[row] = vector
+        self.norms[row] = vector @ vector
+        self.assignment[row] = bucket
+        self.row_of[int(user_id)] = row
+        self.lists[bucket] = np.append(self.lists[bucket], row)
+
+    def _grow(self, size):
+        old_capacity = len(self.ids)
+        if size <= old_capacity:
+            return
+        capacity = max(size, old_capacity * 2, 16)
+        extra = capacity - old_capacity
+        self.ids = np.concatenate([self.ids, np.full(extra, -1, dtype=np.int64)])
+        self.names = np.concatenate([self.names, np.full(extra, None, dtype=object)])
+        self.vectors = np.concatenate([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.vectors_shared = False
+        self.norms = np.concatenate([self.norms, np.zeros(extra, dtype=np.float32)])
+        self.assignment = np.concatenate([self.assignment, np.full(extra, -1, dtype=np.int64)])
+        # Every new row is free, popped from the end so the lowest row is used first
+        self.free_rows.extend(range(capacity - 1, old_capacity - 1, -1))
+
+    def remove(self, user_id):
+        '''Removes a user from the index if present'''
+        with self.lock:
+            row = self.row_of.pop(int(user_id), None)
+            if row is None:
+                return
+            bucket = self.assignment[row]
+            self.lists[bucket] = self.lists[bucket][self.lists[bucket] != row]
+            self.assignment[row] = -1
+            self.ids[row] = -1
+            self.free_rows.append(row)
+
+    def search(self, probe, k=1, n_probe=None, rerank=None):
+        '''
+            Finds approximately the k closest users.
+            :param probe: feature vector of the current user
+            :param k: number of results
+            :param n_probe: buckets to scan, defaults to the index setting
+            :param rerank: candidates re-ranked with the exact distance, defaults to the index setting
+            :return: list of ((id, name), distance) sorted by distance
+        '''
+        probe = np.asarray(probe, dtype=np.float32).ravel()
+        rerank = max(rerank or self.rerank, k)
+
+        with self.lock:
+            if not self.row_of:
+                return []
+            n_probe = min(n_probe or self.n_probe, self.n_lists)
+            centroid_distances = np.einsum('ij,ij->i', self.centroids, self.centroids) - 2.0 * (self.centroids @ probe)
+            if n_probe < self.n_lists:
+                buckets = np.argpartition(centroid_distances, n_probe - 1)[:n_probe]
+            else:
+                buckets = np.arange(self.n_lists)
+            rows = np.concatenate([self.lists[bucket] for bucket in buckets])
+            if rows.size == 0:
+                return []
+
+            coarse = self.norms[rows] - 2.0 * (self.vectors[rows] @ probe)
+            if rows.size > rerank:
+                rows = rows[np.argpartition(coarse, rerank - 1)[:rerank]]
+
+            difference = self.vectors[rows] - probe
+            exact = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+            order = np.argsort(exact, kind='stable')[:k]
+            return [((int(self.ids[rows[i]]), self.names[rows[i]]), float(exact[i])) for i in order]
+
+    def nearest(self, probe, threshold=None):
+        '''Finds approximately the closest user, same result format as UserGallery.nearest()'''
+        results = self.search(probe, 1)
+        if not results or (threshold is not None and results[0][1] >= threshold):
+            return None
+        return results[0]
+
+    def save(self):
+        '''Writes the centroids, bucket assignments and revision, encrypted like the database'''
+        if self.centroids is None:
+            return
+        with self.lock:
+            live = self.ids >= 0
+            buffer = io.BytesIO()
+            np.savez(buffer, version=INDEX_VERSION, revision=self.revision, projection=self.projection_version,
+                     centroids=self.centroids,
+                     ids=self.ids[live], assignment=self.assignment[live],
+                     params=np.array([self.n_probe, self.rerank, self.iterations, self.seed]))
+            self.unsaved = 0
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(self.cipher_suite.encrypt(buffer.getvalue()))
+        os.replace(temp_path, self.path)
+
+    @classmethod
+    def load(cls, path, cipher_suite, gallery, projection_version=0):
+        '''
+            Restores a saved index for the current gallery contents.
+            Users missing from the saved file are assigned to their nearest bucket, deleted users are dropped.
+            :return: IVFIndex at the saved revision, or None when the file does not fit the gallery
+        '''
+        with open(path, "rb") as file:
+            data = np.load(io.BytesIO(cipher_suite.decrypt(file.read())))
+
+        ids, names, vectors = gallery.ids, gallery.names, gallery.vectors
+        if int(data["version"]) != INDEX_VERSION or data["centroids"].shape[1] != vectors.shape[1] \
+                or int(data["revision"]) > gallery.revision or int(data["projection"]) != projection_version:
+            return None
+
+        n_probe, rerank, iterations, seed = (int(value) for value in data["params"])
+        index = cls(len(data["centroids"]), n_probe, rerank, iterations, seed)
+        index.centroids = data["centroids"]
+
+        saved = dict(zip(data["ids"].tolist(), data["assignment"].tolist()))
+        assignment = np.array([saved.get(int(user_id), -1) for user_id in ids], dtype=np.int64)
+        missing = assignment < 0
+        if missing.any():
+            assignment[missing] = index.assign(vectors[missing])
+        index._set_rows(ids, names, vectors, assignment)
+        index.revision = int(data["revision"])
+        return index
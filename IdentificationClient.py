@@ -0,0 +1,80 @@
+import base64
+import http.client
+import json
+import socket
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''HTTP connection over a Unix domain socket'''
+
+    def __init__(self, socket_path, timeout=30.0):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class IdentificationClient:
+    '''Client for IdentificationService keeping one persistent connection, not thread-safe.'''
+
+    def __init__(self, host="127.0.0.1", port=8765, unix_socket=None, timeout=30.0):
+        if unix_socket:
+            self.connection = UnixHTTPConnection(unix_socket, timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, body=None, content_type="application/octet-stream", retry=True):
+        '''
+            Sends one request, by default reconnecting once if the service closed the kept-alive connection.
+            :param retry: False for requests that must not be sent twice, such as enrollments
+            :return: (HTTP status, decoded JSON response)
+        '''
+        headers = {"Content-Type": content_type} if body is not None else {}
+        for attempt in range(2 if retry else 1):
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                return response.status, json.loads(response.read() or b"null")
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self.connection.close()
+                if attempt or not retry:
+                    raise
+
+    @staticmethod
+    def read_image(image):
+        '''Returns encoded image bytes from bytes or an image file path'''
+        if isinstance(image, (bytes, bytearray)):
+            return bytes(image)
+        with open(image, "rb") as file:
+            return file.read()
+
+    def identify(self, image):
+        '''
+            Identifies the face in an image.
+            :param image: encoded image bytes or an image file path
+            :return: result dictionary with status, user_id, name, distance and timings
+        '''
+        return self.request("POST", "/identify", self.read_image(image))[1]
+
+    def enroll(self, name, password, image, overwrite=False, add_template=False):
+        '''Registers a user from an image, see IdentificationService.enroll()'''
+        body = json.dumps({
+            "name": name,
+            "password": password,
+            "image": base64.b64encode(self.read_image(image)).decode("ascii"),
+            "overwrite": overwrite,
+            "add_template": add_template,
+        })
+        return self.request("POST", "/enroll", body.encode("utf-8"), "application/json", retry=False)[1]
+
+    def stats(self):
+        return self.request("GET", "/stats")[1]
+
+    def health(self):
+        return self.request("GET", "/health")[1]
+
+    def close(self):
+        self.connection.close()
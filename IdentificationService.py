@@ -0,0 +1,329 @@
+import asyncio
+import base64
+import binascii
+import json
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit
+import numpy as np
+from BatchIdentifier import init_worker, extract_item
+from DatabaseManager import DatabaseManager
+from Metrics import Metrics
+from UserSearch import UserSearch
+
+MAX_BODY_BYTES = 32 * 1024 * 1024
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 409: "Conflict",
+               411: "Length Required", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    '''Ends a request with an HTTP error status'''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class IdentificationService:
+    '''Local HTTP service that lets several front-ends share one process pool and one gallery.
+
+    POST /identify takes an encoded image (JPEG, PNG, ...) as the request body. POST /enroll
+    takes a JSON object with name, password, a base64 image and optional overwrite and
+    add_template flags. GET /stats returns latency and throughput statistics, GET /health
+    a liveness check. Features are extracted on a process pool; identify requests whose
+    features become ready within batch_window seconds are matched with one gallery query.
+    '''
+
+    def __init__(self, db_name="user_identification.db", workers=None, batch_window=0.005, max_batch=64,
+                 threshold=None):
+        self.db_name = db_name
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        # None uses the threshold that fits the gallery, see UserGallery.match_threshold()
+        self.threshold = threshold
+
+        self.db_manager = None
+        self.executor = None
+        self.pending = None
+        self.batcher = None
+        self.started = time.time()
+        self.requests = Counter()
+        self.latencies = {"identify": deque(maxlen=10000), "enroll": deque(maxlen=10000)}
+        self.batch_sizes = Counter()
+        self.gallery_size = 0
+
+    async def start(self, host="127.0.0.1", port=8765, unix_socket=None):
+        '''
+            Loads the gallery, starts the worker processes and begins accepting connections.
+            :param unix_socket: listen on this Unix socket path instead of host and port
+            :return: the asyncio server
+        '''
+        DatabaseManager.open_session(self.db_name)
+        self.db_manager = DatabaseManager(self.db_name)
+        self.gallery_size = len(UserSearch.load_gallery(self.db_manager))
+
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            initargs=(False, Metrics.enabled))
+        self.pending = asyncio.Queue()
+        self.batcher = asyncio.create_task(self.batch_loop())
+
+        if unix_socket:
+            return await asyncio.start_unix_server(self.handle_connection, unix_socket)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def serve(self, host="127.0.0.1", port=8765, unix_socket=None):
+        '''Runs the service until it is cancelled'''
+        server = await self.start(host, port, unix_socket)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        '''Stops the batcher and the worker processes and writes the database back'''
+        if self.batcher is not None:
+            self.batcher.cancel()
+            self.batcher = None
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+        DatabaseManager.close_session(self.db_name)
+
+    async def handle_connection(self, reader, writer):
+        '''Serves requests on one keep-alive connection'''
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    status, payload = await self.dispatch(method, path, body)
+                except RequestError as e:
+                    headers = {"connection": "close"}
+                    status, payload = e.status, {"error": str(e)}
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self.write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_request(reader):
+        '''
+            Reads one HTTP/1.1 request.
+            :return: (method, path, lower-case headers, body) or None when the client closed the connection
+        '''
+        line = await reader.readline()
+        if not line.strip():
+            return None
+        try:
+            method, target, _ = line.decode("latin-1").split()
+        except ValueError:
+            raise RequestError(400, "Malformed request line.")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise RequestError(411, "Chunked request bodies are not supported, send Content-Length.")
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            raise RequestError(400, "Malformed Content-Length header.")
+        if length > MAX_BODY_BYTES:
+            raise RequestError(413, f"Request bodies are limited to {MAX_BODY_BYTES} bytes.")
+        body = await reader.readexactly(length) if length else b""
+        return method.upper(), urlsplit(target).path, headers, body
+
+    @staticmethod
+    def write_response(writer, status, payload, keep_alive=True):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write((
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode("latin-1") + body)
+
+    async def dispatch(self, method, path, body):
+        '''Routes a request to its endpoint and returns (status, JSON payload)'''
+        routes = {
+            ("POST", "/identify"): self.identify,
+            ("POST", "/enroll"): self.enroll,
+            ("GET", "/stats"): self.stats,
+            ("GET", "/health"): self.health,
+        }
+        handler = routes.get((method, path))
+        if handler is None:
+            raise RequestError(404, f"No endpoint {method} {path}.")
+        try:
+            return await handler(body)
+        except RequestError:
+            raise
+        except Exception as e:
+            return 500, {"error": str(e)}
+
+    async def extract(self, image):
+        '''Extracts the feature vector of an encoded image on the process pool'''
+        loop = asyncio.get_running_loop()
+        result, worker_metrics = await loop.run_in_executor(self.executor, extract_item, ("request", None, image))
+        Metrics.merge(worker_metrics)
+        _, _, feature_vector, status, error, seconds = result
+        return feature_vector, status, error, seconds
+
+    async def identify(self, body):
+        start = time.perf_counter()
+        if not body:
+            raise RequestError(400, "Send the encoded image as the request body.")
+
+        feature_vector, status, error, extraction_seconds = await self.extract(body)
+        result = {"status": status, "user_id": None, "name": None, "distance": None, "error": error,
+                  "extraction_ms": extraction_seconds * 1000, "search_ms": None, "batch_size": None}
+
+        if feature_vector is not None:
+            future = asyncio.get_running_loop().create_future()
+            await self.pending.put((feature_vector, future))
+            match, search_seconds, batch_size = await future
+            result["search_ms"] = search_seconds * 1000
+            result["batch_size"] = batch_size
+            if match:
+                (result["user_id"], result["name"]), result["distance"] = match
+                result["status"] = "match"
+            else:
+                result["status"] = "no_match"
+
+        result["latency_ms"] = self.record("identify", time.perf_counter() - start) * 1000
+        return 200, result
+
+    async def batch_loop(self):
+        '''Collects identify requests arriving within the batch window and matches them together'''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.batch_sizes[len(batch)] += 1
+            Metrics.set_gauge("service_batch_size", len(batch))
+            try:
+                matches, seconds = await loop.run_in_executor(None, self.search, [vector for vector, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), match in zip(batch, matches):
+                if not future.done():
+                    future.set_result((match, seconds, len(batch)))
+
+    def search(self, feature_vectors):
+        '''Matches a batch of feature vectors against the up-to-date gallery in a worker thread'''
+        start = time.perf_counter()
+        gallery = UserSearch.load_gallery(self.db_manager)
+        self.gallery_size = len(gallery)
+        with Metrics.span("service_batch_search"):
+            threshold = gallery.match_threshold(UserSearch.distance_threshold) if self.threshold is None \
+                else self.threshold
+            matches = gallery.batch_nearest(np.stack(feature_vectors), threshold)
+        return matches, time.perf_counter() - start
+
+    async def enroll(self, body):
+        start = time.perf_counter()
+        try:
+            request = json.loads(body)
+            name, password = request["name"], request["password"]
+            image = base64.b64decode(request["image"], validate=True)
+        except (ValueError, KeyError, TypeError, binascii.Error):
+            raise RequestError(400, "Send a JSON object with name, password and a base64 encoded image.")
+        overwrite = bool(request.get("overwrite", False))
+        add_template = bool(request.get("add_template", False))
+
+        loop = asyncio.get_running_loop()
+        existing = await loop.run_in_executor(None, self.db_manager.user_exists, name)
+        if existing:
+            if not (overwrite or add_template):
+                return 409, {"status": "exists", "registered": False,
+                             "error": "A user with this name already exists, set overwrite or add_template."}
+            if not await loop.run_in_executor(None, self.db_manager.verify_password, existing[0], password):
+                return 403, {"status": "wrong_password", "registered": False,
+                             "error": "Password does not match the existing user of this name."}
+        elif overwrite or add_template:
+            return 404, {"status": "not_found", "registered": False,
+                         "error": "No user with this name exists to overwrite or add a template to."}
+
+        feature_vector, status, error, extraction_seconds = await self.extract(image)
+        registered = False
+        if feature_vector is not None:
+            registered = await loop.run_in_executor(
+                None, self.db_manager.register_user, name, password, feature_vector, overwrite, add_template)
+            status = "registered" if registered else "error"
+
+        latency = self.record("enroll", time.perf_counter() - start)
+        return 200, {"status": status, "registered": registered, "error": error,
+                     "extraction_ms": extraction_seconds * 1000, "latency_ms": latency * 1000}
+
+    async def stats(self, body):
+        return 200, self.statistics()
+
+    async def health(self, body):
+        return 200, {"status": "ok", "workers": self.workers}
+
+    def record(self, endpoint, seconds):
+        '''Adds a request latency to the statistics and returns it'''
+        self.requests[endpoint] += 1
+        self.latencies[endpoint].append(seconds)
+        Metrics.observe(f"service_{endpoint}", seconds)
+        return seconds
+
+    def statistics(self):
+        '''Latency percentiles over the last 10000 requests, throughput since start and batch sizes'''
+        uptime = time.time() - self.started
+        endpoints = {}
+        for endpoint, samples in self.latencies.items():
+            endpoints[endpoint] = {"requests": self.requests[endpoint],
+                                   "throughput_per_second": self.requests[endpoint] / uptime}
+            if samples:
+                values = np.asarray(samples) * 1000
+                endpoints[endpoint].update({
+                    "mean_ms": float(values.mean()),
+                    "p50_ms": float(np.percentile(values, 50)),
+                    "p95_ms": float(np.percentile(values, 95)),
+                    "p99_ms": float(np.percentile(values, 99)),
+                    "max_ms": float(values.max()),
+                })
+
+        batches = sum(self.batch_sizes.values())
+        return {
+            "uptime_seconds": uptime,
+            "workers": self.workers,
+            "gallery_size": self.gallery_size,
+            "endpoints": endpoints,
+            "batches": {
+                "count": batches,
+                "mean_size": sum(size * count for size, count in self.batch_sizes.items()) / batches if batches else 0,
+                "sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            },
+        }
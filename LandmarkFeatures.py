@@ -0,0 +1,81 @@
+from itertools import combinations
+import numpy as np
+
+SELECTED_POINTS = [
+    1, 2, 3, 4, 5,  # Jawline points
+    36, 39,  # Left eye corners
+    42, 45,  # Right eye corners
+    31, 35,  # Nose width
+    48, 54,  # Mouth corners
+    57, 8,  # Bottom of lower lip and chin
+    17, 26,  # Left and right eyebrows
+    19, 24  # Center points of left and right eyebrows
+]
+
+ANGLE_TRIPLETS = [
+    (36, 39, 42),  # Left eye region
+    (42, 45, 36),  # Right eye region
+    (31, 30, 35),  # Nose region
+    (48, 51, 54),  # Mouth region
+    (0, 8, 16)  # Chin-jawline region
+]
+
+REFERENCE_PAIR = (36, 45)  # Outer eye corners
+
+
+class LandmarkFeatures:
+    '''Computes facial feature vectors from 68-point landmarks in one vectorized pass.
+
+    The index arrays are built once, so a frame costs a handful of NumPy operations
+    instead of one small allocation per landmark pair. The arithmetic mirrors the
+    original per-pair computation exactly, so vectors stay compatible with enrollments.
+    '''
+
+    pair_first, pair_second = (np.array(indices) for indices in zip(*combinations(SELECTED_POINTS, 2)))
+    angle_a, angle_b, angle_c = (np.array(indices) for indices in zip(*ANGLE_TRIPLETS))
+
+    @staticmethod
+    def to_array(landmarks):
+        '''Converts a dlib full_object_detection into a (68, 2) integer array of point coordinates.'''
+        return np.array([(point.x, point.y) for point in landmarks.parts()], dtype=np.int64)
+
+    @classmethod
+    def dimension(cls):
+        return len(cls.pair_first) + len(cls.angle_a)
+
+    @classmethod
+    def compute(cls, points):
+        '''
+            Calculates the feature vector of a single face.
+            :param points: (68, 2) array of landmark coordinates
+            :return: float64 array of normalized distances followed by angles in degrees
+        '''
+        return cls.compute_batch(np.asarray(points)[None])[0]
+
+    @classmethod
+    def compute_batch(cls, points):
+        '''
+            Calculates feature vectors for many faces or frames at once.
+            :param points: (faces, 68, 2) array of landmark coordinates
+            :return: (faces, dimension) float64 array of feature vectors
+        '''
+        points = np.asarray(points, dtype=np.int64)
+
+        reference = cls._norm(points[:, REFERENCE_PAIR[0]] - points[:, REFERENCE_PAIR[1]])
+        distances = cls._norm(points[:, cls.pair_first] - points[:, cls.pair_second])
+        normalized = distances / reference[:, None]
+
+        vertex = points[:, cls.angle_b]
+        ba = points[:, cls.angle_a] - vertex
+        bc = points[:, cls.angle_c] - vertex
+        dot = np.einsum('...i,...i->...', ba, bc)
+        cosine = dot / (cls._norm(ba) * cls._norm(bc))
+        angles = np.degrees(np.arccos(cosine))
+
+        return np.concatenate([normalized, angles], axis=1)
+
+    @staticmethod
+    def _norm(vectors):
+        '''Euclidean length along the last axis, computed the same way as np.linalg.norm on 2D points.'''
+        vectors = vectors.astype(np.float64)
+        return np.sqrt(vectors[..., 0] * vectors[..., 0] + vectors[..., 1] * vectors[..., 1])
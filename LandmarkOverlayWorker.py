@@ -0,0 +1,122 @@
+import threading
+import numpy as np
+from PyQt5.QtCore import QThread, QCoreApplication, pyqtSignal
+from FaceExceptions import NoFaceDetectedException, MultipleFacesDetectedException
+from Metrics import Metrics
+from UserIdentification import UserIdentification
+
+FACE_NONE = "none"
+FACE_ONE = "one"
+FACE_MULTIPLE = "multiple"
+
+
+class LandmarkOverlayWorker(QThread):
+    '''Finds face landmarks on live preview frames off the GUI thread.
+
+    Only the newest submitted frame is kept: a frame still waiting when the next one arrives
+    is dropped, so the worker never falls behind the camera. Consecutive frames share a
+    FaceTracker, so the detector only runs now and then. Every processed frame is reported
+    with landmarks_ready(sequence, face status, landmarks in frame coordinates or None), and
+    face_status_changed(status) fires when the status moves between none, one and multiple.
+    '''
+    landmarks_ready = pyqtSignal(int, str, object)
+    face_status_changed = pyqtSignal(str)
+
+    def __init__(self, user_identification=None, tracker_options=None):
+        super().__init__()
+        self.user_identification = user_identification
+        self.tracker_options = tracker_options or {}
+        self.tracker = None
+        self.condition = threading.Condition()
+        self.pending = None
+        self.buffers = [None, None]
+        self.busy = None
+        self.stopping = False
+        self.status = None
+
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def submit(self, frame, sequence):
+        '''
+            Queue the newest preview frame, replacing a frame that is still waiting.
+            :param frame: BGR frame, copied before this call returns so ring buffer slots can be passed
+            :param sequence: frame sequence number, passed back with landmarks_ready
+        '''
+        if frame is None:
+            return
+        with self.condition:
+            if self.pending is not None:
+                Metrics.increment("overlay_dropped")
+            # Two buffers: the worker reads one while the newest frame is copied into the other
+            index = 1 if self.busy == 0 else 0
+            buffer = self.buffers[index]
+            if buffer is None or buffer.shape != frame.shape or buffer.dtype != frame.dtype:
+                buffer = self.buffers[index] = np.empty_like(frame)
+            np.copyto(buffer, frame)
+            self.pending = (index, sequence)
+            self.condition.notify()
+
+        if not self.isRunning():
+            self.stopping = False
+            self.start()
+
+    def reset(self):
+        '''Drop the waiting frame and the face track, e.g. when the camera restarts'''
+        with self.condition:
+            self.pending = None
+            self.status = None
+            self.tracker = None
+
+    def stop(self):
+        '''Drop the waiting frame and wait for the worker thread to finish'''
+        with self.condition:
+            self.pending = None
+            self.stopping = True
+            self.condition.notify()
+        self.wait()
+
+    def get_user_identification(self):
+        if self.user_identification is None:
+            self.user_identification = UserIdentification()
+        return self.user_identification
+
+    def run(self):
+        '''Process the newest frame until the worker is stopped'''
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending is not None or self.stopping)
+                if self.stopping:
+                    return
+                index, sequence = self.pending
+                self.pending = None
+                self.busy = index
+                if self.tracker is None:
+                    self.tracker = self.get_user_identification().create_tracker(**self.tracker_options)
+                tracker = self.tracker
+
+            with Metrics.span("overlay"):
+                status, points = self.process(self.buffers[index], tracker)
+            with self.condition:
+                self.busy = None
+
+            self.landmarks_ready.emit(sequence, status, points)
+            if status != self.status:
+                self.status = status
+                self.face_status_changed.emit(status)
+
+    def process(self, frame, tracker):
+        '''Returns the face status and the landmarks of the single face in frame coordinates'''
+        try:
+            points = self.user_identification.extract_landmarks(frame, tracker)
+        except NoFaceDetectedException:
+            return FACE_NONE, None
+        except MultipleFacesDetectedException:
+            return FACE_MULTIPLE, None
+
+        # Landmarks are found on the downscaled image used for detection
+        scale = max(frame.shape[:2]) / self.user_identification.max_dimension
+        if scale > 1:
+            points = points * scale
+        return FACE_ONE, points
@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TIMER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+PREFIX = "face_recognition_"
+
+_disabled_span = nullcontext()
+
+
+class _Span:
+    '''Times a block of code and records it in a timer when the block exits'''
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        Metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    '''Process-wide timers, counters and gauges for the recognition pipeline.
+
+    Disabled unless FACE_RECOGNITION_METRICS=1 is set or enable() is called; while disabled
+    span() hands out a shared no-op context manager and the other calls return immediately.
+    Snapshots can be exported as JSON or Prometheus text, to a file or over HTTP.
+    '''
+
+    enabled = os.environ.get("FACE_RECOGNITION_METRICS") == "1"
+
+    _lock = threading.Lock()
+    _timers = {}
+    _counters = {}
+    _gauges = {}
+    _exporters = []
+
+    @classmethod
+    def enable(cls, enabled=True):
+        cls.enabled = enabled
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._timers.clear()
+            cls._counters.clear()
+            cls._gauges.clear()
+
+    @classmethod
+    def span(cls, name):
+        '''
+            Returns a context manager timing the enclosed block.
+            :param name: stage name, exported as face_recognition_<name>_seconds
+        '''
+        if not cls.enabled:
+            return _disabled_span
+        return _Span(name)
+
+    @classmethod
+    def observe(cls, name, seconds):
+        '''Records one duration for the named timer'''
+        if not cls.enabled:
+            return
+        with cls._lock:
+            timer = cls._timers.get(name)
+            if timer is None:
+                timer = cls._timers[name] = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(TIMER_BUCKETS)}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["max"] = max(timer["max"], seconds)
+            for index, bound in enumerate(TIMER_BUCKETS):
+                if seconds <= bound:
+                    timer["buckets"][index] += 1
+                    break
+
+    @classmethod
+    def increment(cls, name, value=1):
+        '''Adds to a monotonically increasing counter, e.g. captured or dropped frames'''
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._counters[name] = cls._counters.get(name, 0) + value
+
+    @classmethod
+    def set_gauge(cls, name, value):
+        '''Sets a value that can go up and down, e.g. a queue depth'''
+        if not cls.enabled:
+            return
+        with cls._lock:
+            cls._gauges[name] = value
+
+    @classmethod
+    def drain(cls):
+        '''
+            Returns the timers and counters recorded since the last drain and clears them, so a
+            worker process can hand its measurements to the parent, see merge().
+            :return: picklable dict, None while disabled
+        '''
+        if not cls.enabled:
+            return None
+        with cls._lock:
+            drained = {"timers": cls._timers, "counters": cls._counters}
+            cls._timers = {}
+            cls._counters = {}
+        return drained
+
+    @classmethod
+    def merge(cls, drained):
+        '''Adds timers and counters drained in another process to the ones of this process'''
+        if not cls.enabled or not drained:
+            return
+        with cls._lock:
+            for name, other in drained["timers"].items():
+                timer = cls._timers.get(name)
+                if timer is None:
+                    timer = cls._timers[name] = {"count": 0, "sum": 0.0, "max": 0.0,
+                                                 "buckets": [0] * len(TIMER_BUCKETS)}
+                timer["count"] += other["count"]
+                timer["sum"] += other["sum"]
+                timer["max"] = max(timer["max"], other["max"])
+                timer["buckets"] = [a + b for a, b in zip(timer["buckets"], other["buckets"])]
+            for name, value in drained["counters"].items():
+                cls._counters[name] = cls._counters.get(name, 0) + value
+
+    @classmethod
+    def snapshot(cls):
+        '''Returns a JSON-serializable copy of all metrics'''
+        with cls._lock:
+            timers = {}
+            for name, timer in cls._timers.items():
+                timers[name] = {
+                    "count": timer["count"],
+                    "sum_seconds": timer["sum"],
+                    "mean_seconds": timer["sum"] / timer["count"],
+                    "max_seconds": timer["max"],
+                    "buckets": dict(zip(map(str, TIMER_BUCKETS), timer["buckets"])),
+                }
+            return {
+                "timestamp": time.time(),
+                "timers": timers,
+                "counters": dict(cls._counters),
+                "gauges": dict(cls._gauges),
+            }
+
+    @classmethod
+    def to_prometheus(cls):
+        '''Formats all metrics in the Prometheus text exposition format'''
+        with cls._lock:
+            lines = []
+            for name, timer in sorted(cls._timers.items()):
+                metric = f"{PREFIX}{name}_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                cumulative = 0
+                for bound, count in zip(TIMER_BUCKETS, timer["buckets"]):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_bucket{{le="+Inf"}} {timer["count"]}')
+                lines.append(f"{metric}_sum {timer['sum']}")
+                lines.append(f"{metric}_count {timer['count']}")
+            for name, value in sorted(cls._counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name}_total counter")
+                lines.append(f"{PREFIX}{name}_total {value}")
+            for name, value in sorted(cls._gauges.items()):
+                lines.append(f"# TYPE {PREFIX}{name} gauge")
+                lines.append(f"{PREFIX}{name} {value}")
+            return "\n".join(lines) + "\n"
+
+    @classmethod
+    def write(cls, path):
+        '''Writes a snapshot to a file, JSON for .json paths and Prometheus text otherwise'''
+        if path.endswith(".json"):
+            text = json.dumps(cls.snapshot(), indent=2)
+        else:
+            text = cls.to_prometheus()
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(text)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def start_exporter(cls, path=None, port=None, interval=10.0):
+        '''
+            Enables metrics and exports them in the background.
+            :param path: file rewritten every interval seconds
+            :param port: serve /metrics (Prometheus) and /metrics.json on 127.0.0.1:port
+            :param interval: seconds between file exports
+        '''
+        cls.enable()
+        if path:
+            stop_event = threading.Event()
+
+            def export_loop():
+                while not stop_event.wait(interval):
+                    cls.write(path)
+                cls.write(path)
+
+            thread = threading.Thread(target=export_loop, daemon=True)
+            thread.start()
+            cls._exporters.append((stop_event.set, thread.join))
+
+        if port:
+            server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            cls._exporters.append((server.shutdown, server.server_close))
+
+    @classmethod
+    def stop_exporters(cls):
+        '''Stops background exporters, writing the metrics file one last time'''
+        while cls._exporters:
+            stop, close = cls._exporters.pop()
+            stop()
+            close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = Metrics.to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(Metrics.snapshot()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
@@ -0,0 +1,130 @@
+import os
+import sys
+import threading
+import time
+import dlib
+import numpy as np
+
+
+def current_memory_usage():
+    '''Returns the resident memory of this process in bytes.'''
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # Peak rather than current usage; kilobytes everywhere except macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+class ModelRegistry:
+    '''Loads the dlib face detector and shape predictor once per process and shares them.
+
+    Models are loaded lazily on first use; the lock makes sure concurrent callers
+    (GUI thread, worker threads) never trigger a second load.
+    '''
+
+    predictor_path = "shape_predictor_68_face_landmarks.dat"
+
+    _lock = threading.Lock()
+    _ready = threading.Event()
+    _finished = threading.Event()
+    _error = None
+    _detector = None
+    _predictor = None
+    _stats = {}
+
+    @classmethod
+    def get_detector(cls):
+        '''Returns the shared frontal face detector, loading it on first use.'''
+        if cls._detector is None:
+            with cls._lock:
+                if cls._detector is None:
+                    cls._detector = cls._load("detector", dlib.get_frontal_face_detector)
+        return cls._detector
+
+    @classmethod
+    def get_predictor(cls):
+        '''Returns the shared 68-point shape predictor, loading it on first use.'''
+        if cls._predictor is None:
+            with cls._lock:
+                if cls._predictor is None:
+                    cls._predictor = cls._load("predictor", dlib.shape_predictor, cls.predictor_path)
+        return cls._predictor
+
+    @classmethod
+    def is_loaded(cls):
+        '''Checks whether both models are already in memory.'''
+        return cls._detector is not None and cls._predictor is not None
+
+    @classmethod
+    def is_ready(cls):
+        '''Checks whether the models have been loaded and warmed up.'''
+        return cls._ready.is_set()
+
+    @classmethod
+    def warm_up_finished(cls):
+        '''Checks whether warm_up() has ended, successfully or not.'''
+        return cls._finished.is_set()
+
+    @classmethod
+    def warm_up_error(cls):
+        '''Returns the message of the exception that made warm_up() fail, None if it did not fail.'''
+        return cls._error
+
+    @classmethod
+    def wait_until_ready(cls, timeout=None):
+        '''Blocks until warm_up() has finished, returns False on timeout.'''
+        return cls._ready.wait(timeout)
+
+    @classmethod
+    def warm_up(cls):
+        '''Loads both models and runs a dummy inference so the weights are paged in before the first real frame.'''
+        memory_before = current_memory_usage()
+        start = time.perf_counter()
+
+        try:
+            detector = cls.get_detector()
+            predictor = cls.get_predictor()
+            image = np.zeros((240, 320), dtype=np.uint8)
+            detector(image)
+            predictor(image, dlib.rectangle(80, 40, 240, 200))
+        except Exception as e:
+            # Kept so screens created after the failure can still show it
+            cls._error = str(e)
+            cls._finished.set()
+            raise
+
+        cls._stats["warm_up"] = {
+            "seconds": time.perf_counter() - start,
+            "memory_bytes": max(current_memory_usage() - memory_before, 0),
+        }
+        cls._error = None
+        cls._ready.set()
+        cls._finished.set()
+
+    @classmethod
+    def load_stats(cls):
+        '''
+            Reports how long each model took to load and how much memory it added.
+            :return: dict of model name to {"seconds": float, "memory_bytes": int}
+        '''
+        return {name: dict(stats) for name, stats in cls._stats.items()}
+
+    @classmethod
+    def _load(cls, name, loader, *args):
+        memory_before = current_memory_usage()
+        start = time.perf_counter()
+        model = loader(*args)
+        cls._stats[name] = {
+            "seconds": time.perf_counter() - start,
+            "memory_bytes": max(current_memory_usage() - memory_before, 0),
+        }
+        return model
@@ -0,0 +1,16 @@
+from PyQt5.QtCore import QThread, pyqtSignal
+
+class ModelWarmupThread(QThread):
+    '''Loads and warms up the face models in the background so the GUI can start immediately'''
+    warmup_complete = pyqtSignal(bool, str)
+
+    def run(self):
+        '''Import dlib, load the detector and predictor and run a dummy inference'''
+        try:
+            from ModelRegistry import ModelRegistry
+
+            ModelRegistry.warm_up()
+            seconds = ModelRegistry.load_stats()["warm_up"]["seconds"]
+            self.warmup_complete.emit(True, f"Face models ready ({seconds:.1f} s).")
+        except Exception as e:
+            self.warmup_complete.emit(False, f"Error while loading face models: {e}")
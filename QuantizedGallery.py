@@ -0,0 +1,104 @@
+import numpy as np
+from UserGallery import UserGallery
+
+# Code type and number of quantization steps per storage mode
+STORAGE = {"int8": (np.int8, 255.0), "float16": (np.float16, 1.0)}
+
+
+class QuantizedGallery(UserGallery):
+    '''UserGallery whose full scan runs over a compact int8 or float16 copy of the vectors.
+
+    Every dimension is mapped onto the code range with its own offset and scale, so the
+    approximate distance is a scale-weighted distance between codes. The scan touches a
+    quarter (int8) or half (float16) of the bytes of the float32 matrix and is decoded in
+    blocks of block_rows rows. The rerank best users of the scan are then re-ranked with
+    their float32 vectors and templates, so every reported distance is exact.
+    '''
+
+    rerank = 32
+    block_rows = 8192
+
+    def __init__(self, ids, names, vectors, revision=0, spreads=None, templates=None, projection=None,
+                 storage="int8"):
+        super().__init__(ids, names, vectors, revision, spreads, templates, projection)
+        if storage not in STORAGE:
+            raise ValueError(f"Unknown gallery storage {storage}, use one of {', '.join(STORAGE)}.")
+        self.storage = storage
+        self.codes, self.offset, self.scale = self.quantize(self.vectors, storage)
+
+        # Squared distances are weighted by scale^2 per dimension, the code norms include the weights
+        self.weights = self.scale * self.scale
+        self.code_norms = np.empty(len(self.codes), dtype=np.float32)
+        for start, block in self._blocks():
+            self.code_norms[start:start + len(block)] = block * block @ self.weights
+
+    @staticmethod
+    def quantize(vectors, storage):
+        '''
+            Encodes vectors with a per-dimension offset and scale.
+            :return: (codes, offset, scale) where vectors ~= codes * scale + offset
+        '''
+        dtype, steps = STORAGE[storage]
+        if len(vectors) == 0:
+            dimension = vectors.shape[1]
+            return np.empty((0, dimension), dtype=dtype), np.zeros(dimension, np.float32), np.ones(dimension, np.float32)
+
+        low, high = vectors.min(axis=0), vectors.max(axis=0)
+        scale = np.where(high > low, (high - low) / steps, 1.0).astype(np.float32)
+        offset = low.astype(np.float32)
+        if dtype == np.int8:
+            # Shift the code range from 0..255 to -128..127
+            offset = offset + 128 * scale
+            codes = np.clip(np.rint((vectors - offset) / scale), -128, 127).astype(np.int8)
+        else:
+            codes = ((vectors - offset) / scale).astype(np.float16)
+        return codes, offset, scale
+
+    def derive(self, ids, names, vectors, revision, spreads, templates):
+        return QuantizedGallery(ids, names, vectors, revision, spreads, templates, self.projection, self.storage)
+
+    def memory_usage(self):
+        search = self.codes.nbytes + self.code_norms.nbytes + self.offset.nbytes + self.scale.nbytes
+        total = search + self.vectors.nbytes + self.norms.nbytes + self.templates.nbytes + self.spreads.nbytes
+        return {"search": search, "total": total}
+
+    def _refines(self):
+        return True
+
+    def _candidates(self, distances, k):
+        return self._smallest(distances - self.spreads, max(k, self.refine_candidates, self.rerank))
+
+    def _blocks(self):
+        '''Yields (first row, float32 block of codes) over the whole code matrix'''
+        for start in range(0, len(self.codes), self.block_rows):
+            yield start, self.codes[start:start + self.block_rows].astype(np.float32)
+
+    def distances(self, probe):
+        '''Approximate distances between the probe and every enrolled vector, see batch_distances()'''
+        probe = self.project(self.parse_vector(probe))
+        if probe.shape[0] != self.dimension:
+            raise ValueError("Vectors are not the same size.")
+        return self.batch_distances(probe[None, :])[0]
+
+    def batch_distances(self, probes):
+        '''
+            Approximate distance matrix between many probes and the whole gallery, computed on the codes.
+            Only used to pick candidates; reported distances come from the float32 vectors.
+        '''
+        probes = self.project(np.atleast_2d(np.asarray(probes, dtype=np.float32)))
+        if probes.shape[1] != self.dimension:
+            raise ValueError("Vectors are not the same size.")
+
+        # Probes are mapped into code space but not rounded
+        encoded = (probes - self.offset) / self.scale
+        weighted = encoded * self.weights
+        probe_norms = np.einsum('ij,ij->i', weighted, encoded)
+
+        squared = np.empty((len(probes), len(self.codes)), dtype=np.float32)
+        for start, block in self._blocks():
+            squared[:, start:start + len(block)] = weighted @ block.T
+        squared *= -2.0
+        squared += probe_norms[:, None]
+        squared += self.code_norms[None, :]
+        np.maximum(squared, 0.0, out=squared)
+        return np.sqrt(squared)
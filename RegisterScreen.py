@@ -1,26 +1,41 @@
-import cv2
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QPushButton, QLineEdit, QMessageBox, QHBoxLayout, QStyle
-from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtCore import QTimer, Qt
 
 from DatabaseManager import DatabaseManager
 from FaceExceptions import NoFaceDetectedException, MultipleFacesDetectedException
 from FeatureExtractionThread import FeatureExtractionThread
+from FrameRenderer import FrameRenderer
+from LandmarkOverlayWorker import LandmarkOverlayWorker, FACE_NONE, FACE_ONE, FACE_MULTIPLE
 from UserIdentification import UserIdentification
 from CameraApp import CameraApp
 
 class RegisterScreen(QWidget):
     '''This class is responsible for displaying the registration screen'''
 
+    face_status_messages = {
+        FACE_NONE: "No face detected",
+        FACE_ONE: "Face detected, ready to capture",
+        FACE_MULTIPLE: "Multiple faces detected, only one person may be in view",
+    }
+    # Overlay results at most this many frames older than the captured frame are reused on capture
+    max_overlay_lag = 2
+
     def __init__(self, stacked_widget):
         super().__init__()
         self.stacked_widget = stacked_widget
         self.camera_app = CameraApp(self.stacked_widget)
-        self.user_identification = UserIdentification()
+        self.user_identification = None
         self.is_camera_running = False
         self.database_manager = DatabaseManager()
         self.captured_frame = None
         self.feature_extraction_thread = None
+        self.landmarks = None
+        self.overlay_sequence = None
+        self.overlay_status = None
+
+        self.overlay_worker = LandmarkOverlayWorker()
+        self.overlay_worker.landmarks_ready.connect(self.on_landmarks_ready)
+        self.overlay_worker.face_status_changed.connect(self.on_face_status_changed)
         self.init_ui()
 
     def init_ui(self):
@@ -54,6 +69,11 @@ class RegisterScreen(QWidget):
         self.camera_view_label.setFixedSize(640, 400)
         self.camera_view_label.setAlignment(Qt.AlignCenter)
         main_layout.addWidget(self.camera_view_label)
+        self.renderer = FrameRenderer(self.camera_view_label)
+
+        self.face_status_label = QLabel(self)
+        self.face_status_label.setAlignment(Qt.AlignCenter)
+        main_layout.addWidget(self.face_status_label)
 
         button_styles = """
             QPushButton {
@@ -99,6 +119,12 @@ class RegisterScreen(QWidget):
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_camera_feed)
 
+    def get_user_identification(self):
+        '''Create the UserIdentification on first use so opening the screen does not wait for the models'''
+        if self.user_identification is None:
+            self.user_identification = UserIdentification()
+        return self.user_identification
+
     def toggle_password_visibility(self):
         '''Toggle the visibility of the password'''
         if self.show_password_button.isChecked():
@@ -118,6 +144,8 @@ class RegisterScreen(QWidget):
     def start_camera(self):
         '''Start the camera feed and timer'''
         self.camera_app.start_camera()
+        self.renderer.reset()
+        self.reset_overlay()
         self.timer.start(30)
         self.is_camera_running = True
         self.capture_button.setText("Capture Photo")
@@ -128,6 +156,8 @@ class RegisterScreen(QWidget):
         if self.timer.isActive():
             self.timer.timeout.disconnect(self.update_camera_feed)
         self.camera_app.stop_camera()
+        self.overlay_worker.reset()
+        self.face_status_label.clear()
         self.is_camera_running = False
         self.capture_button.setText("Start Camera")
 
@@ -136,40 +166,65 @@ class RegisterScreen(QWidget):
         if not self.is_camera_running:
             return
 
-        frame = self.camera_app.capture_frame()
-        if frame is not None:
-            rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            h, w, ch = rgb_image.shape
-            bytes_per_line = ch * w
-            q_image = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-            pixmap = QPixmap.fromImage(q_image)
-            self.camera_view_label.setPixmap(pixmap.scaled(
-                self.camera_view_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
-            ))
+        frame, sequence, _ = self.camera_app.latest()
+        if self.renderer.render(frame, sequence, self.landmarks):
+            self.overlay_worker.submit(frame, sequence)
+
+    def reset_overlay(self):
+        '''Forget the landmarks and face status of the previous camera session'''
+        self.overlay_worker.reset()
+        self.landmarks = None
+        self.overlay_sequence = None
+        self.overlay_status = None
+        self.face_status_label.setText("Looking for a face...")
+
+    def on_landmarks_ready(self, sequence, status, landmarks):
+        '''Keep the newest overlay result, the preview draws it over the following frames'''
+        if not self.is_camera_running:
+            return
+        self.landmarks = landmarks
+        self.overlay_sequence = sequence
+        self.overlay_status = status
+
+    def on_face_status_changed(self, status):
+        if self.is_camera_running:
+            self.face_status_label.setText(self.face_status_messages.get(status, ""))
 
     def toggle_camera_and_capture(self):
         '''Toggles the camera feed on/off and captures a photo if the camera is running'''
         if not self.is_camera_running:
             self.start_camera()
         else:
-            frame = self.camera_app.capture_frame()
+            frame, sequence, _ = self.camera_app.latest()
             if frame is not None:
+                frame = frame.copy()
+                overlay = self.recent_overlay(sequence)
                 self.stop_camera()
-                self.process_captured_frame(frame)
+                self.process_captured_frame(frame, overlay)
                 QMessageBox.information(self, "Success", "Photo captured successfully!")
 
-    def process_captured_frame(self, frame):
-        '''Processes the captured frame to display landmarks and store for further processing'''
+    def recent_overlay(self, sequence):
+        '''Returns (face status, landmarks) when the overlay analysed a frame close to the given one'''
+        if self.overlay_sequence is None or not 0 <= sequence - self.overlay_sequence <= self.max_overlay_lag:
+            return None
+        return self.overlay_status, self.landmarks
+
+    def process_captured_frame(self, frame, overlay=None):
+        '''
+            Processes the captured frame to display landmarks and store for further processing.
+            :param overlay: recent (face status, landmarks) from the overlay worker, saves a detection here
+        '''
         try:
-            image_with_landmarks = self.user_identification.draw_landmarks(frame)
-
-            height, width, channel = image_with_landmarks.shape
-            bytes_per_line = channel * width
-            q_img = QImage(image_with_landmarks.data, width, height, bytes_per_line, QImage.Format_RGB888)
-            pixmap = QPixmap.fromImage(q_img)
-            self.camera_view_label.setPixmap(pixmap.scaled(
-                self.camera_view_label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation
-            ))
+            if overlay is None:
+                image_with_landmarks = self.get_user_identification().draw_landmarks(frame.copy())
+                self.renderer.render(image_with_landmarks)
+            else:
+                status, landmarks = overlay
+                if status == FACE_NONE:
+                    raise NoFaceDetectedException("No faces detected.")
+                if status == FACE_MULTIPLE:
+                    raise MultipleFacesDetectedException("Multiple faces detected.")
+                self.renderer.render(frame, points=landmarks)
 
             self.captured_frame = frame
 
@@ -197,12 +252,17 @@ class RegisterScreen(QWidget):
             if existing_user:
                 stored_password, _ = existing_user
                 if self.database_manager.verify_password(stored_password, password):
-                    reply = QMessageBox.question(
-                        self, 'User Exists',
-                        "A user with this name already exists. Do you want to overwrite the data?",
-                        QMessageBox.Yes | QMessageBox.No
-                    )
-                    if reply == QMessageBox.Yes:
+                    question = QMessageBox(self)
+                    question.setWindowTitle('User Exists')
+                    question.setText("A user with this name already exists. Do you want to add this photo to "
+                                     "the stored face data or overwrite the data?")
+                    add_button = question.addButton("Add Photo", QMessageBox.AcceptRole)
+                    overwrite_button = question.addButton("Overwrite", QMessageBox.DestructiveRole)
+                    question.addButton(QMessageBox.Cancel)
+                    question.exec_()
+                    if question.clickedButton() is add_button:
+                        self.register_user_with_new_template(name, password)
+                    elif question.clickedButton() is overwrite_button:
                         self.register_user_with_overwrite(name, password)
                     else:
                         QMessageBox.information(self, "Cancelled", "User data was not overwritten.")
@@ -216,15 +276,19 @@ class RegisterScreen(QWidget):
         '''Register user and overwrite existing data'''
         self.start_feature_extraction_thread(name, password, overwrite=True)
 
+    def register_user_with_new_template(self, name, password):
+        '''Register user by adding another face template to the existing data'''
+        self.start_feature_extraction_thread(name, password, overwrite=False, add_template=True)
+
     def register_user_without_overwrite(self, name, password):
         '''Register user without overwriting'''
         self.start_feature_extraction_thread(name, password, overwrite=False)
 
-    def start_feature_extraction_thread(self, name, password, overwrite):
+    def start_feature_extraction_thread(self, name, password, overwrite, add_template=False):
         '''Initialize and start feature extraction with registration in a thread'''
         if self.captured_frame is not None:
             self.feature_extraction_thread = FeatureExtractionThread(
-                name, password, self.captured_frame, self.user_identification, overwrite
+                name, password, self.captured_frame, self.get_user_identification(), overwrite, add_template
             )
             self.feature_extraction_thread.extraction_complete.connect(self.on_extraction_complete)
             self.feature_extraction_thread.start()
@@ -248,6 +312,7 @@ class RegisterScreen(QWidget):
     def hideEvent(self, event):
         '''Stop the camera when the screen is hidden'''
         self.stop_camera()
+        self.overlay_worker.stop()
         super().hideEvent(event)
 
     def go_back(self):
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import mmap
+import os
+import secrets
+import stat
+import struct
+import tempfile
+import threading
+import time
+import numpy as np
+from FeatureProjection import FeatureProjection
+from Metrics import Metrics
+from UserGallery import UserGallery
+
+MAGIC = b"FRGALRY\x00"
+LAYOUT_VERSION = 2
+HEADER = struct.Struct("<8sIIQQQQQQQQdddd")
+# The heartbeat is the last header field and the only one changed after publishing
+HEARTBEAT = struct.Struct("<d")
+HEARTBEAT_OFFSET = HEADER.size - HEARTBEAT.size
+ALIGNMENT = 64
+
+
+def shared_gallery_path(db_name):
+    '''Returns the path of the file naming the gallery currently published for a database.'''
+    return f"{os.path.splitext(db_name)[0]}.gallery"
+
+
+def segment_directory():
+    '''
+        Returns the private directory of this user for published galleries, created on first use.
+        It is memory-backed where the system has /dev/shm, so vectors never reach a disk.
+        Raises PermissionError when the directory exists but others could read or replace its files.
+    '''
+    if not hasattr(os, "getuid"):
+        # The temp directory is already private to the user on Windows
+        return tempfile.gettempdir()
+
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    directory = os.path.join(base, f"face_recognition_{os.getuid()}")
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    status = os.lstat(directory)
+    if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or status.st_mode & 0o077:
+        raise PermissionError(f"{directory} is not a directory only this user can access.")
+    return directory
+
+
+def check_private(descriptor, path):
+    '''Raises PermissionError unless an open segment is a regular file of this user that nobody else can access'''
+    status = os.fstat(descriptor)
+    if not stat.S_ISREG(status.st_mode) or status.st_mode & 0o077 \
+            or (hasattr(os, "getuid") and status.st_uid != os.getuid()):
+        raise PermissionError(f"Shared gallery segment {path} is not a private file of this user.")
+
+
+def segment_prefix(db_name):
+    '''Returns the file name prefix of the segments published for a database.'''
+    return "face_recognition_gallery_" + hashlib.sha1(os.path.abspath(db_name).encode("utf-8")).hexdigest()[:16]
+
+
+def segment_layout(users, dimension, templates, name_bytes, source_dimension):
+    '''Returns (attribute, dtype, shape, offset) of every array in a segment and the total segment size.'''
+    arrays = [
+        ("ids", np.int64, (users,)),
+        ("vectors", np.float32, (users, dimension)),
+        ("norms", np.float32, (users,)),
+        ("spreads", np.float32, (users,)),
+        ("template_owners", np.int64, (templates,)),
+        ("templates", np.float32, (templates, dimension)),
+        ("template_starts", np.int64, (users,)),
+        ("template_counts", np.int64, (users,)),
+        ("name_offsets", np.int64, (users + 1,)),
+        ("name_bytes", np.uint8, (name_bytes,)),
+    ]
+    if source_dimension:
+        arrays += [
+            ("mean", np.float32, (source_dimension,)),
+            ("scale", np.float32, (source_dimension,)),
+            ("components", np.float32, (source_dimension, dimension)),
+        ]
+
+    layout = []
+    offset = HEADER.size
+    for name, dtype, shape in arrays:
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        layout.append((name, dtype, shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, max(offset, 1)
+
+
+class SharedGallery(UserGallery):
+    '''A gallery read directly from a segment published by another process on the same host.
+
+    publish() writes the ids, vectors, norms, spreads and templates of a gallery into a new
+    memory-mapped segment with a version header and then atomically points `<db>.gallery` at it.
+    attach() maps the current segment read-only, so every process searches the same physical
+    pages instead of loading its own copy; only the user names are decoded per process. When the
+    pointer names a newer version, attach() maps that one and searches still running on the
+    previous gallery keep their mapping until they finish.
+
+    The publisher refreshes a heartbeat in the header of the current segment. A segment whose
+    heartbeat is older than its stale_after seconds belongs to a publisher that died or hangs,
+    so attach() ignores it and callers load the gallery from the database instead. Segments live
+    in a directory only this user can access, and attach() maps only files of this user.
+
+    Galleries derived from a shared one, e.g. by apply_changes(), are ordinary private galleries.
+    '''
+
+    attached = {}
+    attached_lock = threading.Lock()
+    # Writable mappings of the segments this process publishes, keyed by database path
+    publishing = {}
+
+    def __init__(self, mapped, header):
+        magic, layout_version, _, version, revision, users, dimension, templates, name_bytes, \
+            source_dimension, projection_version, threshold, explained_variance, stale_after, _ = header
+        self.segment = mapped
+        self.version = version
+        self.revision = revision
+        self.stale_after = stale_after
+
+        layout, _ = segment_layout(users, dimension, templates, name_bytes, source_dimension)
+        arrays = {name: np.frombuffer(mapped, dtype, int(np.prod(shape)), offset).reshape(shape)
+                  for name, dtype, shape, offset in layout}
+        self.ids = arrays["ids"]
+        self.vectors = arrays["vectors"]
+        self.norms = arrays["norms"]
+        self.spreads = arrays["spreads"]
+        self.template_owners = arrays["template_owners"]
+        self.templates = arrays["templates"]
+        self.template_starts = arrays["template_starts"]
+        self.template_counts = arrays["template_counts"]
+
+        offsets, encoded = arrays["name_offsets"], arrays["name_bytes"].tobytes()
+        self.names = np.empty(users, dtype=object)
+        self.names[:] = [encoded[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(users)]
+
+        self.projection = None
+        if source_dimension:
+            self.projection = FeatureProjection(
+                arrays["mean"], arrays["scale"], arrays["components"], projection_version,
+                None if np.isnan(threshold) else threshold,
+                None if np.isnan(explained_variance) else explained_variance)
+
+    def is_fresh(self):
+        '''Whether the publisher refreshed the heartbeat of this segment within stale_after seconds'''
+        return time.time() - HEARTBEAT.unpack_from(self.segment, HEARTBEAT_OFFSET)[0] <= self.stale_after
+
+    @classmethod
+    def publish(cls, gallery, db_name, stale_after=10.0):
+        '''
+            Writes a gallery into a new segment and makes it the current one for the database.
+            :param gallery: UserGallery (or subclass) to share, its float32 vectors are published
+            :param db_name: database the gallery was loaded from
+            :param stale_after: seconds without heartbeat() after which processes stop using the segment
+            :return: version number of the published segment
+        '''
+        pointer = shared_gallery_path(db_name)
+        current = cls.read_pointer(pointer)
+        version = current["version"] + 1 if current is not None else 1
+
+        encoded = [str(name).encode("utf-8") for name in gallery.names]
+        name_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+        projection = gallery.projection
+        source_dimension = projection.source_dimension if projection is not None else 0
+
+        values = {
+            "ids": gallery.ids, "vectors": gallery.vectors, "norms": gallery.norms, "spreads": gallery.spreads,
+            "template_owners": gallery.template_owners, "templates": gallery.templates,
+            "template_starts": gallery.template_starts, "template_counts": gallery.template_counts,
+            "name_offsets": name_offsets, "name_bytes": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        }
+        if projection is not None:
+            values.update(mean=projection.mean, scale=projection.scale, components=projection.components)
+
+        header = HEADER.pack(
+            MAGIC, LAYOUT_VERSION, 0, version, gallery.revision, len(gallery), gallery.dimension,
+            len(gallery.templates), int(name_offsets[-1]), source_dimension,
+            projection.version if projection is not None else 0,
+            np.nan if projection is None or projection.threshold is None else projection.threshold,
+            np.nan if projection is None or projection.explained_variance is None else projection.explained_variance,
+            stale_after, time.time())
+        layout, size = segment_layout(len(gallery), gallery.dimension, len(gallery.templates),
+                                      int(name_offsets[-1]), source_dimension)
+
+        # A fresh random name that must not exist yet, so nobody can prepare the file in advance
+        path = os.path.join(segment_directory(), f"{segment_prefix(db_name)}_{version}_{secrets.token_hex(8)}")
+        with Metrics.span("gallery_publish"):
+            descriptor = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_NOFOLLOW", 0), 0o600)
+            try:
+                os.ftruncate(descriptor, size)
+                mapped = mmap.mmap(descriptor, size)
+            finally:
+                os.close(descriptor)
+            mapped[:HEADER.size] = header
+            for name, dtype, shape, offset in layout:
+                target = np.frombuffer(mapped, dtype, int(np.prod(shape)), offset).reshape(shape)
+                target[...] = values[name]
+                del target
+            mapped.flush()
+
+            temp_path = f"{pointer}.tmp"
+            with open(temp_path, "w") as file:
+                json.dump({"segment": path, "version": version, "revision": int(gallery.revision)}, file)
+            os.replace(temp_path, pointer)
+
+        previous = cls.publishing.get(os.path.abspath(db_name))
+        cls.publishing[os.path.abspath(db_name)] = mapped
+        if previous is not None:
+            previous.close()
+        # Attached processes keep their mapping of older segments after the files are removed
+        cls.remove_segments(db_name, keep=path)
+        return version
+
+    @classmethod
+    def heartbeat(cls, db_name):
+        '''Marks the segment this process published last for the database as still maintained'''
+        mapped = cls.publishing.get(os.path.abspath(db_name))
+        if mapped is not None:
+            HEARTBEAT.pack_into(mapped, HEARTBEAT_OFFSET, time.time())
+
+    @classmethod
+    def unpublish(cls, db_name):
+        '''Removes the pointer and all segments of a database, attached processes keep what they mapped'''
+        try:
+            os.remove(shared_gallery_path(db_name))
+        except FileNotFoundError:
+            pass
+        mapped = cls.publishing.pop(os.path.abspath(db_name), None)
+        if mapped is not None:
+            mapped.close()
+        cls.remove_segments(db_name)
+
+    @staticmethod
+    def remove_segments(db_name, keep=None):
+        prefix = segment_prefix(db_name)
+        directory = segment_directory()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith(prefix + "_") and path != keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Still mapped on systems that refuse to delete mapped files, removed on a later publish
+                    pass
+
+    @staticmethod
+    def read_pointer(pointer):
+        try:
+            with open(pointer, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @classmethod
+    def attach(cls, db_manager):
+        '''
+            Returns the gallery currently published for a database, or None when none is published
+            or its publisher stopped refreshing the heartbeat.
+            The segment is mapped again only when the publisher pointed to a new version.
+        '''
+        pointer = shared_gallery_path(db_manager.db_name)
+        key = os.path.abspath(pointer)
+        for _ in range(3):
+            try:
+                status = os.stat(pointer)
+            except FileNotFoundError:
+                return None
+
+            with cls.attached_lock:
+                cached = cls.attached.get(key)
+                # The pointer is replaced on every publish, so a new inode means a new version
+                modified = (status.st_ino, status.st_mtime_ns)
+                if cached is not None and cached[0] == modified:
+                    gallery = cached[1]
+                else:
+                    current = cls.read_pointer(pointer)
+                    if current is None:
+                        return None
+                    try:
+                        with Metrics.span("gallery_attach"):
+                            gallery = cls.open_segment(current["segment"], current["version"], db_manager.db_name)
+                    except FileNotFoundError:
+                        # Replaced by a newer version between reading the pointer and opening the segment
+                        continue
+                    cls.attached[key] = (modified, gallery)
+
+            if not gallery.is_fresh():
+                Metrics.increment("shared_gallery_stale")
+                return None
+            return gallery
+        return None
+
+    @classmethod
+    def open_segment(cls, path, version, db_name):
+        '''Maps a published segment read-only after checking where it is, who owns it and its version'''
+        directory, name = os.path.split(path)
+        if directory != segment_directory() or not name.startswith(segment_prefix(db_name) + "_"):
+            raise PermissionError(f"{path} is not a shared gallery segment of {db_name}.")
+
+        descriptor = os.open(path, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        try:
+            check_private(descriptor, path)
+            mapped = mmap.mmap(descriptor, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(descriptor)
+        header = HEADER.unpack_from(mapped)
+        if header[0] != MAGIC or header[1] != LAYOUT_VERSION or header[3] != version:
+            mapped.close()
+            raise ValueError(f"Shared gallery segment {path} is not version {version} of a compatible gallery.")
+        return cls(mapped, header)
@@ -1,7 +1,5 @@
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QLabel, QPushButton
-from RegisterScreen import RegisterScreen
-from CameraApp import CameraApp
 
 class StartScreen(QWidget):
     '''This class is responsible for displaying the start screen'''
@@ -49,11 +47,23 @@ class StartScreen(QWidget):
         self.authorize_button.clicked.connect(self.show_authorize)
         layout.addWidget(self.authorize_button, alignment=Qt.AlignCenter)
 
+        self.status_label = QLabel("Loading face recognition models...", self)
+        self.status_label.setAlignment(Qt.AlignCenter)
+        self.status_label.setStyleSheet("font-size: 12px; color: gray;")
+        layout.addWidget(self.status_label, alignment=Qt.AlignCenter)
+
         self.setLayout(layout)
 
+    def on_models_ready(self, success, message):
+        '''Show the result of the background model warm-up'''
+        self.status_label.setText(message)
+        if not success:
+            self.status_label.setStyleSheet("font-size: 12px; color: red;")
+
     def show_register(self):
         '''This method switches to the registration screen'''
         if not hasattr(self.stacked_widget, 'register_window'):
+            from RegisterScreen import RegisterScreen
             self.stacked_widget.register_window = RegisterScreen(self.stacked_widget)
             self.stacked_widget.addWidget(self.stacked_widget.register_window)
         self.stacked_widget.setCurrentWidget(self.stacked_widget.register_window)
@@ -61,6 +71,7 @@ class StartScreen(QWidget):
     def show_authorize(self):
         '''This method switches to the authorization screen'''
         if not hasattr(self.stacked_widget, 'camera_app'):
+            from CameraApp import CameraApp
             self.stacked_widget.camera_app = CameraApp(self.stacked_widget)
             self.stacked_widget.addWidget(self.stacked_widget.camera_app)
         self.stacked_widget.setCurrentWidget(self.stacked_widget.camera_app)
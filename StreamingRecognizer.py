@@ -0,0 +1,144 @@
+import time
+from collections import defaultdict
+import numpy as np
+from FaceExceptions import NoFaceDetectedException, MultipleFacesDetectedException, LowQualityFrameException
+from FrameQualityGate import FrameQualityGate
+from Metrics import Metrics
+
+class StreamingRecognizer:
+    '''Identifies a user from consecutive camera frames, stopping as soon as the evidence is convincing.
+
+    Every frame with exactly one face adds the distances of its closest candidates to the evidence.
+    A candidate gets a vote when it is the nearest user of a frame and below the match threshold.
+    Recognition ends early once the leading candidate has enough votes and agreement, otherwise
+    when the frame budget or the timeout runs out.
+    '''
+
+    def __init__(self, user_search, max_frames=15, timeout=3.0, required_votes=3, min_agreement=0.6, top_k=3,
+                 track=True, quality_gate=True):
+        self.user_search = user_search
+        self.user_identification = user_search.user_identification
+        self.threshold = user_search.distance_threshold
+        self.max_frames = max_frames
+        self.timeout = timeout
+        self.required_votes = required_votes
+        self.min_agreement = min_agreement
+        self.top_k = top_k
+        # Consecutive frames show the same face, so it is tracked instead of detected on every frame
+        self.tracker = self.user_identification.create_tracker() if track else None
+        # Blurred, badly lit and turned-away frames are skipped before they cost a detection
+        self.quality_gate = FrameQualityGate() if quality_gate else None
+        self.reset()
+
+    def reset(self):
+        '''Forget all evidence collected so far'''
+        self.frames = 0
+        self.faces = 0
+        self.rejected = defaultdict(int)
+        self.votes = defaultdict(int)
+        self.distances = defaultdict(list)
+        self.users = {}
+        self.started = time.perf_counter()
+        self.match_threshold = self.threshold
+        if self.tracker is not None:
+            self.tracker.reset()
+
+    def add_frame(self, frame):
+        '''
+            Extract features from one frame and add its candidates to the evidence.
+            :param frame: BGR camera frame
+            :return: True when the evidence is already convincing
+        '''
+        self.frames += 1
+        Metrics.increment("stream_frames")
+        try:
+            feature_vector = self.user_identification.extract_feature_vector(frame, self.tracker, self.quality_gate)
+        except NoFaceDetectedException:
+            self.rejected["no_face"] += 1
+            return False
+        except MultipleFacesDetectedException:
+            self.rejected["multiple_faces"] += 1
+            return False
+        except LowQualityFrameException as e:
+            self.rejected[e.reason] += 1
+            return False
+
+        self.faces += 1
+        gallery = self.user_search.get_gallery()
+        self.match_threshold = gallery.match_threshold(self.threshold)
+        candidates = gallery.top_k(feature_vector, self.top_k)
+        for user, distance in candidates:
+            self.users[user[0]] = user
+            self.distances[user[0]].append(distance)
+
+        if candidates and candidates[0][1] < self.match_threshold:
+            self.votes[candidates[0][0][0]] += 1
+
+        return self.is_confident()
+
+    def leader(self):
+        '''Return the id of the candidate with most votes, ties broken by median distance'''
+        if not self.votes:
+            return None
+        return min(self.votes, key=lambda user_id: (-self.votes[user_id], np.median(self.distances[user_id])))
+
+    def is_confident(self):
+        '''Check whether the leading candidate has enough votes and agreement to stop early'''
+        leader = self.leader()
+        if leader is None:
+            return False
+        return self.votes[leader] >= self.required_votes and self.votes[leader] / self.faces >= self.min_agreement
+
+    def decision(self):
+        '''
+            Decide on the evidence collected so far.
+            :return: closest matched user and their median distance, or None
+        '''
+        leader = self.leader()
+        if leader is None or self.votes[leader] / self.faces < self.min_agreement:
+            return None
+
+        distance = float(np.median(self.distances[leader]))
+        if distance >= self.match_threshold:
+            return None
+        return self.users[leader], distance
+
+    def statistics(self, reason):
+        '''Summarize the recognition run'''
+        return {
+            "reason": reason,
+            "frames": self.frames,
+            "faces": self.faces,
+            "rejected": dict(self.rejected),
+            "votes": {self.users[user_id][1]: votes for user_id, votes in self.votes.items()},
+            "elapsed": time.perf_counter() - self.started,
+        }
+
+    def recognize(self, camera_view, should_stop=None):
+        '''
+            Run recognition on new frames from the camera until a decision is reached.
+            :param camera_view: CameraView providing frames, ideally a threaded one
+            :param should_stop: optional callable returning True to abort early
+            :return: (decision, statistics) where decision is as returned by decision()
+        '''
+        self.reset()
+        deadline = self.started + self.timeout
+        sequence = 0
+
+        while self.frames < self.max_frames:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return self.decision(), self.statistics("timeout")
+            if should_stop is not None and should_stop():
+                return None, self.statistics("cancelled")
+
+            frame, sequence, _ = camera_view.wait_for_frame(sequence, remaining)
+            if frame is None:
+                continue
+
+            # The ring buffer slot may be reused while the frame is being processed
+            if self.add_frame(frame.copy()):
+                Metrics.increment("stream_early_exits")
+                return self.decision(), self.statistics("confident")
+
+        return self.decision(), self.statistics("frame_budget")
@@ -0,0 +1,345 @@
+import numpy as np
+
+
+class UserGallery:
+    '''Keeps all enrolled feature vectors in one contiguous float32 matrix for vectorized search.
+
+    With templates, the matrix holds each user's centroid and every query runs in two passes:
+    users are ranked by the lower bound centroid distance - spread, then the refine_candidates
+    best are compared with each of their templates and matched by their closest template.
+
+    With a FeatureProjection, the gallery holds projected vectors and templates, and probes are
+    projected on the way in, so callers can keep passing raw feature vectors.
+    '''
+
+    refine_candidates = 8
+
+    def __init__(self, ids, names, vectors, revision=0, spreads=None, templates=None, projection=None):
+        self.revision = revision
+        self.projection = projection
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.names = np.asarray(names, dtype=object)
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+        if self.vectors.ndim != 2:
+            raise ValueError("Gallery vectors must form a 2-dimensional matrix.")
+        if not (len(self.ids) == len(self.names) == self.vectors.shape[0]):
+            raise ValueError("Gallery ids, names and vectors must have the same length.")
+
+        self.spreads = np.zeros(len(self.ids), dtype=np.float32) if spreads is None \
+            else np.asarray(spreads, dtype=np.float32)
+
+        # Rows are kept sorted by id so template blocks and index results can be located with searchsorted
+        if len(self.ids) > 1 and not np.all(self.ids[1:] > self.ids[:-1]):
+            order = np.argsort(self.ids, kind='stable')
+            self.ids, self.names, self.spreads = self.ids[order], self.names[order], self.spreads[order]
+            self.vectors = np.ascontiguousarray(self.vectors[order])
+
+        owners, matrix = templates if templates is not None else (np.empty(0, dtype=np.int64), None)
+        owners = np.asarray(owners, dtype=np.int64)
+        if matrix is None or len(owners) == 0:
+            matrix = np.empty((0, self.vectors.shape[1]), dtype=np.float32)
+        elif len(owners) > 1 and not np.all(owners[1:] >= owners[:-1]):
+            order = np.argsort(owners, kind='stable')
+            owners, matrix = owners[order], matrix[order]
+        self.template_owners = owners
+        self.templates = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.template_starts = np.searchsorted(owners, self.ids, 'left')
+        self.template_counts = np.searchsorted(owners, self.ids, 'right') - self.template_starts
+
+        self.norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+
+    @classmethod
+    def from_users(cls, users, dimension=None):
+        '''
+            Builds a gallery from database rows.
+            :param users: iterable of (id, name, feature_vector) rows, vectors as strings or arrays
+            :param dimension: expected vector length, used when there are no users
+            :return: UserGallery holding all users
+        '''
+        ids = []
+        names = []
+        vectors = []
+        for user_id, name, feature_vector in users:
+            ids.append(user_id)
+            names.append(name)
+            vectors.append(cls.parse_vector(feature_vector))
+
+        if vectors:
+            lengths = {len(vector) for vector in vectors}
+            if len(lengths) > 1:
+                raise ValueError("Vectors are not the same size.")
+            matrix = np.vstack(vectors)
+        else:
+            matrix = np.empty((0, dimension or 0), dtype=np.float32)
+
+        return cls(ids, names, matrix)
+
+    @classmethod
+    def from_database(cls, db_manager, projection=None, **options):
+        '''
+            Builds a gallery from all users stored by the given DatabaseManager.
+            :param projection: optional FeatureProjection applied to the stored vectors
+            :param options: further constructor arguments, e.g. the storage of a QuantizedGallery
+        '''
+        # Read the revision first: changes written in between are simply applied again by refresh()
+        revision = db_manager.get_revision()
+        ids, names, matrix = db_manager.get_feature_matrix()
+        spreads, templates = db_manager.get_spreads(), db_manager.get_templates()
+        if projection is not None:
+            matrix, spreads, templates = projection.project_rows(ids, matrix, *templates)
+        return cls(ids, names, matrix, revision, spreads, templates, projection, **options)
+
+    def refresh(self, db_manager):
+        '''
+            Brings the gallery up to date with the users changed since it was loaded.
+            :param db_manager: DatabaseManager the gallery was loaded from
+            :return: this gallery when nothing changed, otherwise a new, updated gallery
+        '''
+        changes = db_manager.get_changes(self.revision)
+        if changes["revision"] == self.revision:
+            return self
+        return self.apply_changes(changes)
+
+    def apply_changes(self, changes):
+        '''
+            Returns a new gallery with changed users replaced, new users appended and deleted users removed.
+            The gallery itself is never modified, so searches running on it stay consistent.
+            :param changes: dictionary returned by DatabaseManager.get_changes()
+        '''
+        changed_ids = np.asarray(changes["ids"], dtype=np.int64)
+        removed = np.concatenate([changed_ids, np.asarray(changes["deleted"], dtype=np.int64)])
+        keep = ~np.isin(self.ids, removed)
+        vectors = changes["vectors"]
+        spreads = changes.get("spreads")
+        owners, templates = changes.get("templates", (np.empty(0, dtype=np.int64), None))
+        if self.projection is not None and len(changed_ids):
+            vectors, spreads, (owners, templates) = self.projection.project_rows(
+                changed_ids, vectors, owners, templates)
+        if not keep.any():
+            return self.derive(changed_ids, changes["names"], vectors, changes["revision"], spreads,
+                               (owners, templates))
+        if len(changed_ids) and vectors.shape[1] != self.dimension:
+            raise ValueError("Vectors are not the same size.")
+
+        if spreads is None:
+            spreads = np.zeros(len(changed_ids), dtype=np.float32)
+        if templates is None or len(owners) == 0:
+            owners, templates = np.empty(0, dtype=np.int64), np.empty((0, self.dimension), dtype=np.float32)
+        kept_templates = ~np.isin(self.template_owners, removed)
+
+        return self.derive(
+            np.concatenate([self.ids[keep], changed_ids]),
+            np.concatenate([self.names[keep], np.asarray(changes["names"], dtype=object)]),
+            np.concatenate([self.vectors[keep], vectors.reshape(len(changed_ids), self.dimension)]),
+            changes["revision"],
+            np.concatenate([self.spreads[keep], spreads]),
+            (np.concatenate([self.template_owners[kept_templates], owners]),
+             np.concatenate([self.templates[kept_templates], templates.reshape(len(owners), self.dimension)])),
+        )
+
+    def derive(self, ids, names, vectors, revision, spreads, templates):
+        '''Builds a gallery of the same kind and settings from new rows, used by apply_changes()'''
+        return UserGallery(ids, names, vectors, revision, spreads, templates, self.projection)
+
+    @staticmethod
+    def parse_vector(feature_vector):
+        '''Converts a comma-separated string, list or array into a float32 vector.'''
+        if isinstance(feature_vector, str):
+            feature_vector = feature_vector.split(",")
+        return np.asarray(feature_vector, dtype=np.float32).ravel()
+
+    def project(self, probes):
+        '''
+            Converts one probe or a matrix of probes to float32 and projects them if the gallery is projected.
+            Probes that are already projected are returned unchanged.
+        '''
+        if isinstance(probes, str):
+            probes = self.parse_vector(probes)
+        probes = np.asarray(probes, dtype=np.float32)
+        if self.projection is not None and probes.shape[-1] == self.projection.source_dimension:
+            probes = self.projection.transform(probes)
+        return probes
+
+    def match_threshold(self, default):
+        '''Returns the calibrated threshold of the gallery's projection, or default for raw feature vectors'''
+        if self.projection is not None and self.projection.threshold is not None:
+            return self.projection.threshold
+        return default
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def dimension(self):
+        return self.vectors.shape[1]
+
+    def memory_usage(self):
+        '''Bytes of the arrays scanned by every query and of all vector data held by the gallery'''
+        search = self.vectors.nbytes + self.norms.nbytes
+        return {"search": search, "total": search + self.templates.nbytes + self.spreads.nbytes}
+
+    def _refines(self):
+        '''Whether candidates from the full scan must be re-ranked by refine() before they are reported'''
+        return len(self.templates) > 0
+
+    def distances(self, probe):
+        '''
+            Calculates the Euclidean distance between the probe and every enrolled vector.
+            :param probe: feature vector of the current user
+            :return: array of distances, one per enrolled user
+        '''
+        probe = self.project(self.parse_vector(probe))
+        if probe.shape[0] != self.dimension:
+            raise ValueError("Vectors are not the same size.")
+
+        difference = self.vectors - probe
+        return np.sqrt(np.einsum('ij,ij->i', difference, difference))
+
+    def batch_distances(self, probes):
+        '''
+            Calculates the distance matrix between many probes and the whole gallery at once.
+            :param probes: 2-dimensional array of feature vectors, one per row
+            :return: (number of probes, number of users) array of distances
+        '''
+        probes = self.project(np.atleast_2d(np.asarray(probes, dtype=np.float32)))
+        if probes.shape[1] != self.dimension:
+            raise ValueError("Vectors are not the same size.")
+
+        probe_norms = np.einsum('ij,ij->i', probes, probes)
+        squared = probe_norms[:, None] + self.norms[None, :] - 2.0 * (probes @ self.vectors.T)
+        np.maximum(squared, 0.0, out=squared)
+        return np.sqrt(squared)
+
+    def nearest(self, probe, threshold=None):
+        '''
+            Finds the closest enrolled user.
+            :param probe: feature vector of the current user
+            :param threshold: distances at or above this value are treated as no match
+            :return: ((id, name), distance) or None
+        '''
+        if len(self) == 0:
+            return None
+
+        probe = self.project(self.parse_vector(probe))
+        distances = self.distances(probe)
+        if not self._refines():
+            index = int(np.argmin(distances))
+            return self._match(index, distances[index], threshold)
+
+        return self.nearest_among(probe, self._candidates(distances, 1), threshold)
+
+    def nearest_among(self, probe, rows, threshold=None):
+        '''
+            Finds the user with the closest template among candidate rows, e.g. rows found by an index.
+            :return: ((id, name), distance) or None, see nearest()
+        '''
+        if len(rows) == 0:
+            return None
+        rows, refined = self.refine(probe, rows, 1)
+        return self._match(rows[0], refined[0], threshold)
+
+    def top_k(self, probe, k):
+        '''
+            Finds the k closest enrolled users.
+            :param probe: feature vector of the current user
+            :param k: number of candidates to return
+            :return: list of ((id, name), distance) sorted by distance
+        '''
+        probe = self.project(self.parse_vector(probe))
+        distances = self.distances(probe)
+        if not self._refines():
+            return [self._match(i, distances[i]) for i in self._smallest(distances, k)]
+
+        rows, refined = self.refine(probe, self._candidates(distances, k), k)
+        return [self._match(row, distance) for row, distance in zip(rows, refined)]
+
+    def batch_nearest(self, probes, threshold=None):
+        '''Finds the closest enrolled user for every probe, see nearest().'''
+        if len(self) == 0:
+            return [None] * len(np.atleast_2d(probes))
+
+        probes = self.project(np.atleast_2d(np.asarray(probes, dtype=np.float32)))
+        if self._refines():
+            return [self.nearest_among(probe, self._candidates(row, 1), threshold)
+                    for probe, row in zip(probes, self.batch_distances(probes))]
+
+        indices = np.argmin(self.batch_distances(probes), axis=1)
+        distances = self._exact_distances(probes, indices[:, None])[:, 0]
+        return [self._match(index, distance, threshold) for index, distance in zip(indices, distances)]
+
+    def batch_top_k(self, probes, k):
+        '''Finds the k closest enrolled users for every probe, see top_k().'''
+        probes = self.project(np.atleast_2d(np.asarray(probes, dtype=np.float32)))
+        results = []
+        for probe, row in zip(probes, self.batch_distances(probes)):
+            if self._refines():
+                rows, refined = self.refine(probe, self._candidates(row, k), k)
+                results.append([self._match(index, distance) for index, distance in zip(rows, refined)])
+                continue
+            candidates = self._smallest(row, k)
+            exact = self._exact_distances(probe[None, :], candidates[None, :])[0]
+            order = np.argsort(exact, kind='stable')
+            results.append([self._match(candidates[i], exact[i]) for i in order])
+        return results
+
+    def rows_of(self, user_ids):
+        '''Returns the gallery rows of the given user ids, skipping ids that are not in the gallery'''
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.ids, user_ids), max(len(self.ids) - 1, 0))
+        return rows[self.ids[rows] == user_ids] if len(self.ids) else rows[:0]
+
+    def _candidates(self, distances, k):
+        '''Returns the rows with the smallest lower bound on their closest template distance.'''
+        return self._smallest(distances - self.spreads, max(k, self.refine_candidates))
+
+    def refine(self, probe, rows, k):
+        '''
+            Compares the probe with every template of the candidate users.
+            Users without templates are compared with their centroid instead.
+            :param probe: feature vector of the current user
+            :param rows: candidate gallery rows
+            :param k: number of users to return
+            :return: (rows, distances) of the k users with the closest template, sorted by distance
+        '''
+        probe = self.project(self.parse_vector(probe))
+        rows = np.asarray(rows, dtype=np.int64)
+        refined = self._exact_distances(probe[None, :], rows[None, :])[0]
+
+        counts = self.template_counts[rows]
+        has_templates = counts > 0
+        if has_templates.any():
+            offsets = np.cumsum(counts) - counts
+            template_rows = np.repeat(self.template_starts[rows] - offsets, counts) + np.arange(counts.sum())
+            difference = self.templates[template_rows] - probe
+            template_distances = np.sqrt(np.einsum('ij,ij->i', difference, difference))
+            refined[has_templates] = np.minimum.reduceat(template_distances, offsets[has_templates])
+
+        order = np.argsort(refined, kind='stable')[:k]
+        return rows[order], refined[order]
+
+    def _exact_distances(self, probes, indices):
+        '''Recomputes distances directly for selected (probe, candidate) pairs.
+
+        The expanded form used by batch_distances() loses precision for near matches,
+        so reported distances are always taken from the plain difference.
+        '''
+        difference = self.vectors[indices] - probes[:, None, :]
+        return np.sqrt(np.einsum('ijk,ijk->ij', difference, difference))
+
+    def _smallest(self, distances, k):
+        '''Returns indices of the k smallest distances in ascending order.'''
+        k = min(k, len(distances))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if k < len(distances):
+            candidates = np.argpartition(distances, k - 1)[:k]
+        else:
+            candidates = np.arange(len(distances))
+        return candidates[np.argsort(distances[candidates], kind='stable')]
+
+    def _match(self, index, distance, threshold=None):
+        distance = float(distance)
+        if threshold is not None and distance >= threshold:
+            return None
+        return (int(self.ids[index]), self.names[index]), distance
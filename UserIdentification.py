@@ -1,106 +1,81 @@
-from itertools import combinations
 import cv2
-import dlib
 import numpy as np
-from DatabaseManager import DatabaseManager
-from RegisterScreen import NoFaceDetectedException, MultipleFacesDetectedException
+from LandmarkFeatures import LandmarkFeatures
+from FaceTracker import FaceTracker
+from Metrics import Metrics
+from ModelRegistry import ModelRegistry
+from FaceExceptions import NoFaceDetectedException, MultipleFacesDetectedException
 
 class UserIdentification:
     '''Handles facial recognition and identification using Dlib landmarks'''
 
+    # Larger images are downscaled to this size before detection, landmarks are in the downscaled coordinates
+    max_dimension = 800
+
     def __init__(self):
-        self.detector = dlib.get_frontal_face_detector()
-        self.predictor = dlib.shape_predictor("shape_predictor_68_face_landmarks.dat")
-        self.db_manager = DatabaseManager()
+        self.detector = ModelRegistry.get_detector()
+        self.predictor = ModelRegistry.get_predictor()
 
     def preprocess_image(self, image):
         '''Preprocesses the image for landmark detection'''
-        height, width = image.shape[:2]
-        max_dimension = 800
-        if max(height, width) > max_dimension:
-            scale = max_dimension / max(height, width)
-            image = cv2.resize(image, (int(width * scale), int(height * scale)))
-
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        return gray
-
-    def extract_feature_vector(self, image):
-        '''Extracts an extended facial feature vector based on normalized landmark distances and angles'''
+        with Metrics.span("preprocess"):
+            height, width = image.shape[:2]
+            if max(height, width) > self.max_dimension:
+                scale = self.max_dimension / max(height, width)
+                image = cv2.resize(image, (int(width * scale), int(height * scale)))
+
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            return gray
+
+    def create_tracker(self, **options):
+        '''Returns a FaceTracker for one stream of consecutive frames, see FaceTracker for the options'''
+        return FaceTracker(self.detector, **options)
+
+    def detect_faces(self, gray, tracker=None):
+        '''Detects faces in a preprocessed frame, or follows them with the tracker of a frame stream'''
+        if tracker is not None:
+            return tracker.update(gray)
+        with Metrics.span("detect"):
+            return self.detector(gray)
+
+    def extract_landmarks(self, image, tracker=None, quality_gate=None):
+        '''
+            Detects exactly one face and returns its 68 landmarks as a (68, 2) array.
+            :param quality_gate: optional FrameQualityGate, blurred or badly exposed frames are rejected
+                                 before detection and turned heads before the landmarks are returned
+        '''
         gray = self.preprocess_image(image)
+        if quality_gate is not None:
+            quality_gate.check_frame(gray)
 
-        faces = self.detector(gray)
+        faces = self.detect_faces(gray, tracker)
         if len(faces) == 0:
+            Metrics.increment("no_face_frames")
             raise NoFaceDetectedException("No faces detected.")
         elif len(faces) > 1:
+            Metrics.increment("multiple_face_frames")
             raise MultipleFacesDetectedException("Multiple faces detected.")
 
-        face = faces[0]
-        landmarks = self.predictor(gray, face)
-
-        def euclidean_distance(point1, point2):
-            return np.linalg.norm(np.array(point1) - np.array(point2))
-
-        def calculate_angle(pointA, pointB, pointC):
-            BA = np.array(pointA) - np.array(pointB)
-            BC = np.array(pointC) - np.array(pointB)
-            cosine_angle = np.dot(BA, BC) / (np.linalg.norm(BA) * np.linalg.norm(BC))
-            angle = np.arccos(cosine_angle)
-            return np.degrees(angle)
-
-        feature_vector = []
-
-        selected_points = [
-            1, 2, 3, 4, 5,  # Jawline points
-            36, 39,  # Left eye corners
-            42, 45,  # Right eye corners
-            31, 35,  # Nose width
-            48, 54,  # Mouth corners
-            57, 8,  # Bottom of lower lip and chin
-            17, 26,  # Left and right eyebrows
-            19, 24  # Center points of left and right eyebrows
-        ]
-
-        left_eye_point = (landmarks.part(36).x, landmarks.part(36).y)
-        right_eye_point = (landmarks.part(45).x, landmarks.part(45).y)
-        reference_distance = euclidean_distance(left_eye_point, right_eye_point)
+        with Metrics.span("landmarks"):
+            points = LandmarkFeatures.to_array(self.predictor(gray, faces[0]))
+        if quality_gate is not None:
+            quality_gate.check_pose(points)
+        return points
 
-        for i, j in combinations(selected_points, 2):
-            point1 = (landmarks.part(i).x, landmarks.part(i).y)
-            point2 = (landmarks.part(j).x, landmarks.part(j).y)
-            distance = euclidean_distance(point1, point2)
-            normalized_distance = distance / reference_distance
-            feature_vector.append(normalized_distance)
-
-        angle_triplets = [
-            (36, 39, 42),  # Left eye region
-            (42, 45, 36),  # Right eye region
-            (31, 30, 35),  # Nose region
-            (48, 51, 54),  # Mouth region
-            (0, 8, 16)  # Chin-jawline region
-        ]
-
-        for (a, b, c) in angle_triplets:
-            pointA = (landmarks.part(a).x, landmarks.part(a).y)
-            pointB = (landmarks.part(b).x, landmarks.part(b).y)
-            pointC = (landmarks.part(c).x, landmarks.part(c).y)
-            angle = calculate_angle(pointA, pointB, pointC)
-            feature_vector.append(angle)
+    def extract_feature_vector(self, image, tracker=None, quality_gate=None):
+        '''Extracts an extended facial feature vector based on normalized landmark distances and angles'''
+        points = self.extract_landmarks(image, tracker, quality_gate)
+        with Metrics.span("features"):
+            return LandmarkFeatures.compute(points).tolist()
 
-        return feature_vector
+    def extract_feature_vectors(self, images):
+        '''Extracts feature vectors for many images, computing the features in one batched pass'''
+        points = np.stack([self.extract_landmarks(image) for image in images])
+        with Metrics.span("features"):
+            return LandmarkFeatures.compute_batch(points)
 
-    def draw_landmarks(self, frame):
+    def draw_landmarks(self, frame, tracker=None):
         '''Detects landmarks on a single frame and returns the frame with landmarks'''
-        gray = self.preprocess_image(frame)
-        faces = self.detector(gray)
-
-        if len(faces) == 0:
-            raise NoFaceDetectedException("No faces detected.")
-        elif len(faces) > 1:
-            raise MultipleFacesDetectedException("Multiple faces detected.")
-
-        landmarks = self.predictor(gray, faces[0])
-        for n in range(68):
-            x = landmarks.part(n).x
-            y = landmarks.part(n).y
-            cv2.circle(frame, (x, y), 2, (0, 255, 0), -1)
+        for x, y in self.extract_landmarks(frame, tracker):
+            cv2.circle(frame, (int(x), int(y)), 2, (0, 255, 0), -1)
         return frame
@@ -1,15 +1,96 @@
+import os
+import threading
 import numpy as np
 from DatabaseManager import DatabaseManager
+from FeatureProjection import FeatureProjection
+from GalleryIndex import IVFIndex
+from Metrics import Metrics
+from SharedGallery import SharedGallery
+from UserGallery import UserGallery
 from UserIdentification import UserIdentification
 
 class UserSearch:
     '''Handles user search operations and identification.'''
 
-    def __init__(self, image):
+    # Threshold for raw feature vectors, a projected gallery uses the calibrated threshold of its projection
+    distance_threshold = 11
+    # Galleries with at least index_min_users users are searched through an approximate index,
+    # set index_class to None to always search exhaustively
+    index_class = IVFIndex
+    index_min_users = 100000
+    index_options = {"n_probe": 8, "rerank": 32}
+    # QuantizedGallery with {"storage": "int8"} scans a compact copy of the vectors and re-ranks exactly
+    gallery_class = UserGallery
+    gallery_options = {}
+    # Apply the projection fitted with fit_projection.py when one is stored next to the database
+    use_projection = True
+    # Search the gallery published by publish_gallery.py instead of loading a private copy,
+    # falling back to the database while nothing is published
+    use_shared_gallery = False
+
+    # Galleries shared by all searches of a process, keyed by database path
+    galleries = {}
+    galleries_lock = threading.Lock()
+
+    def __init__(self, image=None, gallery=None, user_identification=None):
         self.db_manager = DatabaseManager()
-        self.user_identification = UserIdentification()
-        user_vector = ",".join(map(str, self.user_identification.extract_feature_vector(image)))
-        self.nearest_user = self.find_nearest_user(user_vector)
+        self.user_identification = user_identification or UserIdentification()
+        self.gallery = gallery
+        self.nearest_user = None
+        if image is not None:
+            user_vector = self.user_identification.extract_feature_vector(image)
+            self.nearest_user = self.find_nearest_user(user_vector)
+
+    def get_gallery(self):
+        '''Returns the in-memory gallery, loading it from the database on first use.'''
+        if self.gallery is None:
+            self.gallery = self.load_gallery(self.db_manager)
+        return self.gallery
+
+    @classmethod
+    def load_gallery(cls, db_manager):
+        '''
+            Returns the process-wide gallery of a database, refreshed with the users changed since it was loaded.
+            Only the first call reads every user, later calls read the change log and the changed rows.
+            A gallery is read completely again when the projection stored next to the database changed.
+            With use_shared_gallery, the gallery published for the database is returned when there is one.
+            :param db_manager: DatabaseManager of the database
+        '''
+        if cls.use_shared_gallery:
+            try:
+                shared = SharedGallery.attach(db_manager)
+            except Exception as e:
+                print(f"Error: {e}")
+                shared = None
+            if shared is not None:
+                return shared
+        return cls.load_private_gallery(db_manager)
+
+    @classmethod
+    def load_private_gallery(cls, db_manager):
+        '''Returns the gallery this process loads and refreshes itself from the database, see load_gallery()'''
+        key = os.path.abspath(db_manager.db_name)
+        projection = FeatureProjection.open(db_manager) if cls.use_projection else None
+        with cls.galleries_lock:
+            gallery = cls.galleries.get(key)
+            if gallery is None or gallery.projection is not projection:
+                with Metrics.span("gallery_load"):
+                    gallery = cls.gallery_class.from_database(db_manager, projection, **cls.gallery_options)
+            else:
+                with Metrics.span("gallery_refresh"):
+                    gallery = gallery.refresh(db_manager)
+            cls.galleries[key] = gallery
+        return gallery
+
+    def get_index(self):
+        '''Returns the approximate search index shared by this database, or None for small galleries.'''
+        gallery = self.get_gallery()
+        if self.index_class is None or len(gallery) < self.index_min_users:
+            return None
+        index = self.index_class.open(self.db_manager, gallery, **self.index_options)
+        if index.revision < gallery.revision:
+            index.sync(self.db_manager)
+        return index
 
     def find_nearest_user(self, feature_vector):
         '''
@@ -17,22 +98,40 @@ class UserSearch:
             :param feature_vector: feature vector of the current user
             :return closest matched user and the distance between theirs feature vectors
         '''
+        gallery = self.get_gallery()
+        index = self.get_index()
+        threshold = gallery.match_threshold(self.distance_threshold)
+        with Metrics.span("search"):
+            if index is None:
+                return gallery.nearest(feature_vector, threshold)
+            # The index holds the gallery's vectors, so it needs the probe in the same space
+            probe = gallery.project(feature_vector)
+            if len(gallery.templates) == 0:
+                return index.nearest(probe, threshold)
 
-        all_users = self.db_manager.get_all_users()
-        min_distance = float(999999999)
-        closest_user = None
+            # The index ranks users by centroid, their templates are compared by the gallery
+            candidates = index.search(probe, gallery.refine_candidates)
+            rows = gallery.rows_of([user[0] for user, _ in candidates])
+            return gallery.nearest_among(probe, rows, threshold)
 
-        for user in all_users:
-            user_feature_vector = user[2]
-            distance = self.calculate_euclidean_distance(feature_vector, user_feature_vector)
-            if distance < min_distance:
-                min_distance = distance
-                closest_user = user
+    def find_nearest_users(self, feature_vectors):
+        '''
+            Finds the nearest user for many feature vectors with a single gallery query.
+            :param feature_vectors: feature vectors, one per probe
+            :return: list with the closest matched user and distance (or None) per probe
+        '''
+        gallery = self.get_gallery()
+        with Metrics.span("batch_search"):
+            return gallery.batch_nearest(feature_vectors, gallery.match_threshold(self.distance_threshold))
 
-        if min_distance < 11:
-            return closest_user, min_distance
-        else:
-            return None
+    def find_top_users(self, feature_vector, k=5):
+        '''
+            Finds the k nearest users regardless of the match threshold.
+            :param feature_vector: feature vector of the current user
+            :param k: number of candidates to return
+            :return: list of users and distances sorted by distance
+        '''
+        return self.get_gallery().top_k(feature_vector, k)
 
     def calculate_euclidean_distance(self, vector_str1, vector_str2):
         '''
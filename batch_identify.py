@@ -0,0 +1,80 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from collections import Counter
+from BatchIdentifier import BatchIdentifier, iterate_sources
+from Metrics import Metrics
+from UserSearch import UserSearch
+
+FIELDS = ["source", "frame", "status", "user_id", "name", "distance", "error",
+          "extraction_ms", "search_ms", "latency_ms"]
+
+
+def write_results(records, output, output_format):
+    '''Writes result records as JSON lines or CSV and returns a count per status'''
+    statuses = Counter()
+    if output_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=FIELDS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+            statuses[record["status"]] += 1
+    else:
+        for record in records:
+            output.write(json.dumps(record) + "\n")
+            statuses[record["status"]] += 1
+    return statuses
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Identify faces in images and video files without the GUI.")
+    parser.add_argument("sources", nargs="+", help="image files, video files or directories")
+    parser.add_argument("--output", help="result file, .csv for CSV and anything else for JSON lines (default: stdout)")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="output format, overrides the file extension")
+    parser.add_argument("--db", default="user_identification.db", help="database file")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--queue-size", type=int, default=64, help="maximum number of decoded items waiting")
+    parser.add_argument("--frame-step", type=int, default=1, help="process every n-th video frame")
+    parser.add_argument("--quality-gate", action="store_true",
+                        help="skip blurred, badly exposed and turned-away frames before detection")
+    parser.add_argument("--shared-gallery", action="store_true",
+                        help="search the gallery published by publish_gallery.py instead of a private copy")
+    parser.add_argument("--metrics", help="write pipeline metrics here when done (.json or Prometheus text)")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        Metrics.enable()
+    UserSearch.use_shared_gallery = args.shared_gallery
+
+    output_format = args.format or ("csv" if args.output and args.output.lower().endswith(".csv") else "jsonl")
+    identifier = BatchIdentifier(db_name=args.db, workers=args.workers, queue_size=args.queue_size,
+                                 quality_gate=args.quality_gate)
+
+    start = time.perf_counter()
+    records = identifier.identify(iterate_sources(args.sources, args.frame_step))
+    try:
+        if args.output:
+            with open(args.output, "w", newline="", encoding="utf-8") as output:
+                statuses = write_results(records, output, output_format)
+        else:
+            statuses = write_results(records, sys.stdout, output_format)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        print("Identification stopped early, the results are incomplete.", file=sys.stderr)
+        return 1
+    finally:
+        if args.metrics:
+            Metrics.write(args.metrics)
+    elapsed = time.perf_counter() - start
+
+    total = sum(statuses.values())
+    details = ", ".join(f"{count} {status}" for status, count in sorted(statuses.items()))
+    print(f"Identified {total} items in {elapsed:.1f} s ({total / elapsed if elapsed else 0:.1f} items/s): {details}",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,359 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+import cv2
+import dlib
+import numpy as np
+from DatabaseManager import DatabaseManager, hash_password
+from GalleryIndex import IVFIndex
+from FeatureProjection import FeatureProjection
+from FrameQualityGate import FrameQualityGate
+from LandmarkFeatures import LandmarkFeatures
+from QuantizedGallery import QuantizedGallery
+from ModelRegistry import ModelRegistry
+from UserGallery import UserGallery
+from UserIdentification import UserIdentification
+from UserSearch import UserSearch
+
+
+def summarize(samples):
+    '''Turns a list of durations in seconds into millisecond statistics'''
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        "n": int(values.size),
+        "mean_ms": float(values.mean()),
+        "min_ms": float(values.min()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def measure(function, repeat, warmup=2):
+    '''Calls the function repeatedly and returns statistics of its wall-clock duration'''
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def load_images(image_dir, count=4, seed=0):
+    '''Loads sample images from a directory, or makes deterministic synthetic frames without one'''
+    if image_dir:
+        names = sorted(name for name in os.listdir(image_dir)
+                       if os.path.splitext(name)[1].lower() in {".jpg", ".jpeg", ".png", ".bmp"})
+        images = [cv2.imread(os.path.join(image_dir, name)) for name in names]
+        return [image for image in images if image is not None]
+
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 256, (480, 640, 3), dtype=np.uint8) for _ in range(count)]
+
+
+def benchmark_extraction(images, repeat):
+    '''Times every stage of feature extraction on the sample images'''
+    user_identification = UserIdentification()
+    results = {"model_load": ModelRegistry.load_stats()}
+
+    grays = [user_identification.preprocess_image(image) for image in images]
+    results["preprocess_image"] = measure(lambda: [user_identification.preprocess_image(image) for image in images], repeat)
+    quality_gate = FrameQualityGate()
+    results["quality_gate"] = measure(lambda: [quality_gate.measure_frame(gray) for gray in grays], repeat)
+    results["detector"] = measure(lambda: [user_identification.detector(gray) for gray in grays], repeat)
+
+    # Synthetic frames contain no face, so landmarks are predicted inside a fixed central box instead
+    boxes = []
+    for gray in grays:
+        faces = user_identification.detector(gray)
+        if len(faces) == 1:
+            boxes.append(faces[0])
+        else:
+            height, width = gray.shape
+            boxes.append(dlib.rectangle(width // 4, height // 4, 3 * width // 4, 3 * height // 4))
+    # Cost of following a face between detections, compare with "detector"
+    tracker = dlib.correlation_tracker()
+    tracker.start_track(grays[0], boxes[0])
+    results["tracker_update"] = measure(lambda: [tracker.update(gray) for gray in grays], repeat)
+    results["predictor"] = measure(
+        lambda: [user_identification.predictor(gray, box) for gray, box in zip(grays, boxes)], repeat)
+
+    points = [LandmarkFeatures.to_array(user_identification.predictor(gray, box)) for gray, box in zip(grays, boxes)]
+    results["feature_math"] = measure(lambda: [LandmarkFeatures.compute(p) for p in points], repeat)
+    results["feature_math_batch"] = measure(lambda: LandmarkFeatures.compute_batch(np.stack(points)), repeat)
+
+    def extract_all():
+        for image in images:
+            try:
+                user_identification.extract_feature_vector(image)
+            except Exception:
+                pass
+    results["extract_feature_vector"] = measure(extract_all, repeat)
+    results["images"] = len(images)
+    return results
+
+
+class NoIdentification:
+    '''Stands in for UserIdentification, the search benchmarks pass feature vectors and need no models'''
+
+
+def benchmark_search(gallery_sizes, repeat, dimension=176, seed=0):
+    '''
+        Times UserSearch.find_nearest_user and the UserGallery scans under it on synthetic galleries.
+        Galleries of at least UserSearch.index_min_users users are searched through the IVF index,
+        find_nearest_user_ivf forces the index at every size. Run it in a scratch_directory(), the
+        index files are written next to an empty database per size.
+    '''
+    rng = np.random.default_rng(seed)
+    results = {}
+    for size in gallery_sizes:
+        vectors = rng.random((size, dimension), dtype=np.float32)
+        gallery = UserGallery(np.arange(size), [f"user{i}" for i in range(size)], vectors)
+        probes = vectors[rng.integers(0, size, 64)] + rng.normal(0, 0.01, (64, dimension)).astype(np.float32)
+        probe_iter = iter(np.resize(probes, (6 * repeat + 12, dimension)))
+        threshold = UserSearch.distance_threshold
+
+        search = UserSearch(gallery=gallery, user_identification=NoIdentification())
+        search.db_manager = DatabaseManager(f"benchmark_search_{size}.db")
+        size_results = {}
+        index_min_users = UserSearch.index_min_users
+        UserSearch.index_min_users = 0
+        try:
+            start = time.perf_counter()
+            search.get_index()
+            size_results["index_build_seconds"] = time.perf_counter() - start
+            size_results["find_nearest_user_ivf"] = measure(lambda: search.find_nearest_user(next(probe_iter)), repeat)
+        finally:
+            UserSearch.index_min_users = index_min_users
+
+        size_results["find_nearest_user"] = measure(lambda: search.find_nearest_user(next(probe_iter)), repeat)
+        size_results["find_nearest_user_path"] = "exhaustive" if search.get_index() is None else "ivf"
+
+        # The exhaustive gallery scans alone, without the index lookup of UserSearch
+        size_results.update({
+            "gallery_nearest": measure(lambda: gallery.nearest(next(probe_iter), threshold), repeat),
+            "gallery_top_k_5": measure(lambda: gallery.top_k(next(probe_iter), 5), repeat),
+            "gallery_batch_nearest_64": measure(lambda: gallery.batch_nearest(probes, threshold),
+                                                max(repeat // 8, 3)),
+            "memory_bytes": int(gallery.vectors.nbytes),
+        })
+        results[str(size)] = size_results
+    return results
+
+
+def benchmark_index(gallery_sizes, repeat, n_probes=(1, 4, 8, 16, 32), dimension=176, seed=0):
+    '''Measures build time, query latency and recall@1 of the IVF index for several n_probe settings'''
+    rng = np.random.default_rng(seed)
+    results = {}
+    for size in gallery_sizes:
+        # Clustered vectors resemble real galleries better than uniform noise, which has no structure to index
+        centers = rng.random((max(size // 100, 1), dimension), dtype=np.float32) * 20
+        vectors = centers[rng.integers(0, len(centers), size)] + rng.normal(0, 1, (size, dimension)).astype(np.float32)
+        ids = np.arange(size)
+        gallery = UserGallery(ids, [f"user{i}" for i in range(size)], vectors)
+        probes = vectors[rng.integers(0, size, 64)] + rng.normal(0, 0.5, (64, dimension)).astype(np.float32)
+        expected = [match[0][0] for match in gallery.batch_nearest(probes)]
+
+        start = time.perf_counter()
+        index = IVFIndex().build(gallery.ids, gallery.names, gallery.vectors)
+        size_results = {"build_seconds": time.perf_counter() - start, "n_lists": index.n_lists}
+        for n_probe in n_probes:
+            probe_iter = iter(np.resize(probes, (repeat + 4, dimension)))
+            found = [index.search(probe, 1, n_probe=n_probe)[0][0][0] for probe in probes]
+            size_results[f"n_probe_{n_probe}"] = {
+                "recall_at_1": float(np.mean(np.equal(found, expected))),
+                "latency": measure(lambda: index.search(next(probe_iter), 1, n_probe=n_probe), repeat),
+            }
+        results[str(size)] = size_results
+    return results
+
+
+def benchmark_quantized(gallery_sizes, repeat, storages=("int8", "float16"), dimension=176, seed=0):
+    '''Compares memory, latency and recall@1 of quantized galleries with the exact float32 gallery'''
+    rng = np.random.default_rng(seed)
+    results = {}
+    for size in gallery_sizes:
+        centers = rng.random((max(size // 100, 1), dimension), dtype=np.float32) * 20
+        vectors = centers[rng.integers(0, len(centers), size)] + rng.normal(0, 1, (size, dimension)).astype(np.float32)
+        gallery = UserGallery(np.arange(size), [f"user{i}" for i in range(size)], vectors)
+        probes = vectors[rng.integers(0, size, 64)] + rng.normal(0, 0.5, (64, dimension)).astype(np.float32)
+        expected = [match[0][0] for match in gallery.batch_nearest(probes)]
+        probe_iter = iter(np.resize(probes, (repeat + 4, dimension)))
+
+        size_results = {"exact": {
+            "memory_bytes": gallery.memory_usage(),
+            "latency": measure(lambda: gallery.nearest(next(probe_iter)), repeat),
+        }}
+        for storage in storages:
+            start = time.perf_counter()
+            quantized = QuantizedGallery(gallery.ids, gallery.names, gallery.vectors, storage=storage)
+            build_seconds = time.perf_counter() - start
+            found = [match[0][0] for match in quantized.batch_nearest(probes)]
+            probe_iter = iter(np.resize(probes, (repeat + 4, dimension)))
+            size_results[storage] = {
+                "build_seconds": build_seconds,
+                "memory_bytes": quantized.memory_usage(),
+                "recall_at_1": float(np.mean(np.equal(found, expected))),
+                "latency": measure(lambda: quantized.nearest(next(probe_iter)), repeat),
+            }
+        results[str(size)] = size_results
+    return results
+
+
+def benchmark_projection(gallery_sizes, repeat, dimensions=(16, 32, 64), source_dimension=176, seed=0):
+    '''Compares memory, latency and agreement with the raw gallery of galleries projected to fewer dimensions'''
+    rng = np.random.default_rng(seed)
+    results = {}
+    for size in gallery_sizes:
+        # Correlated features on different scales, like the landmark distances and angles
+        mixing = rng.normal(0, 1, (24, source_dimension)).astype(np.float32)
+        scales = np.where(np.arange(source_dimension) >= source_dimension - 5, 30.0, 1.0).astype(np.float32)
+        vectors = (rng.normal(0, 1, (size, 24)).astype(np.float32) @ mixing) * scales
+        vectors += rng.normal(0, 0.1, vectors.shape).astype(np.float32) * scales
+        names = [f"user{i}" for i in range(size)]
+        gallery = UserGallery(np.arange(size), names, vectors)
+        noise = rng.normal(0, 0.1, (64, source_dimension)).astype(np.float32) * scales
+        probes = vectors[rng.integers(0, size, 64)] + noise
+        expected = [match[0][0] for match in gallery.batch_nearest(probes)]
+        probe_iter = iter(np.resize(probes, (repeat + 4, source_dimension)))
+
+        size_results = {"raw": {
+            "memory_bytes": gallery.memory_usage(),
+            "latency": measure(lambda: gallery.nearest(next(probe_iter)), repeat),
+        }}
+        for dimension in dimensions:
+            start = time.perf_counter()
+            projection = FeatureProjection.fit(vectors[:100000], dimension)
+            fit_seconds = time.perf_counter() - start
+            projected = UserGallery(np.arange(size), names, projection.transform(vectors), projection=projection)
+            found = [match[0][0] for match in projected.batch_nearest(probes)]
+            probe_iter = iter(np.resize(probes, (repeat + 4, source_dimension)))
+            size_results[f"dimension_{dimension}"] = {
+                "fit_seconds": fit_seconds,
+                "explained_variance": projection.explained_variance,
+                "threshold": projection.threshold,
+                "memory_bytes": projected.memory_usage(),
+                "agreement_at_1": float(np.mean(np.equal(found, expected))),
+                "latency": measure(lambda: projected.nearest(next(probe_iter)), repeat),
+            }
+        results[str(size)] = size_results
+    return results
+
+
+def benchmark_database(db_sizes, repeat, dimension=176, seed=0):
+    '''Times DatabaseManager operations, including the file encryption round trip, at several sizes'''
+    rng = np.random.default_rng(seed)
+    password_hash = hash_password("benchmark")
+    results = {"hash_password": measure(lambda: hash_password("benchmark"), max(repeat // 10, 3), warmup=0)}
+
+    for size in db_sizes:
+        db_name = f"benchmark_{size}.db"
+        manager = DatabaseManager(db_name)
+        manager.register_users((f"user{i}", password_hash, rng.random(dimension)) for i in range(size))
+
+        counter = iter(range(10 ** 9))
+        size_results = {
+            "file_bytes": os.path.getsize(db_name),
+            "decrypt_encrypt_file": measure(lambda: (manager.decrypt_file(), manager.encrypt_file()), repeat),
+            "user_exists": measure(lambda: manager.user_exists(f"user{size // 2}"), repeat),
+            "get_all_users": measure(manager.get_all_users, repeat),
+            "get_feature_matrix": measure(manager.get_feature_matrix, repeat),
+            "register_users_1": measure(
+                lambda: manager.register_users([(f"new{next(counter)}", password_hash, rng.random(dimension))]), repeat),
+        }
+
+        size_results["session_open_close"] = measure(
+            lambda: (DatabaseManager.open_session(db_name), DatabaseManager.close_session(db_name)), max(repeat // 4, 3))
+        session = DatabaseManager.open_session(db_name, flush_every=10 ** 9)
+        size_results["session_user_exists"] = measure(lambda: manager.user_exists(f"user{size // 2}"), repeat)
+        size_results["session_get_feature_matrix"] = measure(manager.get_feature_matrix, repeat)
+        size_results["session_register_users_1"] = measure(
+            lambda: manager.register_users([(f"new{next(counter)}", password_hash, rng.random(dimension))]), repeat)
+        gallery = UserGallery.from_database(manager)
+        size_results["session_gallery_refresh_unchanged"] = measure(lambda: gallery.refresh(manager), repeat)
+
+        def register_and_refresh():
+            manager.register_users([(f"new{next(counter)}", password_hash, rng.random(dimension))])
+            return gallery.refresh(manager)
+        size_results["session_register_and_gallery_refresh"] = measure(register_and_refresh, repeat)
+        size_results["session_flush"] = measure(session.flush, max(repeat // 4, 3), warmup=0)
+        DatabaseManager.close_session(db_name)
+
+        results[str(size)] = size_results
+    return results
+
+
+@contextmanager
+def scratch_directory():
+    '''Runs the block in a temporary working directory, benchmarks creating their own key and database
+    files keep them away from the real ones'''
+    working_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(working_dir)
+
+
+def parse_sizes(text):
+    return [int(value) for value in text.split(",") if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark extraction, search and database paths without a camera.")
+    parser.add_argument("--images", help="directory with sample face images (default: synthetic frames)")
+    parser.add_argument("--gallery-sizes", type=parse_sizes, default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--db-sizes", type=parse_sizes, default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=50, help="measured repetitions per benchmark")
+    parser.add_argument("--skip", action="append", default=[],
+                        choices=["extraction", "search", "index", "quantized", "projection", "database"])
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+    }
+
+    if "extraction" not in args.skip:
+        ModelRegistry.predictor_path = os.path.abspath(ModelRegistry.predictor_path)
+        report["extraction"] = benchmark_extraction(load_images(args.images), args.repeat)
+    if "search" not in args.skip:
+        with scratch_directory():
+            report["search"] = benchmark_search(args.gallery_sizes, args.repeat)
+    if "index" not in args.skip:
+        report["index"] = benchmark_index(args.gallery_sizes, args.repeat)
+    if "quantized" not in args.skip:
+        report["quantized"] = benchmark_quantized(args.gallery_sizes, args.repeat)
+    if "projection" not in args.skip:
+        report["projection"] = benchmark_projection(args.gallery_sizes, args.repeat)
+    if "database" not in args.skip:
+        with scratch_directory():
+            report["database"] = benchmark_database(args.db_sizes, args.repeat)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
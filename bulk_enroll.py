@@ -0,0 +1,126 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+from DatabaseManager import DatabaseManager, hash_password
+from FaceExceptions import NoFaceDetectedException, MultipleFacesDetectedException
+from UserIdentification import UserIdentification
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp"}
+
+user_identification = None
+
+
+def read_manifest(path):
+    '''Reads (name, password, image path) entries from a CSV file with name,password,image columns.
+    Several rows with the same name enroll each image as another template of that user.'''
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, newline="", encoding="utf-8") as file:
+        for row in csv.DictReader(file):
+            yield row["name"], row["password"], os.path.join(base_dir, row["image"])
+
+
+def read_directory(path, password):
+    '''Reads one entry per image in a directory, using the file name as the user name'''
+    for file_name in sorted(os.listdir(path)):
+        name, extension = os.path.splitext(file_name)
+        if extension.lower() in IMAGE_EXTENSIONS:
+            yield name, password, os.path.join(path, file_name)
+
+
+def init_worker():
+    '''Loads the face models once per worker process'''
+    global user_identification
+    user_identification = UserIdentification()
+
+
+def enroll_entry(entry):
+    '''
+        Extracts the feature vector of one manifest row.
+        :param entry: (name, password, image path)
+        :return: (name, password, image path, feature vector, error message)
+    '''
+    name, password, image_path = entry
+    try:
+        image = cv2.imread(image_path)
+        if image is None:
+            return name, password, image_path, None, "Could not read image."
+        feature_vector = user_identification.extract_feature_vector(image)
+    except (NoFaceDetectedException, MultipleFacesDetectedException) as e:
+        return name, password, image_path, None, f"{type(e).__name__}: {e}"
+    except Exception as e:
+        return name, password, image_path, None, f"Error: {e}"
+
+    return name, password, image_path, feature_vector, None
+
+
+def bulk_enroll(entries, db_name="user_identification.db", workers=None, overwrite=False, chunksize=4):
+    '''
+        Enrolls many users, extracting features and hashing passwords in a process pool.
+        :param entries: iterable of (name, password, image path)
+        :param db_name: database to write to, all rows are written in one transaction
+        :param workers: number of worker processes, defaults to the CPU count
+        :param overwrite: update users that already exist instead of skipping them
+        :return: summary dict with counts, failures and throughput
+    '''
+    start = time.perf_counter()
+    extracted_users = []
+    passwords = {}
+    failures = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        for name, password, image_path, feature_vector, error in executor.map(enroll_entry, entries, chunksize=chunksize):
+            if error:
+                failures.append({"name": name, "image": image_path, "error": error})
+                print(f"FAILED {name} ({image_path}): {error}", file=sys.stderr)
+            else:
+                extracted_users.append((name, feature_vector))
+                passwords.setdefault(name, password)
+        # One bcrypt round per user, however many images of them the manifest lists
+        hashed_passwords = dict(zip(passwords, executor.map(hash_password, passwords.values(), chunksize=chunksize)))
+    extracted = time.perf_counter()
+
+    users = [(name, hashed_passwords[name], feature_vector) for name, feature_vector in extracted_users]
+    counts = DatabaseManager(db_name).register_users(users, overwrite=overwrite)
+    finished = time.perf_counter()
+
+    processed = len(users) + len(failures)
+    return {
+        "processed": processed,
+        "failed": len(failures),
+        "failures": failures,
+        **counts,
+        "extraction_seconds": extracted - start,
+        "database_seconds": finished - extracted,
+        "total_seconds": finished - start,
+        "images_per_second": processed / (extracted - start) if processed else 0.0,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enroll many users from images without the GUI.")
+    parser.add_argument("source", help="CSV manifest with name,password,image columns or a directory of images")
+    parser.add_argument("--password", help="password for every user when enrolling a directory")
+    parser.add_argument("--db", default="user_identification.db", help="database file")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--overwrite", action="store_true", help="update users that already exist")
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        if not args.password:
+            parser.error("--password is required when enrolling a directory")
+        entries = list(read_directory(args.source, args.password))
+    else:
+        entries = list(read_manifest(args.source))
+
+    summary = bulk_enroll(entries, args.db, args.workers, args.overwrite)
+    print(f"Processed {summary['processed']} images in {summary['total_seconds']:.1f} s "
+          f"({summary['images_per_second']:.1f} images/s): {summary['inserted']} inserted, "
+          f"{summary['updated']} updated, {summary['skipped']} skipped, {summary['failed']} failed.")
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
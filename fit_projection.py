@@ -0,0 +1,73 @@
+import argparse
+import os
+import sys
+import numpy as np
+from DatabaseManager import DatabaseManager
+from FeatureProjection import FeatureProjection, projection_path
+
+
+def fit_projection(db_name="user_identification.db", dimension=32, false_accept_rate=0.01):
+    '''
+        Fits a FeatureProjection on the enrolled users and stores it next to the database.
+        Every template is a sample, users without templates contribute their stored feature vector.
+        :return: (projection, number of samples it was fitted on)
+    '''
+    db_manager = DatabaseManager(db_name)
+    ids, _, centroids = db_manager.get_feature_matrix()
+    if len(ids) < 2:
+        raise ValueError("At least two enrolled users are needed to fit a projection.")
+
+    owners, templates = db_manager.get_templates()
+    ids = np.asarray(ids, dtype=np.int64)
+    plain = ~np.isin(ids, owners)
+    samples = np.vstack([templates.reshape(len(owners), -1), centroids[plain]]) if len(owners) else centroids
+    groups = np.concatenate([owners, ids[plain]])
+
+    path = projection_path(db_name)
+    # Versions keep counting across incompatible formats, indexes rebuild whenever the version changes
+    version = FeatureProjection.stored_version(path, db_manager.cipher_suite) + 1 if os.path.exists(path) else 1
+
+    projection = FeatureProjection.fit(samples, dimension, false_accept_rate, version, groups=groups)
+    projection.save(path, db_manager.cipher_suite)
+    return projection, len(samples)
+
+
+def remove_projection(db_name="user_identification.db"):
+    '''Deletes the stored projection, galleries go back to raw feature vectors'''
+    path = projection_path(db_name)
+    if os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit the standardization and PCA projection of the stored "
+                                                 "feature vectors used to search the gallery.")
+    parser.add_argument("--db", default="user_identification.db", help="database file")
+    parser.add_argument("--dimension", type=int, default=32, help="number of principal axes to keep")
+    parser.add_argument("--false-accept-rate", type=float, default=0.01,
+                        help="share of unenrolled people allowed to match an enrolled user")
+    parser.add_argument("--remove", action="store_true", help="delete the stored projection instead")
+    args = parser.parse_args(argv)
+
+    if args.remove:
+        print("Projection removed." if remove_projection(args.db) else "No projection stored.")
+        return 0
+
+    try:
+        projection, samples = fit_projection(args.db, args.dimension, args.false_accept_rate)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    print(f"Projection version {projection.version}: {projection.source_dimension} -> {projection.dimension} "
+          f"dimensions fitted on {samples} vectors, {projection.explained_variance:.1%} of the variance kept, "
+          f"match threshold {projection.threshold:.3f}.")
+    print(f"Search data per user shrinks by {1 - projection.dimension / projection.source_dimension:.0%}; "
+          f"running services pick the projection up on their next gallery refresh.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
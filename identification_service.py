@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from IdentificationClient import IdentificationClient
+from IdentificationService import IdentificationService
+from Metrics import Metrics
+from UserSearch import UserSearch
+
+
+def serve(args):
+    UserSearch.use_shared_gallery = args.shared_gallery
+    if args.metrics_port:
+        Metrics.start_exporter(port=args.metrics_port)
+    service = IdentificationService(args.db, args.workers, args.batch_window_ms / 1000, args.max_batch)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    print(f"Serving identification on {where} with {service.workers} workers", file=sys.stderr)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        Metrics.stop_exporters()
+    return 0
+
+
+def make_client(args):
+    return IdentificationClient(args.host, args.port, args.socket)
+
+
+def identify(args):
+    '''Sends the images repeat times from concurrency parallel clients and prints one JSON line per result'''
+    images = [IdentificationClient.read_image(path) for path in args.images]
+    jobs = [(path, image) for _ in range(args.repeat) for path, image in zip(args.images, images)]
+    local = threading.local()
+    output_lock = threading.Lock()
+
+    def run(job):
+        if not hasattr(local, "client"):
+            local.client = make_client(args)
+        path, image = job
+        start = time.perf_counter()
+        result = local.client.identify(image)
+        result["source"] = path
+        result["round_trip_ms"] = (time.perf_counter() - start) * 1000
+        with output_lock:
+            print(json.dumps(result), flush=True)
+        return result["round_trip_ms"]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        round_trips = np.asarray(list(executor.map(run, jobs)))
+    elapsed = time.perf_counter() - start
+
+    print(f"{len(jobs)} requests in {elapsed:.2f} s ({len(jobs) / elapsed:.1f} requests/s), round trip "
+          f"p50 {np.percentile(round_trips, 50):.1f} ms, p95 {np.percentile(round_trips, 95):.1f} ms",
+          file=sys.stderr)
+    return 0
+
+
+def enroll(args):
+    client = make_client(args)
+    result = client.enroll(args.name, args.password, args.image, args.overwrite, args.add_template)
+    print(json.dumps(result))
+    return 0 if result.get("registered") else 1
+
+
+def stats(args):
+    print(json.dumps(make_client(args).stats(), indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the local identification service or talk to it.")
+    parser.add_argument("--host", default="127.0.0.1", help="service address")
+    parser.add_argument("--port", type=int, default=8765, help="service port")
+    parser.add_argument("--socket", help="Unix socket path, used instead of host and port")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="run the service")
+    serve_parser.add_argument("--db", default="user_identification.db", help="database file")
+    serve_parser.add_argument("--workers", type=int, default=None, help="number of extraction processes")
+    serve_parser.add_argument("--batch-window-ms", type=float, default=5.0,
+                              help="how long identify requests are collected into one gallery query")
+    serve_parser.add_argument("--max-batch", type=int, default=64, help="largest gallery query batch")
+    serve_parser.add_argument("--metrics-port", type=int, help="also serve pipeline metrics on this port")
+    serve_parser.add_argument("--shared-gallery", action="store_true",
+                              help="search the gallery published by publish_gallery.py instead of a private copy")
+    serve_parser.set_defaults(handler=serve)
+
+    identify_parser = commands.add_parser("identify", help="identify faces in images")
+    identify_parser.add_argument("images", nargs="+", help="image files")
+    identify_parser.add_argument("--concurrency", type=int, default=1, help="parallel client connections")
+    identify_parser.add_argument("--repeat", type=int, default=1, help="send every image this many times")
+    identify_parser.set_defaults(handler=identify)
+
+    enroll_parser = commands.add_parser("enroll", help="register a user from an image")
+    enroll_parser.add_argument("name")
+    enroll_parser.add_argument("image")
+    enroll_parser.add_argument("--password", required=True)
+    enroll_parser.add_argument("--overwrite", action="store_true", help="replace an existing user's face data")
+    enroll_parser.add_argument("--add-template", action="store_true", help="add the image to an existing user")
+    enroll_parser.set_defaults(handler=enroll)
+
+    stats_parser = commands.add_parser("stats", help="print service latency and throughput statistics")
+    stats_parser.set_defaults(handler=stats)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
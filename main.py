@@ -1,10 +1,19 @@
+import os
 import sys
 from PyQt5.QtWidgets import QApplication, QStackedWidget
+from Metrics import Metrics
+from ModelWarmupThread import ModelWarmupThread
 from StartScreen import StartScreen
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
 
+    metrics_file = os.environ.get("FACE_RECOGNITION_METRICS_FILE")
+    metrics_port = os.environ.get("FACE_RECOGNITION_METRICS_PORT")
+    if metrics_file or metrics_port:
+        Metrics.start_exporter(metrics_file, int(metrics_port) if metrics_port else None)
+        app.aboutToQuit.connect(Metrics.stop_exporters)
+
     stacked_widget = QStackedWidget()
 
     main_window = StartScreen(stacked_widget)
@@ -14,5 +23,16 @@ if __name__ == "__main__":
     stacked_widget.setFixedSize(680, 480)
     stacked_widget.setWindowTitle("Face Recognition App")
     stacked_widget.show()
+    app.processEvents()
+
+    # Heavy modules and models are loaded only after the window is on screen
+    stacked_widget.model_warmup = ModelWarmupThread()
+    stacked_widget.model_warmup.warmup_complete.connect(main_window.on_models_ready)
+    stacked_widget.model_warmup.start()
+
+    from DatabaseManager import DatabaseManager
+    DatabaseManager.open_session()
+    app.aboutToQuit.connect(DatabaseManager.close_session)
+    app.aboutToQuit.connect(stacked_widget.model_warmup.wait)
 
     sys.exit(app.exec_())
@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+from DatabaseManager import DatabaseManager
+from FeatureProjection import projection_path
+from SharedGallery import SharedGallery
+from UserSearch import UserSearch
+
+
+def file_state(path):
+    '''Returns what identifies the current version of a file, None when it does not exist'''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def publish_gallery(db_name="user_identification.db", interval=1.0, iterations=None):
+    '''
+        Publishes the gallery of a database for other processes and republishes it whenever
+        the database or its projection changes, e.g. after register_user() in any process.
+        Changes are applied to the publisher's own gallery incrementally, see UserSearch.load_private_gallery().
+        Every check also refreshes the heartbeat, without it attached processes stop using the gallery.
+        :param interval: seconds between checks of the database file
+        :param iterations: number of checks before returning, None to run until interrupted
+        :return: the gallery published last
+    '''
+    db_manager = DatabaseManager(db_name)
+    stale_after = max(10.0, 5 * interval)
+    published = None
+    seen = None
+    checks = 0
+    while iterations is None or checks < iterations:
+        # Taken before loading, a change written during the load moves the state again for the next check
+        state = (file_state(db_name), file_state(projection_path(db_name)))
+        if state != seen:
+            gallery = load_without_writing(db_manager)
+            seen = state
+            if gallery is not published:
+                version = SharedGallery.publish(gallery, db_name, stale_after)
+                published = gallery
+                print(f"Published gallery version {version} with {len(gallery)} users at revision "
+                      f"{gallery.revision}.", file=sys.stderr)
+        SharedGallery.heartbeat(db_name)
+        checks += 1
+        if iterations is None or checks < iterations:
+            time.sleep(interval)
+    return published
+
+
+def load_without_writing(db_manager):
+    '''
+        Refreshes the publisher's gallery through a session, which decrypts the file into memory.
+        Outside of a session every read decrypts and re-encrypts the file in place, which would
+        change its state on every check and race with the enrolling processes.
+    '''
+    if db_manager.session() is not None:
+        return UserSearch.load_private_gallery(db_manager)
+    DatabaseManager.open_session(db_manager.db_name)
+    try:
+        return UserSearch.load_private_gallery(db_manager)
+    finally:
+        DatabaseManager.close_session(db_manager.db_name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Share one copy of the gallery with all recognition processes "
+                                                 "on this host and keep it up to date.")
+    parser.add_argument("--db", default="user_identification.db", help="database file")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between checks for new enrollments")
+    args = parser.parse_args(argv)
+
+    try:
+        publish_gallery(args.db, args.interval)
+    except KeyboardInterrupt:
+        pass
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        # Processes attached to the gallery keep it, new ones fall back to loading their own
+        SharedGallery.unpublish(args.db)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())